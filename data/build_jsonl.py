@@ -1,5 +1,8 @@
 from datasets import load_dataset
+import argparse
 import json
+import os
+import sys
 import string
 import random
 import numpy as np
@@ -7,6 +10,10 @@ import re
 from tqdm import tqdm
 import json
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from reading_index import RUBY_PATTERN, ReadingLookup
+from instrument import REPORT, add_report_arguments
+
 
 def condensed(text):
     text = text.strip()
@@ -57,6 +64,14 @@ def sanity_check(input_string, key_kanji):
     return True
 
 
+def plausibility_check(input_string, reading_lookup, min_share=0.01, min_total=20):
+    # reject outputs with a reading that is rare for a well-attested lemma in the corpus
+    for lemma, reading in RUBY_PATTERN.findall(input_string):
+        if not reading_lookup.is_plausible(lemma, reading, min_share, min_total):
+            return False
+    return True
+
+
 KEY_KANJI = {
     "人": ["ひと", "にん", "じん"],
     "回": ["かい"],
@@ -66,19 +81,29 @@ KEY_KANJI = {
 }
 
 
-def dataset_to_jsonl_filter(dataset, output_file, text_replacements={}):
+def dataset_to_jsonl_filter(
+    dataset, output_file, text_replacements={}, reading_lookup=None
+):
     # filepaths = {}
     n_same, n_diff = 0, 0
     with open(output_file, "w", encoding="utf-8") as f:
         random.shuffle(dataset)
         for example in dataset:
+            REPORT.count("rows_read")
             if len(condensed(example["input"])) < 10:
+                REPORT.count("rejected_too_short")
                 continue
             # if example["file_path"] in filepaths:
             #     filepaths[example["file_path"]] += 1
             #     if filepaths[example["file_path"]] > 30:
             #         continue
             if not sanity_check(example["output"], KEY_KANJI):
+                REPORT.count("rejected_key_kanji")
+                continue
+            if reading_lookup is not None and not plausibility_check(
+                example["output"], reading_lookup
+            ):
+                REPORT.count("rejected_implausible_reading")
                 continue
             if example["output"] == example["mecab_output"]:
                 # if random.random() > 0.1:
@@ -87,9 +112,12 @@ def dataset_to_jsonl_filter(dataset, output_file, text_replacements={}):
             else:
                 n_diff += 1
             for replacement in text_replacements:
-                example["output"] = example["output"].replace(
-                    replacement, text_replacements[replacement]
-                )
+                n_replaced = example["output"].count(replacement)
+                if n_replaced:
+                    REPORT.count("replacements_applied", n_replaced)
+                    example["output"] = example["output"].replace(
+                        replacement, text_replacements[replacement]
+                    )
             json_line = json.dumps(
                 {
                     "input": example["input"],
@@ -100,7 +128,10 @@ def dataset_to_jsonl_filter(dataset, output_file, text_replacements={}):
             )
             # filepaths[example["file_path"]] = 1
             f.write(json_line + "\n")
-    print(n_same, n_diff)
+    REPORT.count("rows_same_as_mecab", n_same)
+    REPORT.count("rows_diff_from_mecab", n_diff)
+    REPORT.count("rows_out", n_same + n_diff)
+    return n_same + n_diff
 
 
 TEXT_REPLACEMENTS = {
@@ -212,21 +243,42 @@ def hito_template(readings):
     return output
 
 
-if __name__ == "__main__":
-    dataset = load_dataset("aozora_speech_examples", split="train")
+def filter_by_length(dataset, low_percentile=5, high_percentile=95):
     input_lengths = [len(example["input"]) for example in dataset]
-    min_length = int(np.percentile(input_lengths, 5))
-    max_length = int(np.percentile(input_lengths, 95))
+    min_length = int(np.percentile(input_lengths, low_percentile))
+    max_length = int(np.percentile(input_lengths, high_percentile))
     print(max(input_lengths), min_length, max_length)
 
-    filtered_dataset = [
+    filtered = [
         example
         for example in dataset
         if len(example["input"]) >= min_length and len(example["input"]) <= max_length
     ]
+    REPORT.count("rejected_length_percentile", len(input_lengths) - len(filtered))
+    return filtered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Filter speech examples into training JSONL")
+    add_report_arguments(parser)
+    args = parser.parse_args()
+
+    REPORT.start("build_jsonl", args)
+    with REPORT.stage("load"):
+        dataset = load_dataset("aozora_speech_examples", split="train")
+    with REPORT.stage("filter_by_length"):
+        filtered_dataset = filter_by_length(dataset)
 
     output_jsonl_path = "aozora_speech_new.jsonl"
     TEXT_REPLACEMENTS = TEXT_REPLACEMENTS | hito_template(
         ["ひと", "にん", "じん", "ぴと", "びと"]
     )
-    dataset_to_jsonl_filter(filtered_dataset, output_jsonl_path, TEXT_REPLACEMENTS)
+    reading_index_path = "aozora_speech_readings.sqlite"
+    reading_lookup = (
+        ReadingLookup(reading_index_path) if os.path.exists(reading_index_path) else None
+    )
+    with REPORT.stage("dataset_to_jsonl_filter"):
+        dataset_to_jsonl_filter(
+            filtered_dataset, output_jsonl_path, TEXT_REPLACEMENTS, reading_lookup
+        )
+    REPORT.save()
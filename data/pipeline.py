@@ -0,0 +1,216 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+
+def hash_bytes(*parts: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class FileHasher:
+    """
+    Content hashes of files and directories, remembered by (path, size, mtime)
+    so unchanged inputs are not re-read on every run.
+    """
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self.cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as file:
+                self.cache = json.load(file)
+
+    def hash_file(self, path: str) -> str:
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        if key not in self.cache:
+            digest = hashlib.sha256()
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(chunk)
+            self.cache[key] = digest.hexdigest()
+        return self.cache[key]
+
+    def hash_path(self, path: str) -> str:
+        if os.path.isfile(path):
+            return self.hash_file(path)
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"pipeline: input {path} does not exist")
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                entries.append(
+                    f"{os.path.relpath(filepath, path)}:{self.hash_file(filepath)}"
+                )
+        return hash_bytes("\n".join(entries).encode())
+
+    def save(self):
+        with open(self.cache_path, "w", encoding="utf-8") as file:
+            json.dump(self.cache, file)
+
+
+class Stage:
+    """
+    A pipeline step. fn(inputs, output_dir, **params) receives a dict mapping each
+    input to a path (files/directories as given, stages as their cached output
+    directory), writes its outputs into output_dir and may return a dict with
+    "rows_in"/"rows_out" counts for the run report.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable,
+        inputs: Sequence[str] = (),
+        params: Optional[dict] = None,
+        version: str = "1",
+        code: Sequence = (),
+    ):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.version = version
+        # functions or modules whose source is part of the cache key besides fn
+        self.code = [fn] + list(code)
+
+    def code_hash(self) -> str:
+        return hash_bytes(
+            self.version.encode(),
+            *(inspect.getsource(obj).encode() for obj in self.code),
+        )
+
+
+class Pipeline:
+    """
+    Runs stages in declaration order, caching each stage's outputs under a hash of
+    its input contents, parameters and code; a stage only re-runs if one of those changed.
+
+    With a report (instrument.RunReport), its counters are reset before each stage
+    runs and saved with that stage's _stage.json.
+    """
+
+    def __init__(self, cache_dir=".pipeline_cache", report=None):
+        self.cache_dir = cache_dir
+        self.report = report
+        self.stages: Dict[str, Stage] = {}
+        self.keys: Dict[str, str] = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hasher = FileHasher(os.path.join(cache_dir, "file_hashes.json"))
+
+    def stage(self, name, inputs=(), params=None, version="1", code=()):
+        """
+        Decorator registering fn as a stage; inputs may name earlier stages.
+        """
+
+        def register(fn):
+            self.stages[name] = Stage(name, fn, inputs, params, version, code)
+            return fn
+
+        return register
+
+    def output_dir(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name, self.keys[name])
+
+    def stage_key(self, stage: Stage) -> str:
+        input_hashes = [
+            f"stage:{self.keys[path]}" if path in self.stages else self.hasher.hash_path(path)
+            for path in stage.inputs
+        ]
+        params = json.dumps(stage.params, sort_keys=True, ensure_ascii=False, default=repr)
+        return hash_bytes(
+            stage.code_hash().encode(),
+            "\n".join(input_hashes).encode(),
+            params.encode(),
+        )[:16]
+
+    def run(self, targets: Optional[List[str]] = None, force: Sequence[str] = ()):
+        """
+        Runs the pipeline up to targets (all stages by default).
+
+        Args:
+            targets (list): Names of the stages to produce; their dependencies run as needed.
+            force (list): Names of stages to re-run even if cached, along with every
+                stage that depends on them.
+
+        Returns:
+            list: One report dict per stage with status, timing and row counts.
+        """
+        needed = self._dependencies(targets or list(self.stages))
+        report = []
+        ran = set()
+        for name, stage in self.stages.items():
+            if name not in needed:
+                continue
+            for path in stage.inputs:
+                if path in self.stages and path not in self.keys:
+                    raise ValueError(f"pipeline: stage {name} depends on later stage {path}")
+            key = self.stage_key(stage)
+            self.keys[name] = key
+            output_dir = self.output_dir(name)
+            meta_path = os.path.join(output_dir, "_stage.json")
+            # a forced stage's output may differ under the same key, so the stages
+            # reading it must not be served from the cache either
+            stale = name in force or any(path in ran for path in stage.inputs)
+            if os.path.exists(meta_path) and not stale:
+                with open(meta_path, "r", encoding="utf-8") as file:
+                    meta = json.load(file)
+                meta["status"] = "cached"
+                meta["wall_time"] = 0.0
+            else:
+                meta = self._run_stage(stage, output_dir, meta_path)
+                ran.add(name)
+            report.append(meta)
+            print(
+                f"[{meta['status']:>6}] {name} ({key}): {meta['wall_time']:.1f}s, "
+                f"rows in {meta.get('rows_in', '-')}, rows out {meta.get('rows_out', '-')}",
+                flush=True,
+            )
+        self.hasher.save()
+        return report
+
+    def _run_stage(self, stage: Stage, output_dir: str, meta_path: str) -> dict:
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)  # left over from an interrupted run
+        os.makedirs(output_dir)
+        inputs = {
+            path: self.output_dir(path) if path in self.stages else path
+            for path in stage.inputs
+        }
+        if self.report is not None:
+            self.report.counters.clear()
+        start = time.perf_counter()
+        stats = stage.fn(inputs, output_dir, **stage.params) or {}
+        meta = {
+            "stage": stage.name,
+            "key": self.keys[stage.name],
+            "status": "ran",
+            "wall_time": time.perf_counter() - start,
+            **stats,
+        }
+        if self.report is not None:
+            meta["counters"] = dict(self.report.counters)
+        with open(meta_path, "w", encoding="utf-8") as file:
+            json.dump(meta, file, ensure_ascii=False)
+        return meta
+
+    def _dependencies(self, targets: List[str]) -> set:
+        needed = set()
+        stack = list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in self.stages:
+                raise KeyError(f"pipeline: unknown stage {name}")
+            if name not in needed:
+                needed.add(name)
+                stack.extend(path for path in self.stages[name].inputs if path in self.stages)
+        return needed
@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import sys
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, Tuple
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from instrument import REPORT, add_report_arguments
+
+# "[INST] {instruction}\n{input}\n[/INST]\n" as in inference.format_prompt, which
+# is not imported here to keep torch out of the tokenizer workers (as tiny_random)
+PROMPT_TEMPLATE = """[INST] {instruction}\n{input}\n[/INST]\n"""
+ARRAYS = {
+    "tokens": np.uint32,
+    "loss_mask": np.uint8,
+    "offsets": np.uint64,  # example i is tokens[offsets[i] : offsets[i + 1]]
+    "pack_examples": np.uint32,  # example ids, pack by pack
+    "pack_offsets": np.uint64,  # pack j is pack_examples[pack_offsets[j] : pack_offsets[j + 1]]
+}
+
+tokenizer = None  # per worker process
+
+
+def load_tokenizer(name: str):
+    if name == "tiny-random":
+        from tiny_random import tiny_random_tokenizer
+
+        return tiny_random_tokenizer()
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(name)
+
+
+def init_worker(tokenizer_name: str):
+    global tokenizer
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"  # the pool is the parallelism
+    tokenizer = load_tokenizer(tokenizer_name)
+
+
+def format_example(row: dict) -> Tuple[str, str]:
+    # build_jsonl.py rows carry the instruction; process_anki.py rows have the
+    # [INST] block in input already
+    if row.get("instruction"):
+        prompt = PROMPT_TEMPLATE.format(instruction=row["instruction"], input=row["input"])
+    else:
+        prompt = row["input"] + "\n"
+    return prompt, row["output"]
+
+
+def tokenize_batch(rows: List[dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Tokenizes a batch of examples into flat tokens, their loss mask (1 on the response)
+    and the length of each example.
+    """
+    if tokenizer.eos_token_id is None:
+        # responses end in eos, or the model never learns to stop
+        raise ValueError(f"tokenize_batch: tokenizer {tokenizer.name_or_path} has no eos token")
+    prompts, responses = zip(*(format_example(row) for row in rows))
+    # the prompt is tokenized on its own, as at inference time
+    prompt_ids = tokenizer(list(prompts))["input_ids"]
+    response_ids = tokenizer(list(responses), add_special_tokens=False)["input_ids"]
+    tokens, loss_mask, lengths = [], [], []
+    for prompt, response in zip(prompt_ids, response_ids):
+        response = response + [tokenizer.eos_token_id]
+        tokens.extend(prompt)
+        tokens.extend(response)
+        loss_mask.extend([0] * len(prompt) + [1] * len(response))
+        lengths.append(len(prompt) + len(response))
+    return (
+        np.array(tokens, dtype=np.uint32),
+        np.array(loss_mask, dtype=np.uint8),
+        np.array(lengths, dtype=np.uint64),
+    )
+
+
+def read_batches(paths: List[str], batch_size: int) -> Iterator[List[dict]]:
+    batch = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+
+def raw_to_npy(raw_path: str, npy_path: str, dtype, chunk=1 << 24):
+    # the total length is only known at the end; copy in chunks to keep memory flat
+    raw = np.memmap(raw_path, dtype=dtype, mode="r") if os.path.getsize(raw_path) else None
+    size = 0 if raw is None else len(raw)
+    array = np.lib.format.open_memmap(npy_path, mode="w+", dtype=dtype, shape=(size,))
+    for start in range(0, size, chunk):
+        array[start : start + chunk] = raw[start : start + chunk]
+    array.flush()
+    del array, raw
+    os.remove(raw_path)
+
+
+def first_fit_decreasing(lengths: np.ndarray, capacity: int) -> List[List[int]]:
+    """
+    Packs items into bins of the given capacity, longest first, each into the first
+    bin it fits in. A max segment tree over the bins' free space finds that bin in
+    O(log n). Items longer than capacity must be left out by the caller.
+    """
+    order = np.argsort(-lengths.astype(np.int64), kind="stable")
+    size = 1
+    while size < max(1, len(order)):
+        size *= 2
+    # leaves are bins, all empty to start; a new bin is simply the next unused leaf
+    free = [capacity] * (2 * size)
+    bins: List[List[int]] = []
+    for item in order.tolist():
+        length = int(lengths[item])
+        node = 1
+        while node < size:
+            node = 2 * node if free[2 * node] >= length else 2 * node + 1
+        leaf = node - size
+        if leaf == len(bins):
+            bins.append([])
+        bins[leaf].append(item)
+        free[node] -= length
+        node //= 2
+        while node:
+            free[node] = max(free[2 * node], free[2 * node + 1])
+            node //= 2
+    return bins
+
+
+def pretokenize(
+    paths: List[str],
+    output_dir: str,
+    tokenizer_name: str,
+    context_length: int = 2048,
+    batch_size: int = 1024,
+    workers=None,
+) -> Dict[str, float]:
+    """
+    Tokenizes prompt/response JSONL once into memory-mapped arrays and packs the
+    examples into context windows.
+
+    Writes tokens.npy (uint32), loss_mask.npy (uint8) and offsets.npy (one entry per
+    example plus one) with the examples in input order, pack_examples.npy and
+    pack_offsets.npy with the packing, and meta.json. Batches are tokenized in
+    worker processes and appended in order, so memory does not grow with the data.
+    Examples longer than context_length are kept in the arrays but not packed.
+
+    Returns:
+        dict: Counts and packing efficiency, the share of packed window tokens that
+        are real tokens, next to the efficiency of padding every example to the window.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    raw_paths = {
+        name: os.path.join(output_dir, f"{name}.raw") for name in ("tokens", "loss_mask")
+    }
+    files = {name: open(path, "wb") for name, path in raw_paths.items()}
+    lengths = []
+    pool = Pool(workers, initializer=init_worker, initargs=(tokenizer_name,))
+    try:
+        for tokens, loss_mask, batch_lengths in pool.imap(
+            tokenize_batch, read_batches(paths, batch_size)
+        ):
+            files["tokens"].write(tokens.tobytes())
+            files["loss_mask"].write(loss_mask.tobytes())
+            lengths.append(batch_lengths)
+            REPORT.count("rows_in", len(batch_lengths))
+    finally:
+        pool.close()
+        pool.join()
+        for file in files.values():
+            file.close()
+    for name, raw_path in raw_paths.items():
+        raw_to_npy(raw_path, os.path.join(output_dir, f"{name}.npy"), ARRAYS[name])
+
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.uint64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.uint64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(os.path.join(output_dir, "offsets.npy"), offsets)
+
+    fits = np.flatnonzero(lengths <= context_length)
+    bins = first_fit_decreasing(lengths[fits], context_length)
+    pack_examples = np.array(
+        [fits[item] for items in bins for item in items], dtype=ARRAYS["pack_examples"]
+    )
+    pack_offsets = np.zeros(len(bins) + 1, dtype=np.uint64)
+    np.cumsum([len(items) for items in bins], out=pack_offsets[1:])
+    np.save(os.path.join(output_dir, "pack_examples.npy"), pack_examples)
+    np.save(os.path.join(output_dir, "pack_offsets.npy"), pack_offsets)
+
+    packed_tokens = int(lengths[fits].sum())
+    stats = {
+        "examples": len(lengths),
+        "tokens": int(offsets[-1]),
+        "too_long": len(lengths) - len(fits),
+        "packs": len(bins),
+        "packing_efficiency": packed_tokens / (len(bins) * context_length) if bins else None,
+        "padding_efficiency": packed_tokens / (len(fits) * context_length)
+        if len(fits)
+        else None,
+    }
+    REPORT.update({"rows_out": len(fits), "rejected_too_long": stats["too_long"]})
+    meta = {"tokenizer": tokenizer_name, "context_length": context_length, **stats}
+    with open(os.path.join(output_dir, "meta.json"), "w", encoding="utf-8") as file:
+        json.dump(meta, file, ensure_ascii=False, indent=2)
+    return stats
+
+
+class PackedDataset:
+    """
+    Read-only view of a pretokenize output directory, one item per packed window.
+
+    Items are numpy arrays: input_ids, labels (-100 outside the responses and on
+    padding) and position_ids, which restart at every example and once more for the
+    padding. There is deliberately no attention_mask: examples in a pack are kept
+    apart only by where position_ids restart, so the model must be called without
+    one, and with use_cache=False. transformers then builds a block-diagonal causal
+    mask from position_ids (see masking_utils.find_packed_sequence_indices), and
+    flash attention runs each example as its own varlen sequence. With an
+    attention_mask, a cache, or a model that does not derive the mask from
+    position_ids, packed examples attend to each other.
+    """
+
+    def __init__(self, path: str, pad_token_id: int = 0):
+        self.arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ARRAYS
+        }
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as file:
+            self.meta = json.load(file)
+        self.context_length = self.meta["context_length"]
+        self.pad_token_id = pad_token_id
+
+    def __len__(self):
+        return len(self.arrays["pack_offsets"]) - 1
+
+    def __getitem__(self, index: int) -> Dict[str, np.ndarray]:
+        if not 0 <= index < len(self):
+            raise IndexError(f"PackedDataset: no pack {index}")
+        tokens, loss_mask, offsets = (
+            self.arrays["tokens"],
+            self.arrays["loss_mask"],
+            self.arrays["offsets"],
+        )
+        pack_offsets = self.arrays["pack_offsets"]
+        examples = self.arrays["pack_examples"][pack_offsets[index] : pack_offsets[index + 1]]
+        input_ids = np.full(self.context_length, self.pad_token_id, dtype=np.int64)
+        labels = np.full(self.context_length, -100, dtype=np.int64)
+        position_ids = np.zeros(self.context_length, dtype=np.int64)
+        end = 0
+        for example in examples.tolist():
+            start, stop = int(offsets[example]), int(offsets[example + 1])
+            length = stop - start
+            input_ids[end : end + length] = tokens[start:stop]
+            labels[end : end + length] = np.where(
+                loss_mask[start:stop], tokens[start:stop], -100
+            )
+            position_ids[end : end + length] = np.arange(length)
+            end += length
+        position_ids[end:] = np.arange(self.context_length - end)
+        return {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tokenize training JSONL once into packed, memory-mapped arrays"
+    )
+    parser.add_argument("tokenizer", help="tokenizer path or hub name, or tiny-random")
+    parser.add_argument("output_dir")
+    parser.add_argument("inputs", nargs="+", help="JSONL with input/output(/instruction)")
+    parser.add_argument("--context-length", type=int, default=2048)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    add_report_arguments(parser)
+    args = parser.parse_args()
+
+    REPORT.start("pretokenize", args)
+    with REPORT.stage("pretokenize"):
+        stats = pretokenize(
+            args.inputs,
+            args.output_dir,
+            args.tokenizer,
+            args.context_length,
+            args.batch_size,
+            args.workers,
+        )
+    print(json.dumps(stats, indent=2))
+    REPORT.save()
+
+
+if __name__ == "__main__":
+    main()
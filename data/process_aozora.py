@@ -1,7 +1,15 @@
+import argparse
 import re
 import os
+import sys
+from functools import partial
+from collections import Counter
 from datasets import Dataset, DatasetDict, Value, Features
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from reading_index import ReadingIndex, process_files
+from instrument import REPORT, add_report_arguments
+
 
 def process_reading(reading):
     """
@@ -57,7 +65,11 @@ def condensed(text):
 
 
 def process_file(
-    filepath, delimiter_config, validate_sentence=False, validate_reading=False
+    filepath,
+    delimiter_config,
+    validate_sentence=False,
+    validate_reading=False,
+    stats=None,
 ):
     """
     Processes a single file and returns a list of examples.
@@ -65,10 +77,13 @@ def process_file(
     Args:
         filepath (str): The path to the file to be processed.
         delimiter_config (dict): A dictionary containing delimiter configurations.
+        stats (Counter): If given, rows read and rejected (by reason) are counted in it.
 
     Returns:
         list: A list of examples, where each example is a dictionary containing the input sentence, output sentence, and reference reading.
     """
+    if stats is None:
+        stats = Counter()
     examples = []
     with open(filepath, "r", encoding="utf-8") as file:
         sentence, reading, segments = "", "", []
@@ -76,6 +91,7 @@ def process_file(
         for line in file:
             if "行番号" in line:
                 if segments:  # reached new example; process the previous one
+                    stats["rows_read"] += 1
                     formatted_output = "".join(segments)
                     sentence_validation = condensed(sentence_validation)
                     reading_validation = condensed(reading_validation)
@@ -86,11 +102,15 @@ def process_file(
                         or (_sentence != sentence_validation and validate_sentence)
                         or (_reading != reading_validation and validate_reading)
                     ):
+                        if "<ruby>" not in formatted_output:
+                            stats["rejected_no_ruby"] += 1
                         if _sentence != sentence_validation and validate_sentence:
+                            stats["rejected_sentence_mismatch"] += 1
                             print(
                                 f"Error 1: {_sentence} != {sentence_validation}, file: {filepath}"
                             )
                         if _reading != reading_validation and validate_reading:
+                            stats["rejected_reading_mismatch"] += 1
                             print(
                                 f"Error 2: {_reading} != {reading_validation}, file: {filepath}"
                             )
@@ -116,6 +136,8 @@ def process_file(
                 reading_validation += line.split("\t")[1]
 
         # Process the last example in the file
+        if segments:
+            stats["rows_read"] += 1
         formatted_output = "".join(segments).strip()
         if (
             "<ruby>" not in formatted_output
@@ -130,7 +152,12 @@ def process_file(
 
 
 def process_directory(
-    root_dir, delimiters, validate_sentence=False, validate_reading=False
+    root_dir,
+    delimiters,
+    validate_sentence=False,
+    validate_reading=False,
+    index=None,
+    workers=1,
 ):
     """
     Walks through the directory, processes all .txt files, and adds the examples to a HuggingFace dataset.
@@ -138,25 +165,32 @@ def process_directory(
     Args:
         root_dir (str): The root directory to start the walk.
         delimiters (dict): A dictionary containing delimiter configurations.
+        validate_sentence (bool): Reject examples whose sentence differs from the source line.
+        validate_reading (bool): Reject examples whose reading differs from the source line.
+        index (ReadingIndex): If given, the readings of all examples are merged into it.
+        workers (int): Number of worker processes to parse files with.
 
     Returns:
         DatasetDict: A HuggingFace dataset containing all processed examples.
     """
     examples = []
-    n_file_processed = 0
-    for dirpath, _, filenames in os.walk(root_dir):
-        for filename in [f for f in filenames if f.endswith(".txt")]:
-            filepath = os.path.join(dirpath, filename)
-            file_examples = process_file(filepath, delimiters)
-            for example in file_examples:
-                example["file_path"] = os.path.relpath(
-                    filepath, start=root_dir
-                )  # Add relative file path to each example
-                examples.append(example)
-            n_file_processed += 1
-            if n_file_processed % 100 == 0:
-                print(f"Processed {n_file_processed} files", flush=True)
-    print(f"Processed {n_file_processed} files", flush=True)
+    filepaths = [
+        os.path.join(dirpath, filename)
+        for dirpath, _, filenames in os.walk(root_dir)
+        for filename in filenames
+        if filename.endswith(".txt")
+    ]
+    worker = partial(
+        process_file,
+        delimiter_config=delimiters,
+        validate_sentence=validate_sentence,
+        validate_reading=validate_reading,
+    )
+    for file_examples, file_stats in process_files(worker, filepaths, root_dir, index, workers):
+        REPORT.update(file_stats)
+        REPORT.count("files_processed")
+        examples.extend(file_examples)
+    REPORT.count("rows_out", len(examples))
 
     features = Features(
         {
@@ -173,12 +207,27 @@ def process_directory(
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Build examples from Aozora ruby text")
+    add_report_arguments(parser)
+    args = parser.parse_args()
+
+    REPORT.start("process_aozora", args)
     root_directory = "aozora_dataset"
     delimiters = {"ruby": ("<ruby>", "</ruby>"), "rt": ("<rt>", "</rt>")}
-    dataset = process_directory(
-        root_directory, delimiters, validate_sentence=True, validate_reading=True
-    )
-    dataset.save_to_disk("./aozora_examples")
+    index = ReadingIndex()
+    with REPORT.stage("process_directory"):
+        dataset = process_directory(
+            root_directory,
+            delimiters,
+            validate_sentence=True,
+            validate_reading=True,
+            index=index,
+            workers=os.cpu_count(),
+        )
+    with REPORT.stage("save"):
+        dataset.save_to_disk("./aozora_examples")
+        index.save("./aozora_readings.sqlite")
+    REPORT.save()
 
 
 if __name__ == "__main__":
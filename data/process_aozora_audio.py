@@ -1,19 +1,19 @@
+import argparse
 import string
 import zipfile
 import os
+import sys
+from functools import partial
 from datasets import Dataset, DatasetDict, Value, Features
 import json
-from collections import defaultdict
+from collections import Counter, defaultdict
 
-L_REMOVE = r"""!%&)*+,-./:;=>?@\]^_`|}~)・〕"""
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from reading_index import ReadingIndex, process_files
+from kanji_dict import KANJI_READINGS
+from instrument import REPORT, add_report_arguments
 
-# KANJI_DATA = defaultdict(set)
-# with open("kanji-kyouiku.json", "r", encoding="utf-8") as file:
-#     kanji_data_full = json.load(file)
-#     for kanji in kanji_data_full:
-#         KANJI_DATA[kanji].update(kanji_data_full[kanji]["readings_on"])
-#         KANJI_DATA[kanji].update(kanji_data_full[kanji]["readings_kun"])
-#     print(KANJI_DATA)
+L_REMOVE = r"""!%&)*+,-./:;=>?@\]^_`|}~)・〕"""
 
 
 def condensed(text):
@@ -50,7 +50,22 @@ def find_and_extract_zips(root_dir, target_dir):
     print(f"Extracted {n} zip files")
 
 
-def process_file(file_path, delimiters):
+def process_file(file_path, delimiters, kanji_check=False, stats=None):
+    """
+    Processes a single file and returns a list of examples.
+
+    Args:
+        file_path (str): The path to the file to be processed.
+        delimiters (dict): A dictionary containing delimiter configurations.
+        kanji_check (bool): Whether to reject blocks where a single-kanji lemma has a
+            reading not found in the kanji reading dictionary.
+        stats (Counter): If given, rows read and rejected (by reason) are counted in it.
+
+    Returns:
+        list: A list of examples with the inferred and MeCab annotated outputs.
+    """
+    if stats is None:
+        stats = Counter()
     current_block = {
         "input": "",
         "output": "",
@@ -91,30 +106,33 @@ def process_file(file_path, delimiters):
 
     with open(file_path, "r", encoding="utf-8") as file:
         readings_section = False
-        # kanji_check_failed = False
+        kanji_check_failed = False
         for line in file:
             if "行番号" in line:
                 if current_block["input"]:
-                    if (
-                        len(current_block["inferred_readings"]) == 0
-                        # or kanji_check_failed
-                    ):
-                        continue
-                    inferred_annotated, mecab_annotated = process_block(current_block)
-                    examples.append(
-                        {
-                            "input": current_block["input"].lstrip(L_REMOVE),
-                            "output": inferred_annotated.lstrip(L_REMOVE),
-                            "mecab_output": mecab_annotated.lstrip(L_REMOVE),
-                        }
-                    )
+                    stats["rows_read"] += 1
+                    if len(current_block["inferred_readings"]) == 0:
+                        stats["rejected_no_readings"] += 1
+                    elif kanji_check_failed:
+                        stats["kanji_check_rejected_blocks"] += 1
+                    else:
+                        inferred_annotated, mecab_annotated = process_block(
+                            current_block
+                        )
+                        examples.append(
+                            {
+                                "input": current_block["input"].lstrip(L_REMOVE),
+                                "output": inferred_annotated.lstrip(L_REMOVE),
+                                "mecab_output": mecab_annotated.lstrip(L_REMOVE),
+                            }
+                        )
                 current_block = {
                     "input": "",
                     "output": "",
                     "inferred_readings": [],
                     "mecab_readings": [],
                 }
-                # kanji_check_failed = False
+                kanji_check_failed = False
             elif "[青空文庫テキスト]" in line:
                 current_block["input"] = line.split("\t")[0]
             elif "読み推定結果:" in line:
@@ -123,15 +141,23 @@ def process_file(file_path, delimiters):
                 parts = line.strip().split()  # there are mixed spaces here...
                 if len(parts) == 4:
                     lemma, inferred_reading, mecab_reading, whisper_text = parts
-                    # if inferred_reading not in KANJI_DATA[lemma]:
-                    #     kanji_check_failed = True
+                    if kanji_check:
+                        known = KANJI_READINGS.check(lemma, inferred_reading)
+                        if known is not None:
+                            stats["kanji_check_readings"] += 1
+                            if not known:
+                                stats["kanji_check_rejected_readings"] += 1
+                                kanji_check_failed = True
                     current_block["inferred_readings"].append((lemma, inferred_reading))
                     current_block["mecab_readings"].append((lemma, mecab_reading))
             elif line.strip() == "":
                 readings_section = False
 
     if current_block["input"]:
-        if len(current_block["inferred_readings"]) != 0:
+        stats["rows_read"] += 1
+        if kanji_check_failed:
+            stats["kanji_check_rejected_blocks"] += 1
+        elif len(current_block["inferred_readings"]) != 0:
             inferred_annotated, mecab_annotated = process_block(current_block)
             examples.append(
                 {
@@ -140,43 +166,62 @@ def process_file(file_path, delimiters):
                     "mecab_output": mecab_annotated.lstrip(L_REMOVE),
                 }
             )
+        else:
+            stats["rejected_no_readings"] += 1
 
     return examples
 
 
-def process_directory(root_dir, delimiters):
+def process_directory(root_dir, delimiters, index=None, workers=1, kanji_check=False):
     """
     Walks through the directory, processes all .txt files, and adds the examples to a HuggingFace dataset.
 
     Args:
         root_dir (str): The root directory to start the walk.
         delimiters (dict): A dictionary containing delimiter configurations.
+        index (ReadingIndex): If given, the inferred readings are merged into it.
+            Counts are per file, so they include examples later dropped as duplicates.
+        workers (int): Number of worker processes to parse files with.
+        kanji_check (bool): Whether to reject blocks with readings not in the kanji dictionary.
 
     Returns:
         DatasetDict: A HuggingFace dataset containing all processed examples.
     """
     examples = []
-    n_file_processed = 0
     seen_examples = set()
-    for dirpath, _, filenames in os.walk(root_dir):
-        for filename in [f for f in filenames if f.endswith(".txt")]:
-            filepath = os.path.join(dirpath, filename)
-            file_examples = process_file(filepath, delimiters)
-            for example in file_examples:
-                input_output_pair = (
-                    condensed(example["input"]),
-                    condensed(example["output"]),
-                )
-                if input_output_pair not in seen_examples:  # Check for duplication
-                    seen_examples.add(input_output_pair)
-                    example["file_path"] = os.path.relpath(
-                        filepath, start=root_dir
-                    )  # Add relative file path to each example
-                    examples.append(example)
-            n_file_processed += 1
-            if n_file_processed % 100 == 0:
-                print(f"Processed {n_file_processed} files", flush=True)
-    print(f"Processed {n_file_processed} files", flush=True)
+    stats = Counter()
+    filepaths = [
+        os.path.join(dirpath, filename)
+        for dirpath, _, filenames in os.walk(root_dir)
+        for filename in filenames
+        if filename.endswith(".txt")
+    ]
+    worker = partial(process_file, delimiters=delimiters, kanji_check=kanji_check)
+    if kanji_check:
+        # load (or build) the dictionary once here, so forked workers inherit it
+        # instead of each reading or writing kanji_readings.pkl
+        KANJI_READINGS.readings
+    for file_examples, file_stats in process_files(worker, filepaths, root_dir, index, workers):
+        stats.update(file_stats)
+        stats["files_processed"] += 1
+        for example in file_examples:
+            input_output_pair = (
+                condensed(example["input"]),
+                condensed(example["output"]),
+            )
+            if input_output_pair not in seen_examples:  # Check for duplication
+                seen_examples.add(input_output_pair)
+                examples.append(example)
+            else:
+                stats["rejected_duplicate"] += 1
+    REPORT.update(stats)
+    REPORT.count("rows_out", len(examples))
+    if kanji_check:
+        print(
+            f"Kanji check: {stats['kanji_check_rejected_readings']}/{stats['kanji_check_readings']} "
+            f"readings rejected, {stats['kanji_check_rejected_blocks']} blocks dropped",
+            flush=True,
+        )
 
     features = Features(
         {
@@ -193,13 +238,33 @@ def process_directory(root_dir, delimiters):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Build examples from the Aozora speech corpus")
+    parser.add_argument(
+        "--kanji-check",
+        action="store_true",
+        help="reject blocks whose single-kanji readings are not in the kanji dictionary",
+    )
+    add_report_arguments(parser)
+    args = parser.parse_args()
     # # unprocessed_dir = "aozora_audio"
     root_dir = "aozora_speech_dataset"
     # # find_and_extract_zips(unprocessed_dir, root_dir)
     delimiters = {"ruby": ("<ruby>", "</ruby>"), "rt": ("<rt>", "</rt>")}
 
-    dataset = process_directory(root_dir, delimiters)
-    dataset.save_to_disk("./aozora_speech_examples")
+    REPORT.start("process_aozora_audio", args)
+    index = ReadingIndex()
+    with REPORT.stage("process_directory"):
+        dataset = process_directory(
+            root_dir,
+            delimiters,
+            index=index,
+            workers=os.cpu_count(),
+            kanji_check=args.kanji_check,
+        )
+    with REPORT.stage("save"):
+        dataset.save_to_disk("./aozora_speech_examples")
+        index.save("./aozora_speech_readings.sqlite")
+    REPORT.save()
     print(dataset["all_data"])
     print(dataset["all_data"][:10])
     # print(process_file("/Users/calvinxu/Projects/ML/FLFL/test.txt", delimiters))
@@ -0,0 +1,195 @@
+import argparse
+import io
+import os
+import re
+import sys
+import zipfile
+from collections import Counter
+from functools import partial
+from datasets import Dataset, DatasetDict, Value, Features
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from reading_index import ReadingIndex, process_files
+from instrument import REPORT, add_report_arguments
+
+# ［＃...］ editor annotations (注記), including the ones describing gaiji after ※
+ANNOTATION_PATTERN = re.compile(r"［＃[^］]*］")
+# ｜親字《よみ》 with an explicit base, or 漢字《よみ》 where the base is the preceding kanji run
+RUBY_TOKEN_PATTERN = re.compile(
+    r"｜(?P<base>[^｜《》]+)《(?P<reading>[^《》]+)》"
+    r"|(?P<kanji>[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff々〆ヶ仝〇]+)《(?P<kanji_reading>[^《》]+)》"
+)
+SENTENCE_PATTERN = re.compile(r"[^。！？]+[。！？]*[」』）]?")
+HEADER_DELIMITER = "-------"
+FOOTER_START = "底本："
+
+
+def iter_text_lines(filepath, encoding="cp932"):
+    """
+    Yields the lines of an Aozora Bunko text, reading .txt members of a zip archive directly.
+
+    Args:
+        filepath (str): Path to a .txt file or a .zip archive.
+        encoding (str): Text encoding; Aozora Bunko distributes Shift_JIS (cp932) files.
+
+    Yields:
+        str: Lines of the body text, without the notation header and the colophon.
+    """
+    if filepath.endswith(".zip"):
+        with zipfile.ZipFile(filepath, "r") as zip_ref:
+            for member in zip_ref.namelist():
+                if member.endswith(".txt"):
+                    with zip_ref.open(member) as raw:
+                        text = io.TextIOWrapper(raw, encoding=encoding, errors="replace")
+                        yield from iter_body_lines(text)
+    else:
+        with open(filepath, "r", encoding=encoding, errors="replace") as file:
+            yield from iter_body_lines(file)
+
+
+def iter_body_lines(lines):
+    in_header = False
+    for line in lines:
+        if line.startswith(HEADER_DELIMITER):
+            in_header = not in_header
+            continue
+        if in_header:
+            continue
+        if line.startswith(FOOTER_START):
+            break
+        yield line
+
+
+def parse_ruby(text, delimiters):
+    """
+    Converts Aozora Bunko ruby notation into the delimiter format of the other data sources.
+
+    Args:
+        text (str): A sentence in Aozora Bunko notation, with annotations already removed.
+        delimiters (dict): A dictionary containing delimiter configurations.
+
+    Returns:
+        tuple: The plain sentence, the annotated sentence, and the sentence with ruby
+        bases replaced by their readings.
+    """
+    plain, output, reading = [], [], []
+    position = 0
+    for match in RUBY_TOKEN_PATTERN.finditer(text):
+        before = text[position : match.start()].replace("｜", "")
+        base = match.group("base") or match.group("kanji")
+        ruby = match.group("reading") or match.group("kanji_reading")
+        plain += [before, base]
+        output += [
+            before,
+            f"{delimiters['ruby'][0]}{base}{delimiters['rt'][0]}{ruby}{delimiters['rt'][1]}{delimiters['ruby'][1]}",
+        ]
+        reading += [before, ruby]
+        position = match.end()
+    rest = text[position:].replace("｜", "")
+    plain.append(rest)
+    output.append(rest)
+    reading.append(rest)
+    return "".join(plain), "".join(output), "".join(reading)
+
+
+def process_file(filepath, delimiters, encoding="cp932", stats=None):
+    """
+    Processes a single raw Aozora Bunko text and returns a list of examples.
+
+    Args:
+        filepath (str): The path to the .txt or .zip file to be processed.
+        delimiters (dict): A dictionary containing delimiter configurations.
+        encoding (str): Text encoding of the file.
+        stats (Counter): If given, rows read and rejected (by reason) are counted in it.
+
+    Returns:
+        list: A list of examples, where each example is a dictionary containing the input
+        sentence, output sentence, and reference reading (only ruby spans are read).
+    """
+    if stats is None:
+        stats = Counter()
+    examples = []
+    for line in iter_text_lines(filepath, encoding):
+        line = ANNOTATION_PATTERN.sub("", line).strip()
+        if "《" not in line:
+            continue
+        for sentence in SENTENCE_PATTERN.findall(line):
+            sentence = sentence.strip().lstrip("　")
+            if "《" not in sentence:
+                continue
+            stats["rows_read"] += 1
+            # ※ marks gaiji whose description was in the removed annotation
+            if "※" in sentence:
+                stats["rejected_gaiji"] += 1
+                continue
+            text, output, reading = parse_ruby(sentence, delimiters)
+            if delimiters["ruby"][0] not in output or "《" in text or "》" in text:
+                stats["rejected_unparsed_ruby"] += 1
+                continue
+            examples.append({"input": text, "output": output, "ref_reading": reading})
+    return examples
+
+
+def process_directory(root_dir, delimiters, index=None, workers=1):
+    """
+    Walks through the directory, processes all .txt and .zip files, and adds the examples to a HuggingFace dataset.
+
+    Args:
+        root_dir (str): The root directory to start the walk.
+        delimiters (dict): A dictionary containing delimiter configurations.
+        index (ReadingIndex): If given, the readings of all examples are merged into it.
+        workers (int): Number of worker processes to parse files with.
+
+    Returns:
+        DatasetDict: A HuggingFace dataset containing all processed examples.
+    """
+    examples = []
+    filepaths = [
+        os.path.join(dirpath, filename)
+        for dirpath, _, filenames in os.walk(root_dir)
+        for filename in filenames
+        if filename.endswith(".txt") or filename.endswith(".zip")
+    ]
+    worker = partial(process_file, delimiters=delimiters)
+    for file_examples, file_stats in process_files(worker, filepaths, root_dir, index, workers):
+        REPORT.update(file_stats)
+        REPORT.count("files_processed")
+        examples.extend(file_examples)
+    REPORT.count("rows_out", len(examples))
+
+    features = Features(
+        {
+            "input": Value("string"),
+            "output": Value("string"),
+            "ref_reading": Value("string"),
+            "file_path": Value("string"),
+        }
+    )
+
+    dataset_dict = {k: [d[k] for d in examples] for k in features}
+    dataset = Dataset.from_dict(dataset_dict, features=features)
+    return DatasetDict({"all_data": dataset})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build examples from raw Aozora zip archives")
+    add_report_arguments(parser)
+    args = parser.parse_args()
+
+    root_directory = "aozora_raw"
+    delimiters = {"ruby": ("<ruby>", "</ruby>"), "rt": ("<rt>", "</rt>")}
+    REPORT.start("process_aozora_raw", args)
+    index = ReadingIndex()
+    with REPORT.stage("process_directory"):
+        dataset = process_directory(
+            root_directory, delimiters, index=index, workers=os.cpu_count()
+        )
+    with REPORT.stage("save"):
+        dataset.save_to_disk("./aozora_raw_examples")
+        index.save("./aozora_raw_readings.sqlite")
+    REPORT.save()
+    print(dataset["all_data"])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
+import argparse
 import re
 import os
+import sys
+from collections import Counter
 from datasets import Dataset, DatasetDict, Value, Features
 import string
 import jaconv
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from instrument import REPORT, add_report_arguments
 # converter = KyujitaiConverter()
 
 
@@ -69,7 +75,11 @@ def condensed(text):
 
 
 def process_file(
-    filepath, delimiter_config, validate_sentence=False, validate_reading=False
+    filepath,
+    delimiter_config,
+    validate_sentence=False,
+    validate_reading=False,
+    stats=None,
 ):
     """
     Processes a single file and returns a list of examples.
@@ -77,10 +87,13 @@ def process_file(
     Args:
         filepath (str): The path to the file to be processed.
         delimiter_config (dict): A dictionary containing delimiter configurations.
+        stats (Counter): If given, rows read and rejected (by reason) are counted in it.
 
     Returns:
         list: A list of examples, where each example is a dictionary containing the input sentence, output sentence, and reference reading.
     """
+    if stats is None:
+        stats = Counter()
     examples = []
     with open(filepath, "r", encoding="utf-8") as file:
         sentence, reading, segments = "", "", []
@@ -88,6 +101,7 @@ def process_file(
         for line in file:
             if "行番号" in line:
                 if segments:  # reached new example; process the previous one
+                    stats["rows_read"] += 1
                     formatted_output = "".join(segments)
                     _sentence_validation = condensed(sentence_validation)
                     reading_validation = katakana_to_hiragana(
@@ -100,11 +114,15 @@ def process_file(
                         or (_sentence != _sentence_validation and validate_sentence)
                         or (_reading != reading_validation and validate_reading)
                     ):
+                        if "<ruby>" not in formatted_output:
+                            stats["rejected_no_ruby"] += 1
                         if _sentence != _sentence_validation and validate_sentence:
+                            stats["rejected_sentence_mismatch"] += 1
                             print(
                                 f"Error 1: {_sentence} != {_sentence_validation}, file: {filepath}"
                             )
                         if _reading != reading_validation and validate_reading:
+                            stats["rejected_reading_mismatch"] += 1
                             print(
                                 f"Error 2: {_reading} != {reading_validation}, file: {filepath}"
                             )
@@ -130,6 +148,8 @@ def process_file(
                 reading_validation += line.split("\t")[1]
 
         # Process the last example in the file
+        if segments:
+            stats["rows_read"] += 1
         formatted_output = "".join(segments).strip()
         if (
             "<ruby>" not in formatted_output
@@ -166,9 +186,15 @@ def process_directory(
         for filename in [f for f in filenames if f.endswith(".txt")]:
             filepath = os.path.join(dirpath, filename)
             # can parallelize this, but it's not that slow
+            file_stats = Counter()
             file_examples = process_file(
-                filepath, delimiters, validate_sentence, validate_reading
+                filepath,
+                delimiters,
+                validate_sentence,
+                validate_reading,
+                stats=file_stats,
             )
+            REPORT.update(file_stats)
             for example in file_examples:
                 example["file_path"] = os.path.relpath(
                     filepath, start=root_dir
@@ -177,6 +203,8 @@ def process_directory(
             n_file_processed += 1
             print(f"Processed {n_file_processed} files", flush=True)
     print(f"Processed {n_file_processed} files", flush=True)
+    REPORT.count("files_processed", n_file_processed)
+    REPORT.count("rows_out", len(examples))
 
     features = Features(
         {
@@ -193,13 +221,21 @@ def process_directory(
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Build examples from the shosi corpus")
+    add_report_arguments(parser)
+    args = parser.parse_args()
+
     root_directory = "shosi_dataset"
     delimiters = {"ruby": ("<ruby>", "</ruby>"), "rt": ("<rt>", "</rt>")}
+    REPORT.start("process_shosi", args)
     print(list(os.walk(root_directory)))
-    dataset = process_directory(
-        root_directory, delimiters, validate_sentence=False, validate_reading=True
-    )
-    dataset.save_to_disk("./shosi_examples")
+    with REPORT.stage("process_directory"):
+        dataset = process_directory(
+            root_directory, delimiters, validate_sentence=False, validate_reading=True
+        )
+    with REPORT.stage("save"):
+        dataset.save_to_disk("./shosi_examples")
+    REPORT.save()
 
 
 if __name__ == "__main__":
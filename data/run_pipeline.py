@@ -0,0 +1,187 @@
+import argparse
+import os
+import random
+import sys
+from datasets import load_from_disk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import kanji_dict
+import reading_index
+from reading_index import ReadingIndex, ReadingLookup
+from instrument import REPORT
+
+import build_jsonl
+import process_aozora
+import process_aozora_audio
+import process_aozora_raw
+import process_shosi
+import pretokenize
+from pipeline import Pipeline
+
+DELIMITERS = {"ruby": ("<ruby>", "</ruby>"), "rt": ("<rt>", "</rt>")}
+
+
+def save_dataset(dataset, index, output_dir):
+    dataset.save_to_disk(os.path.join(output_dir, "dataset"))
+    if index is not None:
+        index.save(os.path.join(output_dir, "readings.sqlite"))
+    return {"rows_out": len(dataset["all_data"])}
+
+
+def aozora(inputs, output_dir, delimiters):
+    index = ReadingIndex()
+    dataset = process_aozora.process_directory(
+        inputs["aozora_dataset"],
+        delimiters,
+        validate_sentence=True,
+        validate_reading=True,
+        index=index,
+        workers=os.cpu_count(),
+    )
+    return save_dataset(dataset, index, output_dir)
+
+
+def aozora_raw(inputs, output_dir, delimiters):
+    index = ReadingIndex()
+    dataset = process_aozora_raw.process_directory(
+        inputs["aozora_raw"], delimiters, index=index, workers=os.cpu_count()
+    )
+    return save_dataset(dataset, index, output_dir)
+
+
+def shosi(inputs, output_dir, delimiters):
+    dataset = process_shosi.process_directory(
+        inputs["shosi_dataset"],
+        delimiters,
+        validate_sentence=False,
+        validate_reading=True,
+    )
+    return save_dataset(dataset, None, output_dir)
+
+
+def aozora_speech(inputs, output_dir, delimiters, kanji_check):
+    if kanji_check:
+        # the key covers the JSON, so build the map from it rather than load a
+        # kanji_readings.pkl that may predate it
+        kanji_dict.KANJI_READINGS.rebuild()
+    index = ReadingIndex()
+    dataset = process_aozora_audio.process_directory(
+        inputs["aozora_speech_dataset"],
+        delimiters,
+        index=index,
+        workers=os.cpu_count(),
+        kanji_check=kanji_check,
+    )
+    return save_dataset(dataset, index, output_dir)
+
+
+def aozora_speech_jsonl(
+    inputs, output_dir, text_replacements, length_percentiles, plausibility_filter, seed
+):
+    random.seed(seed)
+    stage_dir = inputs["aozora_speech"]
+    dataset = load_from_disk(os.path.join(stage_dir, "dataset"))["all_data"]
+    filtered_dataset = build_jsonl.filter_by_length(dataset, *length_percentiles)
+    reading_lookup = (
+        ReadingLookup(os.path.join(stage_dir, "readings.sqlite"))
+        if plausibility_filter
+        else None
+    )
+    rows_out = build_jsonl.dataset_to_jsonl_filter(
+        filtered_dataset,
+        os.path.join(output_dir, "aozora_speech.jsonl"),
+        text_replacements,
+        reading_lookup,
+    )
+    return {"rows_in": len(dataset), "rows_out": rows_out}
+
+
+def aozora_speech_tokens(inputs, output_dir, tokenizer, context_length):
+    stats = pretokenize.pretokenize(
+        [os.path.join(inputs["aozora_speech_jsonl"], "aozora_speech.jsonl")],
+        output_dir,
+        tokenizer,
+        context_length,
+        workers=os.cpu_count(),
+    )
+    return {
+        "rows_in": stats["examples"],
+        "rows_out": stats["examples"] - stats["too_long"],
+        "packing_efficiency": stats["packing_efficiency"],
+    }
+
+
+def build_pipeline(kanji_check=False):
+    """
+    Registers the stages in dependency order. kanji_check is opt-in, as in
+    process_aozora_audio, and part of the aozora_speech key either way.
+    """
+    pipeline = Pipeline(report=REPORT)
+    pipeline.stage(
+        "aozora",
+        inputs=["aozora_dataset"],
+        params={"delimiters": DELIMITERS},
+        code=[process_aozora, reading_index],
+    )(aozora)
+    pipeline.stage(
+        "aozora_raw",
+        inputs=["aozora_raw"],
+        params={"delimiters": DELIMITERS},
+        code=[process_aozora_raw, reading_index],
+    )(aozora_raw)
+    pipeline.stage(
+        "shosi",
+        inputs=["shosi_dataset"],
+        params={"delimiters": DELIMITERS},
+        code=[process_shosi],
+    )(shosi)
+    pipeline.stage(
+        "aozora_speech",
+        inputs=["aozora_speech_dataset"] + ([kanji_dict.KANJI_JSON_PATH] if kanji_check else []),
+        params={"delimiters": DELIMITERS, "kanji_check": kanji_check},
+        code=[process_aozora_audio, reading_index, kanji_dict],
+    )(aozora_speech)
+    pipeline.stage(
+        "aozora_speech_jsonl",
+        inputs=["aozora_speech"],
+        params={
+            "text_replacements": build_jsonl.TEXT_REPLACEMENTS
+            | build_jsonl.hito_template(["ひと", "にん", "じん", "ぴと", "びと"]),
+            "length_percentiles": [5, 95],
+            "plausibility_filter": True,
+            "seed": 0,
+        },
+        code=[build_jsonl, reading_index],
+    )(aozora_speech_jsonl)
+    pipeline.stage(
+        "aozora_speech_tokens",
+        inputs=["aozora_speech_jsonl"],
+        params={"tokenizer": "stockmark/gpt-neox-japanese-1.4b", "context_length": 2048},
+        code=[pretokenize],
+    )(aozora_speech_tokens)
+    return pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the cached data pipeline")
+    parser.add_argument(
+        "targets", nargs="*", default=["aozora_speech_jsonl"], help="stages to produce"
+    )
+    parser.add_argument(
+        "--force", nargs="*", default=[], help="stages to re-run even if cached"
+    )
+    parser.add_argument(
+        "--kanji-check",
+        action="store_true",
+        help="reject speech blocks whose kanji readings are not in the kanji dictionary",
+    )
+    args = parser.parse_args()
+
+    pipeline = build_pipeline(kanji_check=args.kanji_check)
+    pipeline.run(args.targets, force=args.force)
+    for name in args.targets:
+        print(f"{name}: {pipeline.output_dir(name)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HARNESS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eval_harness.py")
+COLUMNS = [
+    "load_time",
+    "load_peak_rss_mb",
+    "peak_rss_mb",
+    "tokens_per_second",
+    "sentences_per_second",
+    "reading_accuracy",
+    "exact_match",
+]
+
+
+def run_harness(model, options):
+    """
+    Runs eval_harness.py in a fresh process, so load time and peak memory are its own.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report_path = os.path.join(tmp_dir, "report.json")
+        subprocess.run(
+            [sys.executable, HARNESS, model, "--report", report_path] + options,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        with open(report_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare fp32 and int8 CPU inference (load time, memory, speed)",
+        epilog="Other options are passed on to eval_harness.py, e.g. --limit 200.",
+    )
+    parser.add_argument("model", help="checkpoint path, or tiny-random")
+    parser.add_argument(
+        "--quantized-cache",
+        help="also measure saving an int8 model and loading it back, under this directory",
+    )
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--interop-threads", type=int)
+    args, harness_options = parser.parse_known_args()
+
+    harness_options += ["--device", "cpu"]
+    for option in ("threads", "interop_threads"):
+        if getattr(args, option) is not None:
+            harness_options += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+    runs = {
+        "fp32": harness_options,
+        "int8": harness_options + ["--quantize"],
+    }
+    cache_dir = None
+    if args.quantized_cache and args.model != "tiny-random":
+        # a fresh directory, so the first run quantizes and saves and the second loads
+        os.makedirs(args.quantized_cache, exist_ok=True)
+        cache_dir = tempfile.mkdtemp(prefix="cpu_benchmark_", dir=args.quantized_cache)
+        cached = harness_options + ["--quantize", "--quantized-cache", cache_dir]
+        runs["int8 (quantize, save)"] = cached
+        runs["int8 (load saved)"] = cached
+    try:
+        reports = {name: run_harness(args.model, options) for name, options in runs.items()}
+    finally:
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir)
+
+    print(f"{'':24}" + "".join(f"{column:>22}" for column in COLUMNS))
+    for name, report in reports.items():
+        cells = [report.get(column) for column in COLUMNS]
+        print(
+            f"{name:24}"
+            + "".join(
+                f"{cell:>22.3f}" if isinstance(cell, float) else f"{str(cell):>22}"
+                for cell in cells
+            )
+        )
+    baseline = reports["fp32"]
+    for name, report in reports.items():
+        if name != "fp32" and report["tokens_per_second"] and baseline["tokens_per_second"]:
+            print(
+                f"{name}: {report['tokens_per_second'] / baseline['tokens_per_second']:.2f}x "
+                f"tokens/s, {report['load_time'] / baseline['load_time']:.2f}x load time"
+            )
+
+
+if __name__ == "__main__":
+    main()
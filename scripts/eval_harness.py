@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from cli import add_annotator_arguments, annotator_from_args
+from instrument import peak_rss_mb, percentiles
+from ruby import parse_ruby
+
+SAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eval_sample.jsonl")
+
+
+def load_examples(path, limit=None):
+    """
+    Reads input/output pairs from JSONL as written by data/build_jsonl.py.
+    """
+    examples = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if limit is not None and len(examples) >= limit:
+                break
+            row = json.loads(line)
+            examples.append((row["input"], row["output"]))
+    return examples
+
+
+def score(sentence: str, reference: str, prediction: str) -> Counter:
+    """
+    Counts for one example: exact match, whether the markup is well formed and keeps
+    the input as its base text, and reference spans whose base and reading are matched.
+    """
+    counts = Counter(examples=1, exact_match=int(prediction == reference))
+    _, reference_spans = parse_ruby(reference)
+    counts["reference_spans"] += len(reference_spans)
+    try:
+        base_text, predicted_spans = parse_ruby(prediction)
+    except ValueError:
+        counts["malformed"] += 1
+        return counts
+    counts["base_text_match"] += int(base_text == sentence)
+    counts["predicted_spans"] += len(predicted_spans)
+    counts["correct_spans"] += len(set(reference_spans) & set(predicted_spans))
+    # right place, wrong reading, e.g. 今日 read as こんにち instead of きょう
+    predicted = {(span.offset, span.base) for span in predicted_spans}
+    counts["aligned_spans"] += sum(
+        (span.offset, span.base) in predicted for span in reference_spans
+    )
+    return counts
+
+
+def evaluate(annotator, examples, request_size=32):
+    """
+    Annotates examples in requests of request_size sentences and reports quality
+    and speed. Latency is the wall time of each request.
+    """
+    import torch
+
+    counts, latencies, predictions = Counter(), [], []
+    generated_tokens = 0
+    start = time.perf_counter()
+    for i in range(0, len(examples), request_size):
+        sentences = [sentence for sentence, _ in examples[i : i + request_size]]
+        request_start = time.perf_counter()
+        outputs = annotator.annotate(sentences)
+        latencies.append((time.perf_counter() - request_start) * 1000)
+        generated_tokens += sum(
+            len(ids)
+            for ids in annotator.tokenizer(outputs, add_special_tokens=False)["input_ids"]
+        )
+        predictions.extend(outputs)
+    wall_time = time.perf_counter() - start
+    stats = annotator.stats
+    for (sentence, reference), prediction in zip(examples, predictions):
+        counts.update(score(sentence, reference, prediction))
+
+    def ratio(numerator, denominator):
+        return counts[numerator] / counts[denominator] if counts[denominator] else None
+
+    report = {
+        "examples": counts["examples"],
+        "reading_accuracy": ratio("correct_spans", "reference_spans"),
+        "span_precision": ratio("correct_spans", "predicted_spans"),
+        "span_alignment": ratio("aligned_spans", "reference_spans"),
+        "exact_match": ratio("exact_match", "examples"),
+        "base_text_fidelity": ratio("base_text_match", "examples"),
+        "malformed": ratio("malformed", "examples"),
+        "wall_time": wall_time,
+        "sentences_per_second": len(examples) / wall_time if wall_time else None,
+        "tokens_per_second": generated_tokens / wall_time if wall_time else None,
+        "generated_tokens": generated_tokens,
+        "request_size": request_size,
+        "request_latency_ms": percentiles(latencies),
+        "peak_rss_mb": peak_rss_mb(),
+        # decode steps are only counted by the batched greedy loop
+        "decode_steps_per_sentence": stats["row_steps"] / len(examples) if examples else None,
+        "wasted_steps_per_sentence": stats["wasted_steps"] / len(examples) if examples else None,
+        "decoding_stats": dict(annotator.stats),
+    }
+    if torch.cuda.is_available():
+        report["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / (1 << 20)
+    return report, predictions
+
+
+def check_thresholds(report, thresholds):
+    """
+    Returns the failed METRIC=MIN thresholds, e.g. base_text_fidelity=0.99.
+    """
+    failed = []
+    for threshold in thresholds:
+        metric, minimum = threshold.split("=")
+        if report.get(metric) is None or report[metric] < float(minimum):
+            failed.append(f"{metric} = {report.get(metric)} < {minimum}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate annotation quality and speed")
+    add_annotator_arguments(parser)
+    parser.add_argument("--data", default=SAMPLE_PATH, help="input/output JSONL")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--request-size", type=int, default=32)
+    parser.add_argument("--report", help="write the report as JSON")
+    parser.add_argument("--predictions", help="write input/output/prediction JSONL")
+    parser.add_argument(
+        "--lexicon",
+        help="reading index (reading_index.py) to route unambiguous sentences around the "
+        "model; the report compares against the model alone",
+    )
+    parser.add_argument(
+        "--window", type=int, help="with --lexicon, send only this much context to the model"
+    )
+    parser.add_argument(
+        "--min",
+        action="append",
+        default=[],
+        metavar="METRIC=VALUE",
+        help="exit with an error if a metric is below VALUE (repeatable)",
+    )
+    args = parser.parse_args()
+    if args.lexicon and args.cache:
+        parser.error("--lexicon runs the eval set twice, which --cache would distort")
+
+    examples = load_examples(args.data, args.limit)
+    load_start = time.perf_counter()
+    annotator = annotator_from_args(args)
+    load_time = time.perf_counter() - load_start
+    load_peak_rss_mb = peak_rss_mb()
+    if args.lexicon:
+        from reading_index import ReadingLookup
+        from router import Router
+
+        baseline, _ = evaluate(annotator, examples, args.request_size)
+        annotator.stats.clear()
+        router = Router(annotator, ReadingLookup(args.lexicon), window=args.window)
+        report, predictions = evaluate(router, examples, args.request_size)
+        report["routing"] = router.metrics()
+        report["speedup"] = baseline["wall_time"] / report["wall_time"]
+        report["baseline"] = {
+            metric: baseline[metric]
+            for metric in ("wall_time", "reading_accuracy", "exact_match", "base_text_fidelity")
+        }
+    else:
+        report, predictions = evaluate(annotator, examples, args.request_size)
+    report = {
+        "model": args.model,
+        "data": args.data,
+        "quantize": args.quantize,
+        "threads": args.threads,
+        "load_time": load_time,
+        "load_peak_rss_mb": load_peak_rss_mb,
+    } | report
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    if args.predictions:
+        with open(args.predictions, "w", encoding="utf-8") as file:
+            for (sentence, reference), prediction in zip(examples, predictions):
+                row = {"input": sentence, "output": reference, "prediction": prediction}
+                file.write(json.dumps(row, ensure_ascii=False) + "\n")
+    failed = check_thresholds(report, args.min)
+    for failure in failed:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
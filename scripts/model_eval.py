@@ -1,14 +1,15 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel, AutoPeftModelForCausalLM
-import torch
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from inference import Annotator, load_model
 
 # model_name = "stockmark/gpt-neox-japanese-1.4b"
 # adapter = "../Finetunes/checkpoint-8000"
 
 model_name = "../Finetunes/FLFL"
 
-flfl = AutoModelForCausalLM.from_pretrained(model_name)
-tokenizer = AutoTokenizer.from_pretrained(model_name)
+flfl, tokenizer = load_model(model_name)
 
 # ft_model = PeftModel.from_pretrained(base_model, adapter)
 
@@ -16,8 +17,6 @@ tokenizer = AutoTokenizer.from_pretrained(model_name)
 
 # tokenizer = AutoTokenizer.from_pretrained(adapter)
 
-prompt_template = """[INST] {instruction}\n{input}\n[/INST]\n"""
-
 test_sentences = [
     "国境の長いトンネルを抜けると雪国であった",
     "鰤の照り焼き、八宝菜、ハンバーグ。",
@@ -29,23 +28,13 @@ test_sentences = [
     "時間の澱の中に沈殿していたようだ。",
 ]
 
-prompts = [
-    prompt_template.format(
-        instruction="次の文に正確に振り仮名を付けてください", input=sentence
-    )
-    for sentence in test_sentences
-]
-
 # merged = ft_model.merge_and_unload()
 # merged.save_pretrained("FLFL")
 
 # tokenizer.save_pretrained("FLFL")
 
 for model in [flfl]:
-    for prompt in prompts:
-        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-        with torch.no_grad():
-            tokens = model.generate(**inputs, max_new_tokens=512, do_sample=False)
-
-        output = tokenizer.decode(tokens[0], skip_special_tokens=False)
+    annotator = Annotator(model, tokenizer, max_new_tokens=512, prefix_cache=True)
+    for sentence, output in zip(test_sentences, annotator.annotate(test_sentences)):
+        print(sentence)
         print(output)
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from cli import add_annotator_arguments
+from eval_harness import SAMPLE_PATH, load_examples
+from worker_pool import WorkerPool, available_cores
+
+COLUMNS = ["replicas", "threads", "sentences_per_second", "speedup", "load_time", "pss_mb"]
+# per replica, in the JSON lines and the report
+MEMORY_COLUMNS = ["rss_mb", "pss_mb", "private_dirty_mb"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure sentences/s of the worker pool for several replica counts"
+    )
+    add_annotator_arguments(parser)
+    parser.add_argument("--replicas", type=int, nargs="+", help="default: 1, 2, 4, ... cores")
+    parser.add_argument("--data", default=SAMPLE_PATH, help="input/output JSONL")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--repeat", type=int, default=1, help="annotate the data this often")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--copy-weights",
+        action="store_true",
+        help="load a copy of the weights per replica instead of mapping them once, to compare",
+    )
+    parser.add_argument("--report", help="write the results as JSON")
+    args = parser.parse_args()
+
+    cores = available_cores()
+    counts = args.replicas or [
+        2**i for i in range(len(cores).bit_length()) if 2**i <= len(cores)
+    ]
+    sentences = [sentence for sentence, _ in load_examples(args.data, args.limit)] * args.repeat
+    rows = []
+    for replicas in counts:
+        with WorkerPool(args, replicas, cores, shared_weights=not args.copy_weights) as pool:
+            pool.annotate(sentences[: args.batch_size * replicas], args.batch_size)  # warm up
+            start = time.perf_counter()
+            pool.annotate(sentences, args.batch_size)
+            wall_time = time.perf_counter() - start
+            stats = list(pool.replica_stats.values())
+        rows.append(
+            {
+                "replicas": replicas,
+                "threads": [len(stat["cores"]) for stat in stats],
+                "sentences_per_second": len(sentences) / wall_time,
+                "load_time": max(stat["load_time"] for stat in stats),
+                # pages mapped by several replicas (the weights, shared libraries) count
+                # once in the sum of pss, and not at all in private_dirty
+                "pss_mb": sum(stat.get("pss", 0) for stat in stats),
+                "replica_memory": [
+                    {column: stat.get(column[: -len("_mb")]) for column in MEMORY_COLUMNS}
+                    for stat in stats
+                ],
+                "replica_stats": stats,
+            }
+        )
+        rows[-1]["speedup"] = rows[-1]["sentences_per_second"] / rows[0]["sentences_per_second"]
+        line = {column: rows[-1][column] for column in COLUMNS}
+        print(json.dumps(line | {"replica_memory": rows[-1]["replica_memory"]}), flush=True)
+
+    print(f"{'':4}" + "".join(f"{column:>22}" for column in COLUMNS))
+    for row in rows:
+        cells = [row[column] for column in COLUMNS]
+        print(
+            f"{'':4}"
+            + "".join(
+                f"{cell:>22.3f}" if isinstance(cell, float) else f"{str(cell):>22}"
+                for cell in cells
+            )
+        )
+    header = ["replicas", "replica"] + MEMORY_COLUMNS
+    print(f"\n{'':4}" + "".join(f"{column:>22}" for column in header))
+    for row in rows:
+        for replica, memory in enumerate(row["replica_memory"]):
+            cells = [memory[column] or 0.0 for column in MEMORY_COLUMNS]
+            print(
+                f"{'':4}{row['replicas']:>22}{replica:>22}"
+                + "".join(f"{cell:>22.1f}" for cell in cells)
+            )
+    best = max(rows, key=lambda row: row["sentences_per_second"])
+    print(f"best on this host: {best['replicas']} replicas")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "model": args.model,
+                    "cores": cores,
+                    "shared_weights": not args.copy_weights,
+                    "sentences": len(sentences),
+                    "runs": rows,
+                },
+                file,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+
+
+def normalize_sentence(sentence: str) -> str:
+    # only changes that do not alter what the annotation has to copy
+    return unicodedata.normalize("NFC", sentence).strip()
+
+
+def cache_namespace(identity: dict) -> str:
+    """
+    Hashes a model/adapter/decoding description into a short key prefix.
+    """
+    data = json.dumps(identity, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]
+
+
+class AnnotationCache:
+    """
+    Sentence -> annotation cache: an in-memory LRU in front of a SQLite file.
+
+    Entries are keyed by (namespace, sentence), where the namespace identifies the
+    model and decoding settings (see cache_namespace), so one file can serve several
+    configurations. Once the stored annotations exceed max_bytes, the least recently
+    used entries are evicted down to 90% of it. Last-use times of hits are
+    written back with the next batch rather than on every lookup.
+    """
+
+    def __init__(self, path: str, memory_size=65536, max_bytes=1 << 30):
+        self.path = path
+        self.memory_size = memory_size
+        self.max_bytes = max_bytes
+        self.memory: OrderedDict = OrderedDict()
+        self.stats = Counter()
+        self.touched: Dict[tuple, float] = {}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS annotations (namespace TEXT NOT NULL, "
+            "sentence TEXT NOT NULL, output TEXT NOT NULL, size INTEGER NOT NULL, "
+            "last_used REAL NOT NULL, PRIMARY KEY (namespace, sentence)) WITHOUT ROWID"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS annotations_last_used ON annotations (last_used)"
+        )
+        self.size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM annotations"
+        ).fetchone()[0]
+
+    def remember(self, key: tuple, output: str):
+        self.memory[key] = output
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get_many(self, namespace: str, sentences: List[str]) -> Dict[str, str]:
+        """
+        Returns {sentence: annotation} for the sentences that are cached.
+        """
+        found = {}
+        missing = []
+        now = time.time()
+        for sentence in dict.fromkeys(sentences):
+            key = (namespace, sentence)
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[sentence] = self.memory[key]
+                self.touched[key] = now
+                self.stats["memory_hits"] += 1
+            else:
+                missing.append(sentence)
+        # stay well below SQLite's limit on query parameters
+        for start in range(0, len(missing), 500):
+            chunk = missing[start : start + 500]
+            rows = self.conn.execute(
+                "SELECT sentence, output FROM annotations WHERE namespace = ? "
+                f"AND sentence IN ({', '.join('?' * len(chunk))})",
+                [namespace] + chunk,
+            ).fetchall()
+            for sentence, output in rows:
+                found[sentence] = output
+                self.remember((namespace, sentence), output)
+                self.touched[(namespace, sentence)] = now
+            self.stats["disk_hits"] += len(rows)
+            self.stats["misses"] += len(chunk) - len(rows)
+        return found
+
+    def put_many(self, namespace: str, annotations: Dict[str, str]):
+        now = time.time()
+        rows = []
+        for sentence, output in annotations.items():
+            self.remember((namespace, sentence), output)
+            rows.append((namespace, sentence, output, len(output.encode("utf-8")), now))
+        with self.conn:
+            self.flush_touched()
+            for row in rows:
+                previous = self.conn.execute(
+                    "SELECT size FROM annotations WHERE namespace = ? AND sentence = ?",
+                    row[:2],
+                ).fetchone()
+                self.size += row[3] - (previous[0] if previous else 0)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.stats["stored"] += len(rows)
+            if self.size > self.max_bytes:
+                self.evict(int(self.max_bytes * 0.9))
+
+    def flush_touched(self):
+        if self.touched:
+            self.conn.executemany(
+                "UPDATE annotations SET last_used = ? WHERE namespace = ? AND sentence = ?",
+                [(used, *key) for key, used in self.touched.items()],
+            )
+            self.touched.clear()
+
+    def evict(self, target_bytes: int):
+        rows = self.conn.execute(
+            "SELECT namespace, sentence, size FROM annotations ORDER BY last_used"
+        )
+        evicted = []
+        for namespace, sentence, size in rows:
+            if self.size <= target_bytes:
+                break
+            evicted.append((namespace, sentence))
+            self.size -= size
+        rows.close()
+        self.conn.executemany(
+            "DELETE FROM annotations WHERE namespace = ? AND sentence = ?", evicted
+        )
+        for key in evicted:
+            self.memory.pop(key, None)
+        self.stats["evicted"] += len(evicted)
+
+    def hit_rate(self) -> Optional[float]:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        lookups = hits + self.stats["misses"]
+        return hits / lookups if lookups else None
+
+    def metrics(self) -> dict:
+        return {
+            "hit_rate": self.hit_rate(),
+            "memory_entries": len(self.memory),
+            "disk_bytes": self.size,
+            **self.stats,
+        }
+
+    def close(self):
+        with self.conn:
+            self.flush_touched()
+        self.conn.close()
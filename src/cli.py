@@ -0,0 +1,74 @@
+# kept free of torch/transformers imports so --help and argument errors are instant
+
+
+def add_annotator_arguments(parser):
+    """
+    Adds the model, decoding, cache and CPU options shared by the command line tools.
+    """
+    parser.add_argument("model", help="checkpoint path, or tiny-random for a test model")
+    parser.add_argument("--device")
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--max-batch-tokens", type=int, default=16384)
+    parser.add_argument(
+        "--decoding", default="greedy", choices=["greedy", "prompt_lookup", "constrained"]
+    )
+    parser.add_argument("--prefix-cache", action="store_true")
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="repair broken markup; decode what cannot be repaired again, constrained",
+    )
+    parser.add_argument("--cache", help="SQLite file for the annotation cache")
+    parser.add_argument("--cache-max-mb", type=int, default=1024)
+    parser.add_argument("--model-id", help="model name used in cache keys")
+    parser.add_argument(
+        "--quantize", action="store_true", help="dynamic int8 linear layers (CPU)"
+    )
+    parser.add_argument(
+        "--quantized-cache", help="directory to keep quantized models in between runs"
+    )
+    parser.add_argument(
+        "--shared-weights",
+        action="store_true",
+        help="map the safetensors weights instead of copying them, so processes share them",
+    )
+    parser.add_argument("--threads", type=int, help="intra-op threads")
+    parser.add_argument("--interop-threads", type=int, help="inter-op threads")
+
+
+def annotator_from_args(args):
+    from annotation_cache import AnnotationCache
+    from inference import (
+        Annotator,
+        configure_threads,
+        load_model,
+        quantize_dynamic,
+        tiny_random_model,
+    )
+
+    configure_threads(args.threads, args.interop_threads)
+    if args.model == "tiny-random":
+        model, tokenizer = tiny_random_model()
+        if args.quantize:
+            model = quantize_dynamic(model)
+    else:
+        model, tokenizer = load_model(
+            args.model,
+            args.device,
+            args.quantize,
+            args.quantized_cache,
+            shared_weights=args.shared_weights,
+        )
+    return Annotator(
+        model,
+        tokenizer,
+        max_new_tokens=args.max_new_tokens,
+        max_batch_tokens=args.max_batch_tokens,
+        prefix_cache=args.prefix_cache,
+        decoding=args.decoding,
+        validate=args.validate,
+        cache=AnnotationCache(args.cache, max_bytes=args.cache_max_mb << 20)
+        if args.cache
+        else None,
+        model_id=args.model_id,
+    )
@@ -0,0 +1,453 @@
+from collections import Counter
+from typing import Callable, Iterator, List, Optional, Sequence
+import torch
+from transformers import DynamicCache, StoppingCriteria
+from transformers.generation.streamers import BaseStreamer
+from ruby import CopyState, RubyStreamParser, Span, covers_sentence
+
+RUBY_TAGS = ["<ruby>", "<rt>", "</rt>", "</ruby>", "</rt></ruby>"]
+
+
+def find_draft(
+    tokens: Sequence[int],
+    corpus: List[Sequence[int]],
+    num_draft_tokens: int,
+    max_ngram: int = 3,
+) -> List[int]:
+    """
+    Proposes draft tokens by matching the last n tokens against the corpus.
+
+    The longest n-gram (up to max_ngram) that occurs in a corpus sequence wins,
+    and the tokens that followed it there are the draft.
+
+    Args:
+        tokens (list): The sequence generated so far, including the prompt.
+        corpus (list): Token sequences to look up in, e.g. the input sentence and ruby tags.
+        num_draft_tokens (int): Maximum number of draft tokens.
+        max_ngram (int): Longest suffix of tokens to match.
+
+    Returns:
+        list: Up to num_draft_tokens draft tokens, empty if nothing matched.
+    """
+    for n in range(min(max_ngram, len(tokens)), 0, -1):
+        pattern = list(tokens[-n:])
+        for sequence in corpus:
+            # later occurrences are usually the better continuation
+            for start in range(len(sequence) - n - 1, -1, -1):
+                if sequence[start] == pattern[0] and list(sequence[start : start + n]) == pattern:
+                    draft = list(sequence[start + n : start + n + num_draft_tokens])
+                    if draft:
+                        return draft
+    return []
+
+
+class RubyStoppingCriteria(StoppingCriteria):
+    """
+    Stops each row of a batch once the base text of its output is the whole input
+    sentence (see ruby.covers_sentence), for use with model.generate.
+    """
+
+    def __init__(self, tokenizer, sentences: List[str], prompt_length: int):
+        self.tokenizer = tokenizer
+        self.sentences = sentences
+        self.prompt_length = prompt_length
+        self.done = [False] * len(sentences)
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        for row, sentence in enumerate(self.sentences):
+            if not self.done[row]:
+                text = self.tokenizer.decode(
+                    input_ids[row, self.prompt_length :], skip_special_tokens=True
+                )
+                self.done[row] = covers_sentence(sentence, text)
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+
+class BudgetStoppingCriteria(StoppingCriteria):
+    """
+    Stops each row of a batch once it has generated its own budget of new tokens,
+    for use with model.generate, whose max_new_tokens is one budget for the batch.
+    """
+
+    def __init__(self, budgets: List[int], prompt_length: int):
+        self.budgets = torch.tensor(budgets)
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        # with beams (or several sequences per prompt) generate has more rows than prompts
+        budgets = self.budgets.repeat_interleave(input_ids.shape[0] // len(self.budgets))
+        generated = input_ids.shape[1] - self.prompt_length
+        return (generated >= budgets).to(input_ids.device)
+
+
+class SpanStreamer(BaseStreamer):
+    """
+    Streamer for model.generate (batch size 1) that decodes tokens as they arrive and
+    calls on_span(ruby.Span) as soon as a span's </ruby> has been generated.
+
+    Leading whitespace is dropped, as Annotator strips outputs, so offsets are in the
+    input sentence.
+    """
+
+    def __init__(self, tokenizer, on_span: Callable[[Span], None], skip_prompt=True):
+        self.tokenizer = tokenizer
+        self.on_span = on_span
+        self.skip_prompt = skip_prompt
+        self.parser = RubyStreamParser()
+        self.tokens: List[int] = []
+        self.text = ""
+
+    def put(self, value):
+        if self.skip_prompt:  # generate passes the prompt first
+            self.skip_prompt = False
+            return
+        self.tokens.extend(value.reshape(-1).tolist())
+        text = self.tokenizer.decode(self.tokens, skip_special_tokens=True).lstrip()
+        if text.endswith("\ufffd"):  # wait for the rest of a multi-byte character
+            return
+        new_text, self.text = text[len(self.text) :], text
+        for span in self.parser.feed(new_text):
+            self.on_span(span)
+
+    def end(self):
+        pass
+
+
+def greedy_generate_batch(
+    model,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    budgets: List[int],
+    eos_token_id: Optional[int],
+    past_key_values=None,
+    is_complete: Optional[Callable[[int, List[int]], bool]] = None,
+    stop_on_complete: bool = True,
+    stats: Optional[Counter] = None,
+) -> List[List[int]]:
+    """
+    Greedy decoding of a left-padded batch that drops finished rows as it goes.
+
+    A row finishes with eos, after budgets[row] tokens, or, with stop_on_complete,
+    once is_complete(row, tokens) holds. Finished rows are removed from the batch
+    and the cache, so later steps only run the rows still generating. Position ids
+    follow the attention mask as in model.generate, so the output is the same as
+    generate(do_sample=False) cut at the first of these stops.
+
+    With stop_on_complete off, is_complete is still checked to count wasted_steps:
+    tokens other than eos generated after the output was already complete.
+
+    Args:
+        model: A causal LM.
+        input_ids (Tensor): Left-padded prompts, including any cached prefix.
+        attention_mask (Tensor): Their attention mask.
+        budgets (list): Maximum number of new tokens per row.
+        eos_token_id (int): Generation of a row stops after this token.
+        past_key_values (Cache): Optional cache covering a prefix of every row.
+        is_complete (callable): Called with the row index and its tokens so far.
+        stop_on_complete (bool): Whether a complete row stops.
+        stats (Counter): If given, row steps and stop reasons are counted in it.
+
+    Returns:
+        list: The generated token ids of each row, including eos if it was produced.
+    """
+    if stats is None:
+        stats = Counter()
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+    device = input_ids.device
+    position_ids = (attention_mask.long().cumsum(-1) - 1).masked_fill(attention_mask == 0, 0)
+    n_cached = past_key_values.get_seq_length()
+    active = list(range(input_ids.shape[0]))
+    outputs = [[] for _ in active]
+    complete_at = [None] * len(active)
+    with torch.no_grad():
+        logits = model(
+            input_ids=input_ids[:, n_cached:],
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, n_cached:],
+            past_key_values=past_key_values,
+            use_cache=True,
+        ).logits
+        position_ids = position_ids[:, -1:]
+        while True:
+            next_tokens = logits[:, -1].argmax(-1)
+            stats["row_steps"] += len(active)
+            keep = []
+            for i, (row, token) in enumerate(zip(active, next_tokens.tolist())):
+                outputs[row].append(token)
+                if token == eos_token_id:
+                    stats["stopped_eos"] += 1
+                    continue
+                if is_complete is not None and complete_at[row] is None:
+                    if is_complete(row, outputs[row]):
+                        complete_at[row] = len(outputs[row])
+                        if stop_on_complete:
+                            stats["stopped_complete"] += 1
+                            continue
+                if len(outputs[row]) >= budgets[row]:
+                    stats["stopped_budget"] += 1
+                    continue
+                keep.append(i)
+            if not keep:
+                break
+            if len(keep) < len(active):
+                indices = torch.tensor(keep, device=device)
+                past_key_values.batch_select_indices(indices)
+                attention_mask = attention_mask[indices]
+                position_ids = position_ids[indices]
+                next_tokens = next_tokens[indices]
+                stats["dropped_rows"] += len(active) - len(keep)
+                active = [active[i] for i in keep]
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones((len(active), 1))], dim=-1
+            )
+            position_ids = position_ids + 1
+            logits = model(
+                input_ids=next_tokens[:, None],
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+            ).logits
+    for row, output in enumerate(outputs):
+        if complete_at[row] is not None:
+            # an eos right after the sentence is complete is not wasted
+            stats["wasted_steps"] += len(output) - complete_at[row] - (output[-1] == eos_token_id)
+    stats["generated_tokens"] += sum(len(output) for output in outputs)
+    return outputs
+
+
+def prompt_lookup_generate(
+    model,
+    input_ids: List[int],
+    corpus: List[Sequence[int]],
+    max_new_tokens: int,
+    eos_token_id: Optional[int],
+    num_draft_tokens: int = 10,
+    max_ngram: int = 3,
+    past_key_values=None,
+    stats: Optional[Counter] = None,
+) -> List[int]:
+    """
+    Greedy decoding with drafts from n-gram lookup, verified by the model itself.
+
+    Each step feeds the last accepted token plus the draft through the model in one
+    forward pass and keeps the longest prefix of the draft that greedy decoding would
+    have produced, plus the model's own next token. The output is the same as
+    generate(do_sample=False) up to floating point differences between the batched
+    and single-token forward passes.
+
+    Args:
+        model: A causal LM.
+        input_ids (list): Prompt token ids (a single sequence).
+        corpus (list): Token sequences to draft from; tokens generated so far are added.
+        max_new_tokens (int): Maximum number of tokens to generate.
+        eos_token_id (int): Generation stops after this token.
+        num_draft_tokens (int): Maximum number of draft tokens verified per forward pass.
+        max_ngram (int): Longest suffix matched against the corpus.
+        past_key_values (Cache): Optional cache already covering a prefix of input_ids.
+        stats (Counter): If given, forward passes and draft acceptance are counted in it.
+
+    Returns:
+        list: The generated token ids, including eos if it was produced.
+    """
+    if stats is None:
+        stats = Counter()
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+    device = model.device
+    tokens = list(input_ids)
+    generated = []
+    with torch.no_grad():
+        n_cached = past_key_values.get_seq_length()
+        logits = model(
+            torch.tensor([tokens[n_cached:]], device=device),
+            past_key_values=past_key_values,
+            use_cache=True,
+        ).logits
+        stats["forward_passes"] += 1
+        next_token = int(logits[0, -1].argmax())
+        while True:
+            generated.append(next_token)
+            tokens.append(next_token)
+            if next_token == eos_token_id or len(generated) >= max_new_tokens:
+                break
+            draft = find_draft(
+                tokens,
+                corpus + [generated[:-1]],
+                min(num_draft_tokens, max_new_tokens - len(generated)),
+                max_ngram,
+            )
+            logits = model(
+                torch.tensor([[next_token] + draft], device=device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            ).logits
+            stats["forward_passes"] += 1
+            stats["draft_tokens"] += len(draft)
+            predictions = logits[0].argmax(-1).tolist()
+            n_accepted = 0
+            while n_accepted < len(draft) and predictions[n_accepted] == draft[n_accepted]:
+                n_accepted += 1
+            stats["accepted_draft_tokens"] += n_accepted
+            finished = False
+            for token in draft[:n_accepted]:
+                generated.append(token)
+                tokens.append(token)
+                if token == eos_token_id or len(generated) >= max_new_tokens:
+                    finished = True
+                    break
+            if finished:
+                break
+            # drop the rejected draft tokens from the cache; next_token is not cached yet
+            n_rejected = past_key_values.get_seq_length() - len(tokens)
+            if n_rejected > 0:
+                past_key_values.crop(-n_rejected)
+            next_token = predictions[n_accepted]
+    stats["generated_tokens"] += len(generated)
+    return generated
+
+
+def constrained_generate(
+    model,
+    tokenizer,
+    input_ids: List[int],
+    sentence: str,
+    max_new_tokens: int,
+    past_key_values=None,
+    top_k: int = 32,
+    token_texts: Optional[List[str]] = None,
+    stats: Optional[Counter] = None,
+) -> List[int]:
+    """
+    Greedy decoding constrained to ruby markup of sentence (see ruby.CopyState).
+
+    Outside <rt> only the next sentence characters or a ruby open tag are allowed,
+    inside <rt> only kana and the closing tag. Text that is forced (kana and
+    punctuation up to the next kanji, the rest of a tag, </ruby> after </rt>) is
+    appended without asking the model and prefilled together with the next step.
+    At each step the highest scoring valid token among the top candidates is taken;
+    generation stops with eos once the whole sentence is covered.
+
+    Args:
+        model: A causal LM.
+        tokenizer: Its tokenizer.
+        input_ids (list): Prompt token ids (a single sequence).
+        sentence (str): The input sentence the markup has to copy.
+        max_new_tokens (int): Maximum number of tokens to generate.
+        past_key_values (Cache): Optional cache already covering a prefix of input_ids.
+        top_k (int): Number of candidates checked before searching the whole vocabulary.
+        token_texts (list): Each token decoded on its own (see decode_vocabulary), used
+            to rule out candidates without decoding the whole output.
+        stats (Counter): If given, decode steps and forced tokens are counted in it.
+
+    Returns:
+        list: The generated token ids.
+    """
+    if stats is None:
+        stats = Counter()
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+    if token_texts is None:
+        token_texts = decode_vocabulary(tokenizer)
+    uncached = list(input_ids[past_key_values.get_seq_length() :])
+    generated = []
+    state = CopyState(sentence)
+    text = ""
+    # special tokens decode to nothing, so they would always look valid
+    special_ids = set(tokenizer.all_special_ids)
+    with torch.no_grad():
+        while len(generated) < max_new_tokens:
+            if state.complete:
+                if tokenizer.eos_token_id is not None:
+                    generated.append(tokenizer.eos_token_id)
+                break
+            forced = forced_ids(tokenizer, generated, state.forced_text())
+            if forced:
+                forced = forced[: max_new_tokens - len(generated)]
+                generated += forced
+                uncached += forced
+                stats["forced_tokens"] += len(forced)
+                text = tokenizer.decode(generated, skip_special_tokens=True)
+                state = CopyState.from_text(sentence, text)
+                if state is None:  # the forced text did not decode back as expected
+                    break
+                continue
+            logits = model(
+                torch.tensor([uncached], device=model.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            ).logits[0, -1]
+            stats["decode_steps"] += 1
+            next_token, next_state, next_text = None, None, None
+            for candidates in ranked_candidates(logits, top_k):
+                for token in candidates.tolist():
+                    if token in special_ids or token >= len(token_texts):
+                        continue
+                    piece = token_texts[token]
+                    if not piece:  # tokens that add nothing could loop forever
+                        continue
+                    candidate = state.copy()
+                    if "\ufffd" not in piece and not candidate.feed(piece):
+                        continue
+                    candidate_text = tokenizer.decode(
+                        generated + [token], skip_special_tokens=True
+                    )
+                    if candidate_text == text:
+                        continue
+                    if candidate_text != text + piece:  # merged with the previous tokens
+                        candidate = CopyState.from_text(sentence, candidate_text)
+                    if candidate is not None:
+                        next_token, next_state, next_text = token, candidate, candidate_text
+                        break
+                if next_token is not None:
+                    break
+            if next_token is None:
+                stats["dead_ends"] += 1
+                break
+            generated.append(next_token)
+            uncached = [next_token]
+            state, text = next_state, next_text
+    stats["generated_tokens"] += len(generated)
+    return generated
+
+
+def ranked_candidates(logits: torch.Tensor, top_k: int) -> Iterator[torch.Tensor]:
+    """
+    Yields the top_k token ids, then, only if asked for more, the rest of the
+    vocabulary in score order without them.
+    """
+    top = logits.topk(min(top_k, logits.numel())).indices
+    yield top
+    order = logits.argsort(descending=True)
+    ruled_out = torch.zeros_like(logits, dtype=torch.bool)
+    ruled_out[top] = True
+    yield order[~ruled_out[order]]
+
+
+def decode_vocabulary(tokenizer) -> List[str]:
+    return tokenizer.batch_decode([[token] for token in range(len(tokenizer))])
+
+
+def forced_ids(tokenizer, generated: List[int], forced_text: str) -> List[int]:
+    """
+    Tokenizes forced text in the context of the tokens generated so far.
+
+    Re-tokenizing the generated text with the forced text appended gives the usual
+    tokenization, but only if the generated tokens stay a prefix of it (the model may
+    have spelled a tag out piece by piece). Otherwise the forced text is tokenized on
+    its own. Returns no tokens if neither decodes back to the expected text, in which
+    case the model decodes normally.
+    """
+    if not forced_text:
+        return []
+    text = tokenizer.decode(generated, skip_special_tokens=True)
+    if text.endswith("\ufffd"):
+        return []
+    ids = tokenizer(text + forced_text, add_special_tokens=False)["input_ids"]
+    if ids[: len(generated)] == generated and len(ids) > len(generated):
+        return ids[len(generated) :]
+    ids = tokenizer(forced_text, add_special_tokens=False)["input_ids"]
+    if ids and tokenizer.decode(generated + ids, skip_special_tokens=True) == text + forced_text:
+        return ids
+    return []
@@ -0,0 +1,178 @@
+import argparse
+import json
+import re
+import sys
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple, Optional, TextIO, Tuple
+from cli import add_annotator_arguments, annotator_from_args
+from ruby import can_start_ruby
+
+# a sentence runs up to and including its terminators; line breaks are their own pieces
+SENTENCE_PATTERN = re.compile(r"[^。！？\n]*[。！？]+|[^。！？\n]+|\n")
+# leading and trailing whitespace stays out of the sentence sent to the model
+SPACE_PATTERN = re.compile(r"^(\s*)(.*?)(\s*)$", re.DOTALL)
+
+
+class Segment(NamedTuple):
+    offset: int  # in characters from the start of the document
+    text: str
+    annotate: bool  # False for whitespace and sentences without kanji
+
+
+def iter_segments(
+    file: TextIO, chunk_size: int = 1 << 16, max_sentence_chars: int = 1000
+) -> Iterator[Segment]:
+    """
+    Splits a text stream into sentences on 。！？ and line breaks, keeping offsets.
+
+    Only the unfinished sentence at the end of a chunk is carried over to the next,
+    so memory does not grow with the length of the document. Sentences longer than
+    max_sentence_chars are cut.
+    """
+    offset, rest = 0, ""
+    while True:
+        chunk = file.read(chunk_size)
+        text = rest + chunk
+        pieces = [
+            piece[start : start + max_sentence_chars]
+            for piece in SENTENCE_PATTERN.findall(text)
+            for start in range(0, len(piece), max_sentence_chars)
+        ]
+        # the last piece may continue in the next chunk unless it ends a sentence
+        rest = ""
+        if chunk and pieces and not pieces[-1].endswith(("。", "！", "？", "\n")):
+            rest = pieces.pop()
+        for piece in pieces:
+            leading, sentence, trailing = SPACE_PATTERN.match(piece).groups()
+            for part, annotate in ((leading, False), (sentence, True), (trailing, False)):
+                if part:
+                    yield Segment(offset, part, annotate and any(map(can_start_ruby, part)))
+                    offset += len(part)
+        if not chunk:
+            return
+
+
+class Batch:
+    def __init__(self):
+        self.sentences: List[str] = []
+        self.future: Optional[Future] = None
+
+    def output(self, index: int) -> str:
+        return self.future.result()[index]
+
+
+def annotate_stream(
+    annotator,
+    segments: Iterable[Segment],
+    batch_size: int = 64,
+    max_pending_batches: int = 2,
+    max_buffered: int = 8192,
+    recent_size: int = 4096,
+) -> Iterator[Tuple[Segment, str]]:
+    """
+    Annotates a stream of segments in batches and yields (segment, output) in order.
+
+    New sentences are collected into batches that run in a worker thread while the
+    input is read ahead. A sentence that is in a batch not yet written out or among
+    the recent_size most recent results is not annotated again. Reading waits once
+    max_pending_batches batches are running or max_buffered segments are held back,
+    so memory stays bounded; output is yielded as soon as everything before it is done.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    recent: OrderedDict = OrderedDict()
+    queued = {}  # sentence -> (Batch, index), until it is written out
+    submitted = deque()
+    buffered = deque()  # (segment, output or (Batch, index))
+    batch = Batch()
+
+    def submit():
+        nonlocal batch
+        if batch.sentences:
+            batch.future = executor.submit(annotator.annotate, batch.sentences)
+            submitted.append(batch)
+            batch = Batch()
+
+    def resolve(segment: Segment):
+        if not segment.annotate:
+            return segment.text
+        if segment.text in recent:
+            recent.move_to_end(segment.text)
+            return recent[segment.text]
+        if segment.text not in queued:
+            queued[segment.text] = (batch, len(batch.sentences))
+            batch.sentences.append(segment.text)
+            if len(batch.sentences) >= batch_size:
+                submit()
+        return queued[segment.text]
+
+    def ready() -> bool:
+        output = buffered[0][1]
+        return isinstance(output, str) or (
+            output[0].future is not None and output[0].future.done()
+        )
+
+    def pop() -> Tuple[Segment, str]:
+        segment, output = buffered.popleft()
+        if not isinstance(output, str):
+            source, index = output
+            if source.future is None:
+                submit()
+            output = source.output(index)  # waits for the batch
+            if queued.get(segment.text) == (source, index):
+                del queued[segment.text]
+                recent[segment.text] = output
+                if len(recent) > recent_size:
+                    recent.popitem(last=False)
+        while submitted and submitted[0].future.done():
+            submitted.popleft()
+        return segment, output
+
+    try:
+        for segment in segments:
+            buffered.append((segment, resolve(segment)))
+            while len(submitted) > max_pending_batches or len(buffered) > max_buffered:
+                yield pop()
+            while buffered and ready():
+                yield pop()
+        submit()
+        while buffered:
+            yield pop()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate a document with furigana")
+    add_annotator_arguments(parser)
+    parser.add_argument("input", nargs="?", default="-", help="text file, or - for stdin")
+    parser.add_argument("--output", default="-", help="output file, or - for stdout")
+    parser.add_argument(
+        "--jsonl", action="store_true", help="write annotated sentences with their offsets"
+    )
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    annotator = annotator_from_args(args)
+    source = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    target = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        for segment, output in annotate_stream(
+            annotator, iter_segments(source), batch_size=args.batch_size
+        ):
+            if not args.jsonl:
+                target.write(output)
+            elif segment.annotate:
+                line = {"offset": segment.offset, "input": segment.text, "output": output}
+                target.write(json.dumps(line, ensure_ascii=False) + "\n")
+            if segment.text == "\n":
+                target.flush()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,15 @@
 from enum import Enum
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 from utils import is_hiragana, is_katakana
 from jaconv import kata2hira
+from kana import ITERATION_MARKS, NORMALIZATIONS, normalize_kana_batch
+
+
+class States(Enum):
+    START = 1
+    KANA = 2
+    KANJI = 3
+    END = 4
 
 
 def generate_possible_kanji_reading_pairs(
@@ -53,12 +61,6 @@ def generate_possible_kanji_reading_pairs(
     if is_kana(text[-1]) and text[-1] != reading[-1]:
         return None
 
-    class States(Enum):
-        START = 1
-        KANA = 2
-        KANJI = 3
-        END = 4
-
     state = States.START
     current_kanji_block = ""
     text, reading = kata2hira(text), kata2hira(reading)
@@ -122,11 +124,23 @@ def generate_possible_kanji_reading_pairs(
     return results
 
 
-def generate_furigana(
-    text: str,
-    reading: str,
-    delimiters: Dict[str, Tuple[str, str]],
-    min_reading_len=True,
+def choose_reading_pairs(
+    results: List[List[Tuple[str, str]]], min_reading_len=True
+) -> List[Tuple[str, str]]:
+    if min_reading_len:
+        return next(
+            (
+                result
+                for result in results
+                if all(len(pair[0]) <= len(pair[1]) for pair in result)
+            ),
+            results[0],
+        )
+    return results[0]
+
+
+def render_furigana(
+    text: str, pairs: List[Tuple[str, str]], delimiters: Dict[str, Tuple[str, str]]
 ) -> str:
     def replace_first(text, lemma, reading):
         index = text.find(lemma)
@@ -138,28 +152,98 @@ def generate_furigana(
         return text, ""
 
     _text = ("", text)
+    for pair in pairs:
+        lemma, reading = pair
+        left, right = replace_first(_text[1], lemma, reading)
+        _text = (_text[0] + left, right)
+    return "".join(_text)
+
+
+def generate_furigana(
+    text: str,
+    reading: str,
+    delimiters: Dict[str, Tuple[str, str]],
+    min_reading_len=True,
+) -> str:
     results = generate_possible_kanji_reading_pairs(text, reading)
     if results is None or len(results) == 0:
         raise ValueError(
             f"generate_furigana: no valid configuration found for {text}, {reading}"
         )
-    pairs = []
-    if min_reading_len:
-        pairs = next(
-            (
-                result
-                for result in results
-                if all(len(pair[0]) <= len(pair[1]) for pair in result)
-            ),
-            results[0],
+    return render_furigana(text, choose_reading_pairs(results, min_reading_len), delimiters)
+
+
+def restore_pairs(
+    text: str,
+    reading: str,
+    normalized_text: str,
+    normalized_reading: str,
+    pairs: List[Tuple[str, str]],
+) -> List[Tuple[str, str]]:
+    """
+    Maps pairs found for a normalized text and reading back to the same stretches of
+    the original ones. Kana outside the kanji blocks read as themselves, so a block's
+    reading starts where the kana before it end. Iteration marks in the reading are
+    spelled out, so that it stays kana.
+    """
+    reading = "".join(
+        normal if char in ITERATION_MARKS else char
+        for char, normal in zip(reading, normalized_reading)
+    )
+    restored = []
+    position, cursor = 0, 0
+    for lemma, lemma_reading in pairs:
+        start = normalized_text.index(lemma, position)
+        cursor += start - position
+        end = cursor + len(lemma_reading)
+        restored.append((text[start : start + len(lemma)], kata2hira(reading[cursor:end])))
+        cursor = end
+        position = start + len(lemma)
+    return restored
+
+
+def align_furigana_batch(
+    pairs: List[Tuple[str, str]],
+    delimiters: Dict[str, Tuple[str, str]],
+    min_reading_len=True,
+) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    generate_furigana for a batch of (text, reading) pairs that, for the pairs it
+    cannot align as they are, compares kana through kana.normalize_kana_batch, one
+    more normalization at a time, over all pairs still unaligned at once.
+
+    The ruby is built on the original text and reading (in hiragana), so e.g. small
+    kana are kept even when the alignment needed them normalized.
+
+    Returns:
+        list: (furigana, how) for each pair, where how is "exact", the normalization
+        in kana.NORMALIZATIONS that rescued the pair, or (None, None) if none did.
+    """
+    aligned: List[Tuple[Optional[str], Optional[str]]] = [(None, None)] * len(pairs)
+    pending = list(range(len(pairs)))
+    for level in range(len(NORMALIZATIONS) + 1):
+        if not pending:
+            break
+        texts = normalize_kana_batch([pairs[index][0] for index in pending], level)
+        readings = normalize_kana_batch(
+            [pairs[index][1] for index in pending], level, reading=True
         )
-    else:
-        pairs = results[0]
-    for pair in pairs:
-        lemma, reading = pair
-        left, right = replace_first(_text[1], lemma, reading)
-        _text = (_text[0] + left, right)
-    return "".join(_text)
+        how = NORMALIZATIONS[level - 1] if level else "exact"
+        unaligned = []
+        for index, text, reading in zip(pending, texts, readings):
+            try:
+                results = generate_possible_kanji_reading_pairs(text, reading)
+            except ValueError:
+                results = None
+            if not results:
+                unaligned.append(index)
+                continue
+            reading_pairs = choose_reading_pairs(results, min_reading_len)
+            if level:
+                reading_pairs = restore_pairs(*pairs[index], text, reading, reading_pairs)
+            aligned[index] = (render_furigana(pairs[index][0], reading_pairs, delimiters), how)
+        pending = unaligned
+    return aligned
 
 
 def test_furigana():
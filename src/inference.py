@@ -0,0 +1,722 @@
+import copy
+import hashlib
+import json
+import mmap
+import os
+from collections import Counter
+from typing import Dict, List, Optional
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache, StoppingCriteriaList
+from annotation_cache import cache_namespace, normalize_sentence
+from decoding import (
+    RUBY_TAGS,
+    BudgetStoppingCriteria,
+    RubyStoppingCriteria,
+    SpanStreamer,
+    constrained_generate,
+    decode_vocabulary,
+    greedy_generate_batch,
+    prompt_lookup_generate,
+)
+from ruby import MAX_READING_PER_CHAR, can_start_ruby, covers_sentence, parse_ruby
+from tiny_random import tiny_random_tokenizer
+from validate import check_output, repair_output
+
+PROMPT_TEMPLATE = """[INST] {instruction}\n{input}\n[/INST]\n"""
+INSTRUCTION = "次の文に正確に振り仮名を付けてください"
+
+
+def format_prompt(sentence: str, instruction: str = INSTRUCTION) -> str:
+    return PROMPT_TEMPLATE.format(instruction=instruction, input=sentence)
+
+
+def prompt_prefix(instruction: str = INSTRUCTION) -> str:
+    # the part of every prompt before the sentence
+    return PROMPT_TEMPLATE.split("{input}")[0].format(instruction=instruction)
+
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def load_model(
+    model_name: str,
+    device: Optional[str] = None,
+    quantize: bool = False,
+    quantized_cache_dir: Optional[str] = None,
+    shared_weights: bool = False,
+):
+    """
+    Loads a merged FLFL checkpoint (or any causal LM) and its tokenizer for inference.
+
+    With quantize, the linear layers are converted to dynamic int8 for CPU inference.
+    If quantized_cache_dir is given, the converted model is saved there and later
+    loads read it directly instead of loading and converting the fp32 weights.
+    With shared_weights (and without quantize), the weights are mapped from the
+    safetensors files, see load_shared_model.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if quantize:
+        if device not in (None, "cpu"):
+            raise ValueError("load_model: dynamic int8 quantization only runs on CPU")
+        if quantized_cache_dir is None:
+            return quantize_dynamic(AutoModelForCausalLM.from_pretrained(model_name)), tokenizer
+        return load_quantized(model_name, quantized_cache_dir), tokenizer
+    if shared_weights:
+        model = load_shared_model(model_name)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name)
+    if device is not None:
+        model = model.to(device)
+    model.eval()
+    return model, tokenizer
+
+
+def map_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Returns the tensors of a safetensors file as views of one private mapping of it,
+    without reading them into memory: their pages are the page cache's, shared with
+    every other process that maps the file, until written to (copy on write).
+    """
+    with open(path, "rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    header_length = int.from_bytes(mapped[:8], "little")
+    header = json.loads(mapped[8 : 8 + header_length])
+    header.pop("__metadata__", None)
+    tensors = {}
+    for name, entry in header.items():
+        dtype = SAFETENSORS_DTYPES[entry["dtype"]]
+        start, end = entry["data_offsets"]
+        if start == end:
+            tensors[name] = torch.empty(entry["shape"], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(
+            mapped,
+            dtype=dtype,
+            count=(end - start) // dtype.itemsize,
+            offset=8 + header_length + start,
+        ).view(entry["shape"])
+    return tensors
+
+
+def load_shared_model(model_name: str):
+    """
+    Loads a safetensors checkpoint directory with every weight a view of the mapped
+    files (see map_safetensors) rather than a copy, so that processes loading the
+    same checkpoint this way, such as worker_pool replicas, hold one copy of the
+    weights between them. The weights keep the dtype they are stored in.
+
+    Raises:
+        ValueError: If the checkpoint is not safetensors, or its tensors do not match
+        the model's parameters.
+    """
+    from transformers import AutoConfig, GenerationConfig
+
+    index_path = os.path.join(model_name, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as file:
+            files = sorted(set(json.load(file)["weight_map"].values()))
+    elif os.path.exists(os.path.join(model_name, "model.safetensors")):
+        files = ["model.safetensors"]
+    else:
+        raise ValueError(f"load_shared_model: no safetensors checkpoint in {model_name}")
+    state_dict = {}
+    for name in files:
+        state_dict.update(map_safetensors(os.path.join(model_name, name)))
+
+    model = AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(model_name))
+    # assign makes the mapped tensors the parameters; the initial ones are freed
+    unexpected = model.load_state_dict(state_dict, strict=False, assign=True).unexpected_keys
+    model.tie_weights()
+    mapped = {tensor.data_ptr() for tensor in state_dict.values()}
+    not_loaded = [
+        name
+        for name, parameter in model.named_parameters()
+        if parameter.data_ptr() not in mapped
+    ]
+    # checkpoints in an older layout name a tensor differently (embed_out for lm_head);
+    # pair what is left by shape where that is unambiguous
+    for name in list(not_loaded):
+        parameter = model.get_parameter(name)
+        matches = [
+            key
+            for key in unexpected
+            if state_dict[key].shape == parameter.shape
+        ]
+        others = [
+            other
+            for other in not_loaded
+            if model.get_parameter(other).shape == parameter.shape
+        ]
+        if len(matches) == 1 and len(others) == 1:
+            module_name, _, attribute = name.rpartition(".")
+            setattr(
+                model.get_submodule(module_name),
+                attribute,
+                torch.nn.Parameter(state_dict[matches[0]], parameter.requires_grad),
+            )
+            unexpected.remove(matches[0])
+            not_loaded.remove(name)
+    if unexpected or not_loaded:
+        raise ValueError(
+            f"load_shared_model: {model_name} does not match its config: "
+            f"unexpected {unexpected[:5]}, not loaded {not_loaded[:5]}"
+        )
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_name)
+    except OSError:  # no generation_config.json
+        pass
+    return model
+
+
+def quantize_dynamic(model):
+    """
+    Replaces the nn.Linear layers with int8 dynamically quantized ones (CPU only).
+    """
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def is_quantized(model) -> bool:
+    return any(
+        isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in model.modules()
+    )
+
+
+def quantized_cache_key(model_name: str) -> str:
+    # the saved int8 weights are only valid for the same checkpoint and library
+    # versions (the packed layout belongs to torch's quantized kernels)
+    import transformers
+
+    parts = [os.path.realpath(model_name), torch.__version__, transformers.__version__]
+    if os.path.isdir(model_name):
+        for name in sorted(os.listdir(model_name)):
+            stat = os.stat(os.path.join(model_name, name))
+            parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def load_quantized(model_name: str, cache_dir: str):
+    """
+    Loads the int8 model from cache_dir, or quantizes the checkpoint and saves it there.
+
+    Only the state dict is saved, and it is read back with weights_only, so a file in
+    the cache cannot run code. The model itself is built from the checkpoint's config
+    and quantized the same way before the saved weights are loaded into it.
+    """
+    from transformers import AutoConfig, GenerationConfig
+
+    path = os.path.join(cache_dir, f"{quantized_cache_key(model_name)}.pt")
+    if os.path.exists(path):
+        model = quantize_dynamic(
+            AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(model_name))
+        )
+        model.load_state_dict(torch.load(path, weights_only=True))
+        try:
+            model.generation_config = GenerationConfig.from_pretrained(model_name)
+        except OSError:  # no generation_config.json
+            pass
+        model.eval()
+        return model
+    model = quantize_dynamic(AutoModelForCausalLM.from_pretrained(model_name))
+    os.makedirs(cache_dir, exist_ok=True)
+    torch.save(model.state_dict(), path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return model
+
+
+def configure_threads(num_threads: Optional[int] = None, interop_threads: Optional[int] = None):
+    """
+    Sets torch's intra-op and inter-op thread pools; call before running any model.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if interop_threads is not None:
+        torch.set_num_interop_threads(interop_threads)
+
+
+def tiny_random_model(seed: int = 0, hidden_size: int = 32, num_layers: int = 2):
+    """
+    Builds a small randomly initialized model with a character-level tokenizer, for
+    exercising the inference code on CPU without downloading a checkpoint.
+
+    The tokenizer is tiny_random.tiny_random_tokenizer.
+    """
+    from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+    tokenizer = tiny_random_tokenizer()
+    torch.manual_seed(seed)
+    config = GPTNeoXConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        intermediate_size=hidden_size * 2,
+        max_position_embeddings=2048,
+        bos_token_id=1,
+        eos_token_id=1,
+        pad_token_id=0,
+    )
+    model = GPTNeoXForCausalLM(config)
+    model.eval()
+    return model, tokenizer
+
+
+def make_batches(
+    lengths: List[int], max_batch_tokens: int, max_new_tokens, max_batch_size=None
+) -> List[List[int]]:
+    """
+    Groups prompt indices into batches of similar length.
+
+    Prompts are sorted by prompt plus generation length, longest first, and a batch
+    is closed once its padded size, rows * longest, would exceed max_batch_tokens.
+    A prompt that is too long on its own still gets a batch of one.
+
+    Args:
+        lengths (list): Token length of each prompt.
+        max_batch_tokens (int): Token budget of a padded batch, including generation.
+        max_new_tokens (int or list): Number of tokens generated per row, or per prompt.
+        max_batch_size (int): Optional cap on rows per batch.
+
+    Returns:
+        list: Lists of indices into lengths, one per batch.
+    """
+    if isinstance(max_new_tokens, int):
+        max_new_tokens = [max_new_tokens] * len(lengths)
+    totals = [length + new_tokens for length, new_tokens in zip(lengths, max_new_tokens)]
+    order = sorted(range(len(totals)), key=lambda i: totals[i], reverse=True)
+    batches, batch, longest = [], [], 0
+    for i in order:
+        longest_if_added = max(longest, totals[i])
+        if batch and (
+            (len(batch) + 1) * longest_if_added > max_batch_tokens
+            or (max_batch_size is not None and len(batch) >= max_batch_size)
+        ):
+            batches.append(batch)
+            batch, longest_if_added = [], totals[i]
+        batch.append(i)
+        longest = longest_if_added
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class PrefixCache:
+    """
+    Key/value cache of the fixed prompt prefix, computed once per model.
+
+    Each batch gets its own copy of the cache, expanded to the batch size, so only
+    the sentence part of the prompts has to be prefilled.
+    """
+
+    def __init__(self, model, tokenizer, prefix: str):
+        self.prefix = prefix
+        self.input_ids = tokenizer(prefix)["input_ids"]
+        with torch.no_grad():
+            past_key_values = model(
+                torch.tensor([self.input_ids], device=model.device), use_cache=True
+            ).past_key_values
+        if isinstance(past_key_values, tuple):  # legacy cache format
+            past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+        self.past_key_values = past_key_values
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def copy(self, batch_size: int):
+        past_key_values = copy.deepcopy(self.past_key_values)
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+
+
+class Annotator:
+    """
+    Batched furigana annotation with a causal LM.
+
+    Sentences are sorted by prompt length and generated in left-padded batches
+    bounded by a token budget; outputs are returned in input order.
+
+    With prefix_cache, the shared instruction prefix is encoded once and reused:
+    rows are laid out as prefix + padding + sentence, with the padding masked out.
+
+    decoding="prompt_lookup" generates one sentence at a time with drafts looked up
+    in the input sentence and the ruby tags (see decoding.prompt_lookup_generate);
+    the output is the same as greedy decoding. decoding="constrained" also goes one
+    sentence at a time and only lets the model choose where ruby goes and what the
+    readings are (see decoding.constrained_generate).
+
+    With adaptive_budget, each sentence may generate at most as many tokens as the
+    longest markup of it ruby.CopyState allows (capped at max_new_tokens). With
+    stop_on_complete, a row stops once its base text is the whole sentence. Greedy
+    batches run in decoding.greedy_generate_batch, which drops finished rows from the
+    batch; other generate_kwargs go through model.generate with BudgetStoppingCriteria
+    and RubyStoppingCriteria.
+
+    With validate, every output is checked (validate.check_output); broken markup
+    around intact text is repaired by re-aligning its reading (validate.repair_output),
+    and only rows that cannot be repaired are decoded again, constrained. An output
+    still invalid after that (or already constrained) is replaced by the sentence
+    itself, without ruby, and counted in stats["unrepaired_outputs"].
+
+    With a cache (annotation_cache.AnnotationCache), sentences are normalized and
+    only those not cached for this model and these settings are generated.
+    model_id names the model in cache keys when its config does not (e.g. an adapter
+    loaded from a path).
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_new_tokens=512,
+        max_batch_tokens=16384,
+        max_batch_size=None,
+        prefix_cache=False,
+        decoding="greedy",
+        num_draft_tokens=10,
+        adaptive_budget=True,
+        stop_on_complete=True,
+        validate=False,
+        cache=None,
+        model_id=None,
+        **generate_kwargs,
+    ):
+        if decoding not in ("greedy", "prompt_lookup", "constrained"):
+            raise ValueError(f"Annotator: unknown decoding mode {decoding}")
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_new_tokens = max_new_tokens
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.generate_kwargs = {"do_sample": False} | generate_kwargs
+        # causal LMs continue from the last position, so pad on the left
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.prefix_cache = (
+            PrefixCache(model, tokenizer, prompt_prefix()) if prefix_cache else None
+        )
+        self.decoding = decoding
+        self.num_draft_tokens = num_draft_tokens
+        self.adaptive_budget = adaptive_budget
+        self.stop_on_complete = stop_on_complete
+        self.validate = validate
+        self.span_tokens = self.count_span_tokens()
+        self.stats = Counter()
+        self.token_texts = None  # decoded vocabulary for constrained decoding
+        self.model_id = model_id
+        self.cache = cache
+        self.cache_namespace = cache_namespace(self.cache_identity())
+        if decoding == "prompt_lookup":
+            self.tag_ids = [
+                tokenizer(tag, add_special_tokens=False)["input_ids"] for tag in RUBY_TAGS
+            ]
+
+    def cache_identity(self) -> dict:
+        config = self.model.config
+        return {
+            "model": self.model_id or getattr(config, "_name_or_path", None),
+            "revision": getattr(config, "_commit_hash", None),
+            "adapters": {
+                name: adapter.to_dict()
+                for name, adapter in getattr(self.model, "peft_config", {}).items()
+            },
+            # int8 outputs can differ from fp32 ones, and outputs decoded from reused
+            # prefix KV from a full forward pass, by rounding
+            "quantize": is_quantized(self.model),
+            "prefix_cache": self.prefix_cache is not None,
+            "prompt": format_prompt("{input}"),
+            "decoding": self.decoding,
+            "max_new_tokens": self.max_new_tokens,
+            "num_draft_tokens": self.num_draft_tokens,
+            "adaptive_budget": self.adaptive_budget,
+            "stop_on_complete": self.stop_on_complete,
+            "validate": self.validate,
+            "generate_kwargs": self.generate_kwargs,
+        }
+
+    def count_span_tokens(self) -> int:
+        """
+        Upper bound on the tokens one ruby span adds per base character: the four tags,
+        the longest reading ruby.CopyState accepts, and the base tokens split apart.
+        """
+        tags = sum(
+            len(self.tokenizer(tag, add_special_tokens=False)["input_ids"])
+            for tag in RUBY_TAGS[:4]
+        )
+        kana = [chr(c) for c in range(0x3041, 0x3097)] + [chr(c) for c in range(0x30A1, 0x30FD)]
+        kana_tokens = max(
+            len(ids) for ids in self.tokenizer(kana, add_special_tokens=False)["input_ids"]
+        )
+        return tags + MAX_READING_PER_CHAR * kana_tokens + 2
+
+    def budgets(self, sentences: List[str]) -> List[int]:
+        if not self.adaptive_budget or not sentences:
+            return [self.max_new_tokens] * len(sentences)
+        lengths = self.tokenizer(sentences, add_special_tokens=False)["input_ids"]
+        return [
+            min(
+                self.max_new_tokens,
+                len(ids) + sum(map(can_start_ruby, sentence)) * self.span_tokens + 1,
+            )
+            for sentence, ids in zip(sentences, lengths)
+        ]
+
+    def annotate(self, sentences: List[str]) -> List[str]:
+        if self.cache is None:
+            return self.annotate_uncached(sentences)
+        sentences = [normalize_sentence(sentence) for sentence in sentences]
+        found = self.cache.get_many(self.cache_namespace, sentences)
+        misses = [sentence for sentence in dict.fromkeys(sentences) if sentence not in found]
+        if misses:
+            generated = dict(zip(misses, self.annotate_uncached(misses)))
+            self.cache.put_many(self.cache_namespace, generated)
+            found.update(generated)
+        return [found[sentence] for sentence in sentences]
+
+    def annotate_streaming(self, sentence: str, on_span) -> str:
+        """
+        Annotates one sentence, calling on_span(ruby.Span) for each span as soon as its
+        </ruby> is generated, and returns the whole output.
+
+        Tokens come from model.generate with a decoding.SpanStreamer, so the output is
+        that of greedy decoding whatever the decoding mode; validate is not applied.
+        A cached output is passed on span by span at once.
+        """
+        if self.cache is not None:
+            sentence = normalize_sentence(sentence)
+            found = self.cache.get_many(self.cache_namespace, [sentence])
+            if sentence in found:
+                try:
+                    spans = parse_ruby(found[sentence])[1]
+                except ValueError:
+                    spans = []
+                for span in spans:
+                    on_span(span)
+                return found[sentence]
+        inputs = self.encode([format_prompt(sentence)])
+        stopping_criteria = StoppingCriteriaList()
+        if self.stop_on_complete:
+            stopping_criteria.append(
+                RubyStoppingCriteria(self.tokenizer, [sentence], inputs["input_ids"].shape[1])
+            )
+        with torch.no_grad():
+            tokens = self.model.generate(
+                **inputs,
+                max_new_tokens=self.budgets([sentence])[0],
+                pad_token_id=self.tokenizer.pad_token_id,
+                stopping_criteria=stopping_criteria,
+                streamer=SpanStreamer(self.tokenizer, on_span),
+                **self.generate_kwargs,
+            )
+        output = self.tokenizer.decode(
+            tokens[0, inputs["input_ids"].shape[1] :], skip_special_tokens=True
+        ).strip()
+        self.stats["streamed"] += 1
+        # the same output annotate would give, unless it decodes differently
+        if self.cache is not None and self.decoding != "constrained" and not self.validate:
+            self.cache.put_many(self.cache_namespace, {sentence: output})
+        return output
+
+    def annotate_uncached(self, sentences: List[str]) -> List[str]:
+        outputs = self.generate_outputs(sentences)
+        if self.validate:
+            outputs = self.validate_outputs(sentences, outputs)
+        return outputs
+
+    def validate_outputs(self, sentences: List[str], outputs: List[str]) -> List[str]:
+        outputs = list(outputs)
+        for i, (sentence, output) in enumerate(zip(sentences, outputs)):
+            # outputs are stripped, see generate
+            error = check_output(sentence.strip(), output)
+            if error is None:
+                self.stats["valid_outputs"] += 1
+                continue
+            self.stats[f"invalid_{error}"] += 1
+            repaired = repair_output(sentence.strip(), output)
+            if repaired is not None:
+                self.stats["repaired_outputs"] += 1
+                outputs[i] = repaired
+                continue
+            if self.decoding != "constrained":
+                self.stats["requeued_outputs"] += 1
+                outputs[i] = self.generate_constrained(sentence)
+                if check_output(sentence.strip(), outputs[i]) is None:
+                    continue
+            self.stats["unrepaired_outputs"] += 1
+            outputs[i] = sentence.strip()
+        return outputs
+
+    def generate_outputs(self, sentences: List[str]) -> List[str]:
+        if self.decoding == "prompt_lookup":
+            return [self.generate_prompt_lookup(sentence) for sentence in sentences]
+        if self.decoding == "constrained":
+            return [self.generate_constrained(sentence) for sentence in sentences]
+        prompts = [format_prompt(sentence) for sentence in sentences]
+        lengths = self.prompt_lengths(sentences)
+        budgets = self.budgets(sentences)
+        outputs = [None] * len(prompts)
+        for batch in make_batches(
+            lengths, self.max_batch_tokens, budgets, self.max_batch_size
+        ):
+            for i, output in zip(
+                batch,
+                self.generate(
+                    [prompts[i] for i in batch],
+                    [sentences[i] for i in batch],
+                    [budgets[i] for i in batch],
+                ),
+            ):
+                outputs[i] = output
+        return outputs
+
+    def prompt_lengths(self, sentences: List[str]) -> List[int]:
+        prompts = [format_prompt(sentence) for sentence in sentences]
+        return [len(ids) for ids in self.tokenizer(prompts)["input_ids"]]
+
+    def encode(self, prompts: List[str]):
+        if self.prefix_cache is None:
+            return self.tokenizer(prompts, return_tensors="pt", padding=True).to(
+                self.model.device
+            )
+        prefix = self.prefix_cache.prefix
+        if not all(prompt.startswith(prefix) for prompt in prompts):
+            raise ValueError("Annotator: prompts do not start with the cached prefix")
+        suffixes = self.tokenizer(
+            [prompt[len(prefix) :] for prompt in prompts], add_special_tokens=False
+        )["input_ids"]
+        longest = max(len(suffix) for suffix in suffixes)
+        prefix_ids = self.prefix_cache.input_ids
+        pad_id = self.tokenizer.pad_token_id
+        input_ids = [
+            prefix_ids + [pad_id] * (longest - len(suffix)) + suffix for suffix in suffixes
+        ]
+        attention_mask = [
+            [1] * len(prefix_ids) + [0] * (longest - len(suffix)) + [1] * len(suffix)
+            for suffix in suffixes
+        ]
+        return {
+            "input_ids": torch.tensor(input_ids, device=self.model.device),
+            "attention_mask": torch.tensor(attention_mask, device=self.model.device),
+            "past_key_values": self.prefix_cache.copy(len(prompts)),
+        }
+
+    def encode_single(self, sentence: str):
+        """
+        Returns the prompt token ids of one sentence and a cache to start from
+        (a copy of the prefix cache, or None).
+        """
+        prompt = format_prompt(sentence)
+        if self.prefix_cache is None:
+            return self.tokenizer(prompt)["input_ids"], None
+        prefix = self.prefix_cache.prefix
+        input_ids = self.prefix_cache.input_ids + self.tokenizer(
+            prompt[len(prefix) :], add_special_tokens=False
+        )["input_ids"]
+        return input_ids, self.prefix_cache.copy(1)
+
+    def generate_prompt_lookup(self, sentence: str) -> str:
+        input_ids, past_key_values = self.encode_single(sentence)
+        sentence_ids = self.tokenizer(sentence, add_special_tokens=False)["input_ids"]
+        generated = prompt_lookup_generate(
+            self.model,
+            input_ids,
+            [sentence_ids] + self.tag_ids,
+            self.budgets([sentence])[0],
+            self.tokenizer.eos_token_id,
+            num_draft_tokens=self.num_draft_tokens,
+            past_key_values=past_key_values,
+            stats=self.stats,
+        )
+        return self.tokenizer.decode(generated, skip_special_tokens=True).strip()
+
+    def generate_constrained(self, sentence: str) -> str:
+        input_ids, past_key_values = self.encode_single(sentence)
+        if self.token_texts is None:
+            self.token_texts = decode_vocabulary(self.tokenizer)
+        generated = constrained_generate(
+            self.model,
+            self.tokenizer,
+            input_ids,
+            sentence,
+            self.budgets([sentence])[0],
+            past_key_values=past_key_values,
+            token_texts=self.token_texts,
+            stats=self.stats,
+        )
+        return self.tokenizer.decode(generated, skip_special_tokens=True).strip()
+
+    def generate(
+        self,
+        prompts: List[str],
+        sentences: Optional[List[str]] = None,
+        budgets: Optional[List[int]] = None,
+    ) -> List[str]:
+        """
+        Generates completions for one padded batch of prompts.
+
+        Without sentences, rows cannot stop on completion and budgets default to
+        max_new_tokens.
+        """
+        if budgets is None:
+            budgets = [self.max_new_tokens] * len(prompts)
+        stop_on_complete = self.stop_on_complete and sentences is not None
+        inputs = self.encode(prompts)
+        if self.generate_kwargs == {"do_sample": False}:
+            is_complete = None
+            if sentences is not None:
+                is_complete = lambda row, tokens: covers_sentence(
+                    sentences[row], self.tokenizer.decode(tokens, skip_special_tokens=True)
+                )
+            generated = greedy_generate_batch(
+                self.model,
+                inputs["input_ids"],
+                inputs["attention_mask"],
+                budgets,
+                self.tokenizer.eos_token_id,
+                past_key_values=inputs.get("past_key_values"),
+                is_complete=is_complete,
+                stop_on_complete=stop_on_complete,
+                stats=self.stats,
+            )
+            return [
+                output.strip()
+                for output in self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+            ]
+        prompt_length = inputs["input_ids"].shape[1]
+        stopping_criteria = StoppingCriteriaList()
+        stopping_criteria.append(BudgetStoppingCriteria(budgets, prompt_length))
+        if stop_on_complete:
+            stopping_criteria.append(
+                RubyStoppingCriteria(self.tokenizer, sentences, prompt_length)
+            )
+        with torch.no_grad():
+            tokens = self.model.generate(
+                **inputs,
+                max_new_tokens=max(budgets),
+                pad_token_id=self.tokenizer.pad_token_id,
+                stopping_criteria=stopping_criteria,
+                **self.generate_kwargs,
+            )
+        # rows that stopped are padded up to the longest; beam search does not stop
+        # rows one by one, so cut each at its budget too
+        new_tokens = [
+            row[prompt_length : prompt_length + budget] for row, budget in zip(tokens, budgets)
+        ]
+        return [
+            output.strip()
+            for output in self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        ]
@@ -0,0 +1,163 @@
+import cProfile
+import json
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss_mb(who="self"):
+    """
+    Returns the peak resident set size of this process (or of its largest child) in MB.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN
+    )
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    scale = 1 << 20 if sys.platform == "darwin" else 1 << 10
+    return usage.ru_maxrss / scale
+
+
+def memory_mb():
+    """
+    Returns resident memory of this process in MB as rss, pss (shared pages divided
+    among the processes mapping them) and private_dirty (memory no other process can
+    share, unlike clean pages of memory-mapped files); None where /proc is missing.
+    """
+    try:
+        with open("/proc/self/smaps_rollup", "r") as file:
+            fields = dict(line.split(":", 1) for line in file if ":" in line)
+    except OSError:
+        return None
+    return {
+        name.lower(): int(fields[name].split()[0]) / 1024
+        for name in ("Rss", "Pss", "Private_Dirty")
+        if name in fields
+    }
+
+
+def cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def percentiles(values, qs=(50, 95, 99)):
+    """
+    Returns {"p50": ..., ...} by the nearest-rank method (None if there are no values).
+    """
+    values = sorted(values)
+    if not values:
+        return {f"p{q}": None for q in qs}
+    return {
+        f"p{q}": values[min(len(values) - 1, max(0, -(-q * len(values) // 100) - 1))]
+        for q in qs
+    }
+
+
+def add_report_arguments(parser):
+    """
+    Adds the --profile and --report options that RunReport.start reads to an argparse parser.
+    """
+    parser.add_argument(
+        "--profile", action="store_true", help="profile each stage with cProfile"
+    )
+    parser.add_argument(
+        "--report", help="write the run report here (default: <name>_report.json)"
+    )
+    return parser
+
+
+class RunReport:
+    """
+    Counters and per-stage timings for one run of a data script, written out as JSON.
+
+    Stage timings include CPU time of worker processes that have been joined.
+    With profile enabled, each stage of the main process is profiled with cProfile
+    and dumped next to the report as <run>.<stage>.pstats.
+    """
+
+    def __init__(self, name="run"):
+        self.name = name
+        self.counters = Counter()
+        self.stages = {}
+        self.profile = False
+        self.report_path = None
+        self.argv = []
+        self.started = datetime.now().isoformat(timespec="seconds")
+
+    def start(self, name, args=None):
+        """
+        Resets the report for a new run, with the options add_report_arguments parsed into args.
+        """
+        self.__init__(name)
+        self.argv = list(sys.argv)
+        self.profile = bool(getattr(args, "profile", False))
+        self.report_path = getattr(args, "report", None) or f"{name}_report.json"
+        return self
+
+    def count(self, key, n=1):
+        self.counters[key] += n
+
+    def update(self, counts):
+        self.counters.update(counts)
+
+    @contextmanager
+    def stage(self, name):
+        profiler = cProfile.Profile() if self.profile else None
+        wall_start, cpu_start = time.perf_counter(), cpu_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield self
+        finally:
+            if profiler:
+                profiler.disable()
+            entry = {
+                "wall_time": time.perf_counter() - wall_start,
+                "cpu_time": cpu_time() - cpu_start,
+                "peak_rss_mb": peak_rss_mb(),
+            }
+            if profiler:
+                profile_path = os.path.join(
+                    os.path.dirname(self.report_path or "") or ".",
+                    f"{self.name}.{name}.pstats",
+                )
+                profiler.dump_stats(profile_path)
+                entry["profile"] = profile_path
+            self.stages[name] = entry
+            print(
+                f"[{self.name}] {name}: {entry['wall_time']:.1f}s wall, "
+                f"{entry['cpu_time']:.1f}s cpu",
+                flush=True,
+            )
+
+    def to_dict(self):
+        return {
+            "run": self.name,
+            "started": self.started,
+            "argv": self.argv,
+            "stages": self.stages,
+            "counters": dict(self.counters),
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_children_mb": peak_rss_mb("children"),
+        }
+
+    def save(self, path=None):
+        path = path or self.report_path or f"{self.name}_report.json"
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, ensure_ascii=False, indent=2)
+        print(f"[{self.name}] report written to {path}", flush=True)
+        return path
+
+
+# shared by the data scripts so counters can be bumped anywhere during a run
+REPORT = RunReport()
@@ -0,0 +1,153 @@
+from typing import Callable, List
+import numpy as np
+
+# every table maps code points below TABLE_SIZE (through the kana blocks); others are kept
+TABLE_SIZE = 0x3100
+# applied cumulatively, in this order, by normalize_kana_batch
+NORMALIZATIONS = ("script", "long_vowel", "small_kana", "iteration")
+ITERATION_MARKS = "ゝゞヽヾ々"
+
+SMALL_KANA = "ぁあぃいぅうぇえぉおっつゃやゅゆょよゎわゕかゖけ"
+VOWEL_ROWS = {
+    "あ": "あかさたなはまやらわがざだばぱぁゃゎ",
+    "い": "いきしちにひみりゐぎじぢびぴぃ",
+    "う": "うくすつぬふむゆるぐずづぶぷゔぅゅ",
+    "え": "えけせてねへめれゑげぜでべぺぇ",
+    "お": "おこそとのほもよろをごぞどぼぽぉょ",
+}
+# as in process_reading, ー after the お and う rows (こー, しょー, くー) reads う
+ELONGATION = {"あ": "あ", "い": "い", "う": "う", "え": "え", "お": "う"}
+VOICEABLE = "かきくけこさしすせそたちつてとはひふへほう"
+
+
+def identity_table() -> np.ndarray:
+    return np.arange(TABLE_SIZE, dtype=np.int32)
+
+
+def build_script_table() -> np.ndarray:
+    # katakana ァ-ヴ and ヽヾ to hiragana; ヵ and ヶ are left alone, as furigana
+    # counts them as kanji (一ヶ月)
+    table = identity_table()
+    table[ord("ァ") : ord("ヴ") + 1] -= ord("ァ") - ord("ぁ")
+    table[ord("ヽ")], table[ord("ヾ")] = ord("ゝ"), ord("ゞ")
+    return table
+
+
+def build_small_kana_table() -> np.ndarray:
+    table = identity_table()
+    for small, large in zip(SMALL_KANA[::2], SMALL_KANA[1::2]):
+        table[ord(small)] = ord(large)
+    return table
+
+
+def build_elongation_table() -> np.ndarray:
+    # the kana ー stands for after each hiragana, 0 where it stands for nothing
+    table = np.zeros(TABLE_SIZE, dtype=np.int32)
+    for vowel, row in VOWEL_ROWS.items():
+        for char in row:
+            table[ord(char)] = ord(ELONGATION[vowel])
+    return table
+
+
+def build_voicing_table() -> np.ndarray:
+    table = identity_table()
+    for char in VOICEABLE:
+        table[ord(char)] = ord(char) + (0x4E if char == "う" else 1)  # ゔ is apart
+    return table
+
+
+def build_hiragana_mask() -> np.ndarray:
+    mask = np.zeros(TABLE_SIZE, dtype=bool)
+    mask[ord("ぁ") : ord("ゖ") + 1] = True
+    return mask
+
+
+SCRIPT_TABLE = build_script_table()
+SMALL_KANA_TABLE = build_small_kana_table()
+ELONGATION_TABLE = build_elongation_table()
+VOICING_TABLE = build_voicing_table()
+HIRAGANA_MASK = build_hiragana_mask()
+
+
+def lookup(table: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    inside = codes < TABLE_SIZE
+    return np.where(inside, table[np.where(inside, codes, 0)], codes)
+
+
+def is_hiragana_code(codes: np.ndarray) -> np.ndarray:
+    return (codes < TABLE_SIZE) & HIRAGANA_MASK[np.minimum(codes, TABLE_SIZE - 1)]
+
+
+def previous(codes: np.ndarray) -> np.ndarray:
+    shifted = np.zeros_like(codes)
+    shifted[:, 1:] = codes[:, :-1]
+    return shifted
+
+
+def until_stable(step: Callable[[np.ndarray], np.ndarray], codes: np.ndarray) -> np.ndarray:
+    # marks that follow marks (こーー, すゝゝ) resolve one more per pass
+    while not np.array_equal(changed := step(codes), codes):
+        codes = changed
+    return codes
+
+
+def elongate(codes: np.ndarray) -> np.ndarray:
+    vowels = lookup(ELONGATION_TABLE, previous(codes))
+    return np.where((codes == ord("ー")) & (vowels != 0), vowels, codes)
+
+
+def repeat(codes: np.ndarray, reading: bool) -> np.ndarray:
+    before = previous(codes)
+    kana = is_hiragana_code(before)
+    codes = np.where((codes == ord("ゝ")) & kana, before, codes)
+    codes = np.where((codes == ord("ゞ")) & kana, lookup(VOICING_TABLE, before), codes)
+    if not reading:
+        # 々 after kana repeats it (ここ々); after kanji it is read with them. In a
+        # reading (とき々) it repeats a reading of unknown length and is left alone
+        codes = np.where((codes == ord("々")) & kana, before, codes)
+    return codes
+
+
+def encode_batch(strings: List[str]) -> np.ndarray:
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    width = int(lengths.max()) if len(strings) else 0
+    codes = np.zeros((len(strings), width), dtype=np.int32)
+    flat = np.frombuffer("".join(strings).encode("utf-32-le"), dtype=np.uint32)
+    codes[np.arange(width) < lengths[:, None]] = flat
+    return codes
+
+
+def decode_batch(codes: np.ndarray, strings: List[str]) -> List[str]:
+    lengths = [len(string) for string in strings]
+    mask = np.arange(codes.shape[1]) < np.array(lengths, dtype=np.int64)[:, None]
+    text = codes[mask].astype(np.uint32).tobytes().decode("utf-32-le")
+    offsets = np.cumsum([0] + lengths).tolist()
+    return [text[start:end] for start, end in zip(offsets, offsets[1:])]
+
+
+def normalize_kana_batch(strings: List[str], level: int, reading: bool = False) -> List[str]:
+    """
+    Applies the first level NORMALIZATIONS to a batch of strings at once, by table
+    lookups over their code points:
+
+    script: katakana to hiragana.
+    long_vowel: ー to the vowel it lengthens, う after the お row as in process_reading.
+    small_kana: small kana to full size (っ to つ, ゃ to や).
+    iteration: ゝ and ゞ to the (voiced) kana before them, and 々 after kana in text.
+
+    Every normalization maps one character to one character, so positions in the
+    result are positions in the input. Characters other than kana are kept.
+    """
+    if level == 0 or not strings:
+        return list(strings)
+    steps = NORMALIZATIONS[:level]
+    codes = encode_batch(strings)
+    if "script" in steps:
+        codes = lookup(SCRIPT_TABLE, codes)
+    if "long_vowel" in steps:
+        codes = until_stable(elongate, codes)
+    if "small_kana" in steps:
+        codes = lookup(SMALL_KANA_TABLE, codes)
+    if "iteration" in steps:
+        codes = until_stable(lambda codes: repeat(codes, reading), codes)
+    return decode_batch(codes, strings)
@@ -0,0 +1,124 @@
+import json
+import os
+import pickle
+import sys
+from typing import Dict, FrozenSet, Optional
+from jaconv import kata2hira
+
+KANJI_JSON_PATH = "kanji-kyouiku.json"
+KANJI_READINGS_PATH = "kanji_readings.pkl"
+
+# first mora voicing (rendaku) and final mora gemination (sokuon) in compounds
+RENDAKU = dict(zip("かきくけこさしすせそたちつてとはひふへほ", "がぎぐげござじずぜぞだぢづでどばびぶべぼ"))
+HANDAKU = dict(zip("はひふへほ", "ぱぴぷぺぽ"))
+SOKUON_FINALS = "ちつくき"
+
+
+def normalize_reading(reading: str) -> str:
+    # kanji-data style readings: "ひと.つ" (okurigana after the dot), "-ひと" (affix markers)
+    return kata2hira(reading.split(".")[0].strip("-"))
+
+
+def reading_variants(reading: str):
+    yield reading
+    if reading[0] in RENDAKU:
+        yield RENDAKU[reading[0]] + reading[1:]
+    if reading[0] in HANDAKU:
+        yield HANDAKU[reading[0]] + reading[1:]
+    if len(reading) > 1 and reading[-1] in SOKUON_FINALS:
+        yield reading[:-1] + "っ"
+
+
+def build_kanji_dict(json_path: str, output_path: str) -> Dict[str, FrozenSet[str]]:
+    """
+    Converts a kanji-data style JSON dictionary into the pickled frozenset map used by KanjiReadings.
+
+    Args:
+        json_path (str): Path to the JSON dictionary (kanji -> {"readings_on", "readings_kun", ...}).
+        output_path (str): Where to write the pickled map.
+
+    Returns:
+        dict: kanji -> frozenset of hiragana readings, including rendaku and sokuon variants.
+    """
+    with open(json_path, "r", encoding="utf-8") as file:
+        kanji_data_full = json.load(file)
+    kanji_readings = {}
+    for kanji, data in kanji_data_full.items():
+        readings = set()
+        for reading in data.get("readings_on", []) + data.get("readings_kun", []):
+            reading = normalize_reading(reading)
+            if reading:
+                readings.update(reading_variants(reading))
+        kanji_readings[kanji] = frozenset(readings)
+    # readers in other processes only ever see a missing or a complete file
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        pickle.dump(kanji_readings, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, output_path)
+    return kanji_readings
+
+
+class KanjiReadings:
+    """
+    Kanji reading dictionary that is only loaded on first use.
+
+    The pickled map is built from the JSON dictionary the first time it is needed
+    if it does not exist yet.
+    """
+
+    def __init__(self, path=KANJI_READINGS_PATH, json_path=KANJI_JSON_PATH):
+        self.path = path
+        self.json_path = json_path
+        self._readings: Optional[Dict[str, FrozenSet[str]]] = None
+
+    def available(self) -> bool:
+        return os.path.exists(self.path) or os.path.exists(self.json_path)
+
+    @property
+    def readings(self) -> Dict[str, FrozenSet[str]]:
+        if self._readings is None:
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as file:
+                    self._readings = pickle.load(file)
+            elif os.path.exists(self.json_path):
+                self._readings = build_kanji_dict(self.json_path, self.path)
+            else:
+                raise FileNotFoundError(
+                    f"KanjiReadings: neither {self.path} nor {self.json_path} exists"
+                )
+        return self._readings
+
+    def rebuild(self) -> Dict[str, FrozenSet[str]]:
+        """
+        Builds the map from the JSON dictionary again, replacing the pickled one.
+        """
+        self._readings = build_kanji_dict(self.json_path, self.path)
+        return self._readings
+
+    def check(self, lemma: str, reading: str) -> Optional[bool]:
+        """
+        Checks a single kanji lemma against the dictionary.
+
+        Returns:
+            bool: Whether the reading is known for the kanji, or None if the
+            lemma is not a single kanji in the dictionary.
+        """
+        readings = self.readings.get(lemma)
+        if readings is None:
+            return None
+        return kata2hira(reading) in readings
+
+
+KANJI_READINGS = KanjiReadings()
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("usage: kanji_dict.py kanji-kyouiku.json kanji_readings.pkl")
+        sys.exit(1)
+    kanji_readings = build_kanji_dict(sys.argv[1], sys.argv[2])
+    print(f"Saved readings for {len(kanji_readings)} kanji to {sys.argv[2]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
+import argparse
 from enum import Enum
-from furigana import generate_furigana
+from furigana import align_furigana_batch
 from utils import is_hiragana, is_kanji, is_katakana, is_kana
+from instrument import REPORT, add_report_arguments
 import json
 
 
@@ -8,15 +10,19 @@ def extract_entries(file_path):
     examples = []
     with open(file_path, "r") as file:
         for line in file:
+            REPORT.count("rows_read")
             fields = line.strip().split("\t")
             lemma = fields[0]
             reading = fields[1]
             sentence = fields[2]
             if reading == lemma:
+                REPORT.count("rejected_reading_is_lemma")
                 continue
             if all(is_kana(char) for char in lemma):
+                REPORT.count("rejected_all_kana")
                 continue
             if len(lemma) == 0 or len(reading) == 0:
+                REPORT.count("rejected_empty")
                 continue
             example = {
                 "lemma": lemma.split("・")[0],
@@ -27,22 +33,53 @@ def extract_entries(file_path):
     return examples
 
 
+def align_entries(examples, delimiters, rescued_file, batch_size=4096):
+    """
+    Sets each example's furigana with furigana.align_furigana_batch and drops the
+    ones it cannot align. Rows rescued by a kana normalization are written to
+    rescued_file as lemma, reading, normalization and furigana, for review.
+    """
+    aligned_examples = []
+    with open(rescued_file, "w", encoding="utf-8") as rescued:
+        for start in range(0, len(examples), batch_size):
+            batch = examples[start : start + batch_size]
+            alignments = align_furigana_batch(
+                [(example["lemma"], example["reading"]) for example in batch], delimiters
+            )
+            for example, (furigana, how) in zip(batch, alignments):
+                if furigana is None:
+                    REPORT.count("rejected_unaligned")
+                    continue
+                REPORT.count(f"aligned_{how}")
+                if how != "exact":
+                    rescued.write(
+                        "\t".join([example["lemma"], example["reading"], how, furigana]) + "\n"
+                    )
+                aligned_examples.append(example | {"furigana": furigana})
+    return aligned_examples
+
+
 def main():
-    examples = extract_entries("data/anki_dataset/Mining-All-1.txt")
+    parser = argparse.ArgumentParser(description="Align Anki mining cards with furigana")
+    add_report_arguments(parser)
+    args = parser.parse_args()
+
+    REPORT.start("process_anki", args)
+    with REPORT.stage("extract_entries"):
+        examples = extract_entries("data/anki_dataset/Mining-All-1.txt")
     output_file = "data/anki_dataset/Mining-All-1.jsonl"
     delimiters = {"ruby": ("<ruby>", "</ruby>"), "rt": ("<rt>", "</rt>")}
-    for example in examples:
-        if not generate_furigana(example["lemma"], example["reading"], delimiters):
-            (example["lemma"], example["reading"])
+    with REPORT.stage("align"):
+        examples = align_entries(
+            examples, delimiters, "data/anki_dataset/Mining-All-1.rescued.tsv"
+        )
 
-    with open(output_file, "w", encoding="utf-8") as f:
+    with REPORT.stage("write"), open(output_file, "w", encoding="utf-8") as f:
         for example in examples:
             json_line = json.dumps(
                 {
                     # "input": example["lemma"],
-                    "output": generate_furigana(
-                        example["lemma"], example["reading"], delimiters
-                    ),
+                    "output": example["furigana"],
                     # "context": example["sentence"],
                     "instruction": "",
                     "input": (
@@ -56,6 +93,8 @@ def main():
                 ensure_ascii=False,
             )
             f.write(json_line + "\n")
+            REPORT.count("rows_out")
+    REPORT.save()
 
 
 if __name__ == "__main__":
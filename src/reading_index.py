@@ -0,0 +1,247 @@
+import json
+import os
+import re
+import sqlite3
+import sys
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from functools import lru_cache, partial
+from multiprocessing import Pool
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+RUBY_PATTERN = re.compile(r"<ruby>(.*?)<rt>(.*?)</rt></ruby>")
+
+# only keep a handful of example sources per (lemma, reading) on disk
+MAX_SOURCES = 8
+
+
+class ReadingIndex:
+    """
+    Corpus-wide lemma -> reading -> (count, sources) aggregate.
+
+    Indexes are built per worker while files are parsed and merged afterwards
+    (map-reduce), then saved as a single SQLite file for lookup with ReadingLookup.
+    """
+
+    def __init__(self):
+        self.counts: Dict[str, Counter] = defaultdict(Counter)
+        self.sources: Dict[Tuple[str, str], set] = defaultdict(set)
+
+    def __len__(self):
+        return sum(len(readings) for readings in self.counts.values())
+
+    def add(self, lemma: str, reading: str, source: Optional[str] = None, count=1):
+        self.counts[lemma][reading] += count
+        if source is not None:
+            self.sources[(lemma, reading)].add(source)
+
+    def add_annotated(self, text: str, source: Optional[str] = None):
+        """
+        Adds every <ruby>lemma<rt>reading</rt></ruby> span of an annotated sentence.
+        """
+        for lemma, reading in RUBY_PATTERN.findall(text):
+            if lemma and reading:
+                self.add(lemma, reading, source)
+
+    def merge(self, other: "ReadingIndex") -> "ReadingIndex":
+        for lemma, readings in other.counts.items():
+            self.counts[lemma].update(readings)
+        for pair, sources in other.sources.items():
+            self.sources[pair].update(sources)
+        return self
+
+    def save(self, path: str):
+        """
+        Writes the index to a SQLite file, replacing any existing file at path.
+        """
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute(
+            "CREATE TABLE readings (lemma TEXT NOT NULL, reading TEXT NOT NULL, "
+            "count INTEGER NOT NULL, n_sources INTEGER NOT NULL, sources TEXT NOT NULL, "
+            "PRIMARY KEY (lemma, reading)) WITHOUT ROWID"
+        )
+        conn.executemany(
+            "INSERT INTO readings VALUES (?, ?, ?, ?, ?)",
+            (
+                (
+                    lemma,
+                    reading,
+                    count,
+                    len(self.sources.get((lemma, reading), ())),
+                    "\t".join(sorted(self.sources.get((lemma, reading), ()))[:MAX_SOURCES]),
+                )
+                for lemma in sorted(self.counts)
+                for reading, count in self.counts[lemma].items()
+            ),
+        )
+        conn.commit()
+        conn.execute("VACUUM")
+        conn.close()
+        os.replace(tmp_path, path)
+
+
+def merge_indexes(indexes: Iterable[ReadingIndex]) -> ReadingIndex:
+    merged = ReadingIndex()
+    for index in indexes:
+        merged.merge(index)
+    return merged
+
+
+class ReadingLookup:
+    """
+    Read-only view of a saved ReadingIndex with cached point lookups.
+    """
+
+    def __init__(self, path: str, cache_size=65536):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"ReadingLookup: no index at {path}")
+        self.path = path
+        self.conn = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False
+        )
+        self.readings = lru_cache(maxsize=cache_size)(self._readings)
+
+    def _readings(self, lemma: str) -> Dict[str, int]:
+        rows = self.conn.execute(
+            "SELECT reading, count FROM readings WHERE lemma = ?", (lemma,)
+        ).fetchall()
+        return dict(rows)
+
+    def total(self, lemma: str) -> int:
+        return sum(self.readings(lemma).values())
+
+    def share(self, lemma: str, reading: str) -> Optional[float]:
+        """
+        Returns the fraction of occurrences of lemma read as reading,
+        or None if the lemma has never been seen.
+        """
+        readings = self.readings(lemma)
+        if not readings:
+            return None
+        return readings.get(reading, 0) / sum(readings.values())
+
+    def is_plausible(self, lemma: str, reading: str, min_share=0.01, min_total=20):
+        """
+        A reading is implausible only if the lemma is well attested (at least
+        min_total occurrences) and the reading makes up less than min_share of them.
+        """
+        readings = self.readings(lemma)
+        total = sum(readings.values())
+        if total < min_total:
+            return True
+        return readings.get(reading, 0) / total >= min_share
+
+    def sources(self, lemma: str, reading: str) -> List[str]:
+        row = self.conn.execute(
+            "SELECT sources FROM readings WHERE lemma = ? AND reading = ?",
+            (lemma, reading),
+        ).fetchone()
+        return row[0].split("\t") if row and row[0] else []
+
+    def prefix(self, prefix: str, limit=None) -> Iterator[Tuple[str, str, int]]:
+        """
+        Yields (lemma, reading, count) for every lemma starting with prefix, in lemma order.
+        """
+        query = "SELECT lemma, reading, count FROM readings WHERE lemma >= ? AND lemma < ? ORDER BY lemma"
+        params = [prefix, prefix + "\U0010ffff"]
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        yield from self.conn.execute(query, params)
+
+    def close(self):
+        self.conn.close()
+
+
+def index_jsonl(file_path: str) -> ReadingIndex:
+    index = ReadingIndex()
+    source = os.path.basename(file_path)
+    with open(file_path, "r", encoding="utf-8") as file:
+        for line in file:
+            index.add_annotated(json.loads(line)["output"], source)
+    return index
+
+
+def build_index(file_paths: List[str], output_path: str, workers=None):
+    """
+    Builds an index from annotated JSONL files, one file per worker, and saves it.
+    """
+    with Pool(workers) as pool:
+        index = merge_indexes(pool.imap_unordered(index_jsonl, file_paths))
+    index.save(output_path)
+    return index
+
+
+def index_file(
+    process_file: Callable, file_path: str, root_dir: str, with_index: bool = False
+) -> Tuple[List[dict], Optional[ReadingIndex], Counter]:
+    """
+    Processes a single corpus file and optionally indexes the readings of its examples.
+
+    Args:
+        process_file (callable): Called as process_file(file_path, stats=Counter()),
+            returns the examples of the file and counts its rows in stats.
+        file_path (str): The path to the file to be processed.
+        root_dir (str): The root directory, used for relative file paths.
+        with_index (bool): Whether to build a ReadingIndex over the examples.
+
+    Returns:
+        tuple: The examples of the file, their ReadingIndex (or None) and row counts.
+    """
+    relpath = os.path.relpath(file_path, start=root_dir)
+    stats = Counter()
+    examples = process_file(file_path, stats=stats)
+    index = ReadingIndex() if with_index else None
+    for example in examples:
+        example["file_path"] = relpath  # Add relative file path to each example
+        if index is not None:
+            index.add_annotated(example["output"], source=relpath)
+    return examples, index, stats
+
+
+def process_files(
+    process_file: Callable,
+    file_paths: List[str],
+    root_dir: str,
+    index: Optional[ReadingIndex] = None,
+    workers: int = 1,
+) -> Iterator[Tuple[List[dict], Counter]]:
+    """
+    Runs index_file over the files, in a pool of worker processes if workers > 1,
+    and yields the examples and row counts of each file in order. If index is given,
+    the readings of every file are merged into it (map-reduce).
+
+    process_file must be picklable for the pool, e.g. a module-level function or a
+    functools.partial of one.
+    """
+    worker = partial(
+        index_file, process_file, root_dir=root_dir, with_index=index is not None
+    )
+    n_file_processed = 0
+    with Pool(workers) if workers > 1 else nullcontext() as pool:
+        results = pool.imap(worker, file_paths, chunksize=8) if pool else map(worker, file_paths)
+        for examples, file_index, stats in results:
+            if index is not None:
+                index.merge(file_index)
+            n_file_processed += 1
+            if n_file_processed % 100 == 0:
+                print(f"Processed {n_file_processed} files", flush=True)
+            yield examples, stats
+    print(f"Processed {n_file_processed} files", flush=True)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("usage: reading_index.py OUTPUT.sqlite INPUT.jsonl [INPUT.jsonl ...]")
+        sys.exit(1)
+    index = build_index(sys.argv[2:], sys.argv[1])
+    print(f"Indexed {len(index)} readings of {len(index.counts)} lemmas")
+
+
+if __name__ == "__main__":
+    main()
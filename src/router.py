@@ -0,0 +1,222 @@
+from collections import Counter
+from itertools import groupby
+from typing import List, Optional, Tuple
+from furigana import generate_furigana
+from reading_index import ReadingLookup
+from ruby import can_start_ruby, parse_ruby
+
+DELIMITERS = {"ruby": ("<ruby>", "</ruby>"), "rt": ("<rt>", "</rt>")}
+
+
+def kanji_runs(sentence: str) -> List[Tuple[int, int]]:
+    """
+    Returns (start, end) of every maximal run of characters a ruby base can hold.
+    """
+    runs, offset = [], 0
+    for is_run, chars in groupby(sentence, key=can_start_ruby):
+        length = len(list(chars))
+        if is_run:
+            runs.append((offset, offset + length))
+        offset += length
+    return runs
+
+
+def splice(sentence: str, replacements: List[Tuple[int, int, str]]) -> str:
+    # replacements are (start, end, markup) and do not overlap
+    parts, end = [], 0
+    for start, stop, markup in sorted(replacements):
+        parts.append(sentence[end:start])
+        parts.append(markup)
+        end = stop
+    parts.append(sentence[end:])
+    return "".join(parts)
+
+
+class Router:
+    """
+    Annotates kanji runs with a single known reading from the lexicon and sends only
+    sentences with an ambiguous run to the annotator.
+
+    The lexicon is a ReadingLookup built from annotated training outputs (see
+    reading_index.py), so its lemmas are ruby bases: whole kanji runs or the words
+    they were split into. A run is unambiguous if it, or its split into known lemmas
+    of two or more characters, has a reading with at least min_share of at least
+    min_total occurrences. Single kanji are only taken as a whole run, as inside a
+    compound they change reading (一回 is いっかい, not いちかい).
+
+    Without window, an ambiguous sentence is annotated by the model as a whole. With
+    window, only the ambiguous runs with window characters of context on either side
+    go to the model, and the model's spans for those runs are merged with the lexicon
+    spans; a sentence whose windows come back malformed is annotated as a whole.
+
+    Has the annotate interface of inference.Annotator.
+    """
+
+    def __init__(
+        self,
+        annotator,
+        lookup: ReadingLookup,
+        min_share=0.99,
+        min_total=5,
+        max_lemma_length=8,
+        window: Optional[int] = None,
+    ):
+        self.annotator = annotator
+        self.lookup = lookup
+        self.min_share = min_share
+        self.min_total = min_total
+        self.max_lemma_length = max_lemma_length
+        self.window = window
+        self.counters = Counter()
+
+    @property
+    def tokenizer(self):
+        return self.annotator.tokenizer
+
+    @property
+    def stats(self) -> Counter:
+        return self.annotator.stats + self.counters
+
+    def unique_reading(self, lemma: str) -> Optional[str]:
+        readings = self.lookup.readings(lemma)
+        total = sum(readings.values())
+        if total < self.min_total:
+            return None
+        reading, count = max(readings.items(), key=lambda item: item[1])
+        return reading if count / total >= self.min_share else None
+
+    def resolve_run(self, run: str) -> Optional[str]:
+        """
+        Returns the markup of a kanji run if the lexicon is sure of it, else None.
+        """
+        pieces = []
+        reading = self.unique_reading(run)
+        if reading is not None:
+            pieces.append((run, reading))
+        else:
+            # longest known lemma first, left to right
+            start = 0
+            while start < len(run):
+                for end in range(min(len(run), start + self.max_lemma_length), start + 1, -1):
+                    reading = self.unique_reading(run[start:end])
+                    if reading is not None:
+                        pieces.append((run[start:end], reading))
+                        start = end
+                        break
+                else:
+                    return None
+        try:
+            return "".join(
+                generate_furigana(lemma, reading, DELIMITERS) for lemma, reading in pieces
+            )
+        except ValueError:  # readings that are not kana
+            return None
+
+    def plan(self, sentence: str):
+        """
+        Splits the kanji runs of a sentence into (start, end, markup) from the lexicon
+        and (start, end) of the ambiguous runs.
+        """
+        resolved, ambiguous = [], []
+        for start, end in kanji_runs(sentence):
+            markup = self.resolve_run(sentence[start:end])
+            if markup is None:
+                ambiguous.append((start, end))
+            else:
+                resolved.append((start, end, markup))
+        self.counters["runs"] += len(resolved) + len(ambiguous)
+        self.counters["lexicon_runs"] += len(resolved)
+        return resolved, ambiguous
+
+    def windows(self, sentence: str, ambiguous: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        merged = []
+        for start, end in ambiguous:
+            start, end = max(0, start - self.window), min(len(sentence), end + self.window)
+            # never cut a kanji run, and leave surrounding whitespace out
+            while start > 0 and can_start_ruby(sentence[start - 1]) and can_start_ruby(
+                sentence[start]
+            ):
+                start -= 1
+            while end < len(sentence) and can_start_ruby(sentence[end - 1]) and can_start_ruby(
+                sentence[end]
+            ):
+                end += 1
+            while sentence[start].isspace():
+                start += 1
+            while sentence[end - 1].isspace():
+                end -= 1
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def annotate(self, sentences: List[str]) -> List[str]:
+        plans = [self.plan(sentence) for sentence in sentences]
+        outputs: List[Optional[str]] = [None] * len(sentences)
+        requests = []  # (sentence index, start, end) to send to the model
+        for i, (sentence, (resolved, ambiguous)) in enumerate(zip(sentences, plans)):
+            if not ambiguous:
+                outputs[i] = splice(sentence, resolved)
+            elif self.window is None:
+                requests.append((i, 0, len(sentence)))
+            else:
+                requests.extend(
+                    (i, start, end) for start, end in self.windows(sentence, ambiguous)
+                )
+        self.counters["sentences"] += len(sentences)
+        self.counters["chars"] += sum(map(len, sentences))
+        self.counters["routed_sentences"] += len({i for i, _, _ in requests})
+
+        model_outputs = (
+            self.annotator.annotate([sentences[i][start:end] for i, start, end in requests])
+            if requests
+            else []
+        )
+        self.counters["model_chars"] += sum(end - start for _, start, end in requests)
+        merged = {}  # sentence index -> replacements, for windowed sentences
+        fallback = set()
+        for (i, start, end), output in zip(requests, model_outputs):
+            if self.window is None:
+                outputs[i] = output
+                continue
+            self.counters["windows"] += 1
+            ambiguous = plans[i][1]
+            replacements = merged.setdefault(i, list(plans[i][0]))
+            try:
+                base_text, spans = parse_ruby(output)
+                if base_text != sentences[i][start:end]:
+                    raise ValueError(f"Router: window {base_text} changed")
+                for span in spans:
+                    offset = start + span.offset
+                    # bases are kanji only, so a span lies inside one run
+                    if any(run_start <= offset < run_end for run_start, run_end in ambiguous):
+                        markup = generate_furigana(span.base, span.reading, DELIMITERS)
+                        replacements.append((offset, offset + len(span.base), markup))
+            except ValueError:
+                fallback.add(i)
+        for i, replacements in merged.items():
+            if i not in fallback:
+                outputs[i] = splice(sentences[i], replacements)
+        if fallback:
+            self.counters["window_fallbacks"] += len(fallback)
+            order = sorted(fallback)
+            self.counters["model_chars"] += sum(len(sentences[i]) for i in order)
+            for i, output in zip(order, self.annotator.annotate([sentences[i] for i in order])):
+                outputs[i] = output
+        return outputs
+
+    def metrics(self) -> dict:
+        counters = self.counters
+        return {
+            "routing_ratio": counters["routed_sentences"] / counters["sentences"]
+            if counters["sentences"]
+            else None,
+            "model_char_ratio": counters["model_chars"] / counters["chars"]
+            if counters["chars"]
+            else None,
+            "lexicon_run_ratio": counters["lexicon_runs"] / counters["runs"]
+            if counters["runs"]
+            else None,
+            **counters,
+        }
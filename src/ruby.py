@@ -0,0 +1,253 @@
+import re
+from enum import Enum
+from typing import List, NamedTuple, Tuple
+from utils import is_kana, is_kanji
+
+RUBY_OPEN, RUBY_CLOSE = "<ruby>", "</ruby>"
+RT_OPEN, RT_CLOSE = "<rt>", "</rt>"
+RUBY_SPAN_PATTERN = re.compile(r"<ruby>(.*?)<rt>(.*?)</rt></ruby>")
+MAX_READING_PER_CHAR = 6  # 承 is うけたまわ(る); longer readings are runaways
+
+
+def is_reading_char(char: str) -> bool:
+    try:
+        return is_kana(char)  # includes ー and the kana iteration marks
+    except ValueError:  # unnamed code points
+        return False
+
+
+def can_start_ruby(char: str) -> bool:
+    # ruby bases start with a kanji (or 々, 〆, ヶ as in furigana.py), never with kana
+    if char in ["々", "ヶ", "ヵ", "〆"]:
+        return True
+    try:
+        return is_kanji(char)
+    except ValueError:
+        return False
+
+
+class Span(NamedTuple):
+    offset: int  # in the base text
+    base: str
+    reading: str
+
+
+def parse_ruby(text: str) -> Tuple[str, List[Span]]:
+    """
+    Splits ruby markup into its base text and spans.
+
+    Raises:
+        ValueError: If tags are left over after the well-formed spans are removed.
+    """
+    base_text, spans, end = [], [], 0
+    offset = 0
+    for match in RUBY_SPAN_PATTERN.finditer(text):
+        before = text[end : match.start()]
+        base_text.append(before)
+        offset += len(before)
+        base, reading = match.groups()
+        spans.append(Span(offset, base, reading))
+        base_text.append(base)
+        offset += len(base)
+        end = match.end()
+    base_text.append(text[end:])
+    base_text = "".join(base_text)
+    for tag in (RUBY_OPEN, RUBY_CLOSE, RT_OPEN, RT_CLOSE):
+        if tag in base_text:
+            raise ValueError(f"parse_ruby: unmatched {tag} in {text}")
+    return base_text, spans
+
+
+def covers_sentence(sentence: str, text: str) -> bool:
+    """
+    Whether the base text of (possibly unfinished) markup is exactly the sentence,
+    with every ruby span closed.
+    """
+    return RUBY_SPAN_PATTERN.sub(r"\1", text).strip() == sentence.strip()
+
+
+class CopyState:
+    """
+    Tracks where ruby markup generated for a sentence is, character by character.
+
+    Valid markup copies the sentence, where a ruby span opens at a kanji, copies one
+    or more kanji as its base, and then has a non-empty kana reading of at most
+    MAX_READING_PER_CHAR characters per base character:
+    text <ruby>base<rt>reading</rt></ruby> text ...
+    """
+
+    class Mode(Enum):
+        TEXT = 1
+        BASE = 2
+        READING = 3
+        CLOSING = 4  # after </rt>, only </ruby> may follow
+
+    def __init__(self, sentence: str):
+        self.sentence = sentence
+        self.mode = CopyState.Mode.TEXT
+        self.pos = 0  # characters of the sentence copied so far
+        self.count = 0  # characters of the current base or reading
+        self.base_length = 0
+        self.pending = ""  # partial tag
+
+    def copy(self) -> "CopyState":
+        state = CopyState.__new__(CopyState)
+        state.__dict__.update(self.__dict__)
+        return state
+
+    @classmethod
+    def from_text(cls, sentence: str, text: str):
+        """
+        Returns the state after text, or None if text is not a valid prefix of markup.
+        A trailing replacement character (a partially decoded token) is ignored.
+        """
+        state = cls(sentence)
+        if state.feed(text.rstrip("\ufffd")):
+            return state
+        return None
+
+    @property
+    def complete(self) -> bool:
+        return (
+            self.mode == CopyState.Mode.TEXT
+            and not self.pending
+            and self.pos == len(self.sentence)
+        )
+
+    @property
+    def reading_full(self) -> bool:
+        return self.count >= MAX_READING_PER_CHAR * self.base_length
+
+    def expected_tags(self):
+        match self.mode:
+            case CopyState.Mode.TEXT:
+                if self.pos < len(self.sentence) and can_start_ruby(self.sentence[self.pos]):
+                    return [RUBY_OPEN]
+                return []
+            case CopyState.Mode.BASE:
+                return [RT_OPEN] if self.count > 0 else []
+            case CopyState.Mode.READING:
+                return [RT_CLOSE] if self.count > 0 else []
+            case CopyState.Mode.CLOSING:
+                return [RUBY_CLOSE]
+
+    def feed(self, text: str) -> bool:
+        for char in text:
+            if not self.feed_char(char):
+                return False
+        return True
+
+    def starts_tag(self) -> bool:
+        if not self.expected_tags():
+            return False
+        if self.mode in (CopyState.Mode.TEXT, CopyState.Mode.BASE):
+            # a literal "<" in the sentence is copied, not read as a tag
+            return not (self.pos < len(self.sentence) and self.sentence[self.pos] == "<")
+        return True
+
+    def feed_char(self, char: str) -> bool:
+        if self.pending or (char == "<" and self.starts_tag()):
+            return self.feed_tag_char(char)
+        match self.mode:
+            case CopyState.Mode.TEXT | CopyState.Mode.BASE:
+                if self.pos < len(self.sentence) and char == self.sentence[self.pos]:
+                    if self.mode == CopyState.Mode.BASE and not can_start_ruby(char):
+                        return False  # kana stay outside the ruby, as in furigana.py
+                    self.pos += 1
+                    self.count += 1
+                    return True
+                return False
+            case CopyState.Mode.READING:
+                if self.reading_full:
+                    return False
+                if is_reading_char(char):
+                    self.count += 1
+                    return True
+                return False
+            case CopyState.Mode.CLOSING:
+                return False
+
+    def feed_tag_char(self, char: str) -> bool:
+        candidate = self.pending + char
+        tags = [tag for tag in self.expected_tags() if tag.startswith(candidate)]
+        if not tags:
+            return False
+        if candidate != tags[0]:
+            self.pending = candidate
+            return True
+        self.pending = ""
+        if candidate == RT_OPEN:
+            self.base_length = self.count
+        self.count = 0
+        self.mode = {
+            RUBY_OPEN: CopyState.Mode.BASE,
+            RT_OPEN: CopyState.Mode.READING,
+            RT_CLOSE: CopyState.Mode.CLOSING,
+            RUBY_CLOSE: CopyState.Mode.TEXT,
+        }[candidate]
+        return True
+
+    def forced_text(self) -> str:
+        """
+        Returns the text that must come next whatever the model prefers: the rest of a
+        partial tag, </ruby> after </rt>, or the sentence up to the next kanji.
+        """
+        if self.pending:
+            tags = [tag for tag in self.expected_tags() if tag.startswith(self.pending)]
+            return tags[0][len(self.pending) :] if len(tags) == 1 else ""
+        if self.mode == CopyState.Mode.CLOSING:
+            return RUBY_CLOSE
+        if self.mode == CopyState.Mode.READING and self.reading_full:
+            return RT_CLOSE
+        if self.mode == CopyState.Mode.TEXT:
+            end = self.pos
+            while end < len(self.sentence) and not can_start_ruby(self.sentence[end]):
+                end += 1
+            return self.sentence[self.pos : end]
+        return ""
+
+
+class RubyStreamParser:
+    """
+    Incremental parse_ruby for text that arrives in pieces, e.g. while it is generated.
+
+    feed() returns the spans whose </ruby> has arrived, with offsets in the base text
+    as parse_ruby gives them. A span that turns out malformed is not returned.
+    """
+
+    def __init__(self):
+        self.buffer = ""  # text from the first unfinished span (or partial <ruby>) on
+        self.offset = 0  # base text length before buffer
+
+    def feed(self, text: str) -> List[Span]:
+        self.buffer += text
+        spans = []
+        while True:
+            start = self.buffer.find(RUBY_OPEN)
+            if start == -1:
+                # hold back what may be the start of a <ruby> tag
+                keep = next(
+                    (
+                        length
+                        for length in range(min(len(self.buffer), len(RUBY_OPEN) - 1), 0, -1)
+                        if RUBY_OPEN.startswith(self.buffer[-length:])
+                    ),
+                    0,
+                )
+                self.offset += len(self.buffer) - keep
+                self.buffer = self.buffer[len(self.buffer) - keep :]
+                return spans
+            self.offset += start
+            self.buffer = self.buffer[start:]
+            end = self.buffer.find(RUBY_CLOSE)
+            if end == -1:
+                return spans
+            end += len(RUBY_CLOSE)
+            match = RUBY_SPAN_PATTERN.fullmatch(self.buffer[:end])
+            if match is None:
+                self.buffer = self.buffer[len(RUBY_OPEN) :]
+                continue
+            base, reading = match.groups()
+            spans.append(Span(self.offset, base, reading))
+            self.offset += len(base)
+            self.buffer = self.buffer[end:]
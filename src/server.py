@@ -0,0 +1,380 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional
+from cli import add_annotator_arguments, annotator_from_args
+from instrument import percentiles
+from streaming import SpanTimer
+
+MAX_BODY_BYTES = 1 << 20
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+@dataclass
+class Item:
+    sentence: str
+    length: int  # prompt tokens plus generation budget
+    future: asyncio.Future
+    queued: float = field(default_factory=time.perf_counter)
+
+
+class BatchScheduler:
+    """
+    Queues sentences from concurrent requests and annotates them in micro-batches.
+
+    A batch is closed once adding the next sentence would exceed max_batch_tokens,
+    counted as in inference.make_batches, or max_wait_ms after its first sentence
+    arrived. Batches run one at a time in a worker thread so the event loop keeps
+    accepting requests. Requests that would grow the queue beyond max_queue
+    sentences are rejected with QueueFull, requests of more than max_queue
+    sentences with RequestTooLarge.
+
+    The annotator (and its tokenizer) is only used from the worker thread, which
+    also copies its stats for metrics() after each batch.
+    """
+
+    def __init__(
+        self, annotator, max_batch_tokens=8192, max_wait_ms=10, max_queue=1024, window=1000
+    ):
+        self.annotator = annotator
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.queue: Optional[asyncio.Queue] = None
+        self.carry: Optional[Item] = None  # first item of the next batch
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.counters = Counter()
+        self.max_batch_size = 0
+        self.latencies = deque(maxlen=window)  # per request, in ms
+        self.batch_times = deque(maxlen=window)  # per batch, in ms
+        self.first_span_times = deque(maxlen=window)  # per streamed sentence, in ms
+        self.stream_times = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.worker_stats = self.copy_worker_stats()
+
+    def copy_worker_stats(self) -> dict:
+        cache = self.annotator.cache
+        return {
+            "annotator": dict(self.annotator.stats),
+            "cache": cache.metrics() if cache else None,
+        }
+
+    def work(self, fn, *args):
+        # runs in the worker thread, the only one that updates the stats copied here
+        try:
+            return fn(*args)
+        finally:
+            stats = self.copy_worker_stats()
+            with self.lock:
+                self.worker_stats = stats
+
+    def measure(self, sentences: List[str]) -> List[int]:
+        lengths = self.annotator.prompt_lengths(sentences)
+        budgets = self.annotator.budgets(sentences)
+        return [length + budget for length, budget in zip(lengths, budgets)]
+
+    @property
+    def queue_depth(self) -> int:
+        if self.queue is None:
+            return 0
+        return self.queue.qsize() + (self.carry is not None)
+
+    def cost(self, rows: int, longest: int) -> int:
+        return rows * longest
+
+    async def submit(self, sentences: List[str]) -> List[str]:
+        if self.queue is None:
+            raise RuntimeError("BatchScheduler: run() has not been started")
+        if len(sentences) > self.max_queue:
+            self.counters["oversized_requests"] += 1
+            raise RequestTooLarge(f"{len(sentences)} sentences, limit {self.max_queue}")
+        if self.queue_depth + len(sentences) > self.max_queue:
+            self.counters["rejected_requests"] += 1
+            raise QueueFull(f"queue depth {self.queue_depth}, limit {self.max_queue}")
+        if not sentences:
+            return []
+        start = time.perf_counter()
+        self.counters["requests"] += 1
+        self.counters["sentences"] += len(sentences)
+        loop = asyncio.get_running_loop()
+        # the fast tokenizer must not be used from two threads at once
+        lengths = await loop.run_in_executor(self.executor, self.measure, sentences)
+        items = [
+            Item(sentence, length, loop.create_future())
+            for sentence, length in zip(sentences, lengths)
+        ]
+        for item in items:
+            self.queue.put_nowait(item)
+        try:
+            return list(await asyncio.gather(*(item.future for item in items)))
+        finally:
+            self.latencies.append((time.perf_counter() - start) * 1000)
+
+    async def stream(self, sentence: str, on_span) -> str:
+        """
+        Annotates one sentence with Annotator.annotate_streaming in the batch worker
+        thread, between batches. on_span is called from that thread.
+        """
+        if self.queue_depth + 1 > self.max_queue:
+            self.counters["rejected_requests"] += 1
+            raise QueueFull(f"queue depth {self.queue_depth}, limit {self.max_queue}")
+        self.counters["streams"] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.work, self.annotator.annotate_streaming, sentence, on_span
+        )
+
+    async def next_batch(self) -> List[Item]:
+        first = self.carry if self.carry is not None else await self.queue.get()
+        self.carry = None
+        batch, longest = [first], first.length
+        deadline = first.queued + self.max_wait
+        while True:
+            if self.queue.empty():
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:  # whatever is already waiting joins the batch, even past the deadline
+                item = self.queue.get_nowait()
+            if self.cost(len(batch) + 1, max(longest, item.length)) > self.max_batch_tokens:
+                self.carry = item
+                break
+            batch.append(item)
+            longest = max(longest, item.length)
+        return batch
+
+    async def run(self):
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            start = time.perf_counter()
+            try:
+                outputs = await loop.run_in_executor(
+                    self.executor,
+                    self.work,
+                    self.annotator.annotate,
+                    [item.sentence for item in batch],
+                )
+            except Exception as error:
+                self.counters["failed_batches"] += 1
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(error)
+                continue
+            self.batch_times.append((time.perf_counter() - start) * 1000)
+            self.counters["batches"] += 1
+            self.counters["batched_sentences"] += len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            for item, output in zip(batch, outputs):
+                if not item.future.done():  # the client may have gone away
+                    item.future.set_result(output)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            worker_stats = self.worker_stats
+        batches = self.counters["batches"]
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue": self.max_queue,
+            "counters": dict(self.counters),
+            "batch_size": {
+                "mean": self.counters["batched_sentences"] / batches if batches else None,
+                "max": self.max_batch_size,
+            },
+            "request_latency_ms": percentiles(self.latencies),
+            "batch_time_ms": percentiles(self.batch_times),
+            "stream_first_span_ms": percentiles(self.first_span_times),
+            "stream_total_ms": percentiles(self.stream_times),
+            # as of the last finished batch
+            **worker_stats,
+        }
+
+
+class Server:
+    """
+    Minimal HTTP/1.1 JSON API over TCP or a Unix socket, one request per connection.
+
+    POST /annotate  {"sentences": [...]} -> {"outputs": [...]}
+    POST /annotate/stream  {"sentence": ...} -> JSON lines, one per ruby span as soon
+                    as it is generated, then {"output", "time_to_first_span_ms", "total_ms"}
+    GET  /metrics   queue depth, batch sizes and latency percentiles
+    GET  /health
+    """
+
+    def __init__(self, scheduler: BatchScheduler):
+        self.scheduler = scheduler
+
+    async def route(self, method: str, path: str, body: bytes):
+        match (method, path):
+            case ("POST", "/annotate"):
+                request = json.loads(body or b"{}")
+                sentences = request.get("sentences") if isinstance(request, dict) else None
+                if not isinstance(sentences, list) or not all(
+                    isinstance(sentence, str) for sentence in sentences
+                ):
+                    return 400, {"error": "expected {\"sentences\": [str, ...]}"}
+                try:
+                    outputs = await self.scheduler.submit(sentences)
+                except RequestTooLarge as error:
+                    return 413, {"error": f"too many sentences: {error}"}
+                except QueueFull as error:
+                    return 503, {"error": f"overloaded: {error}"}
+                return 200, {"outputs": outputs}
+            case ("GET", "/metrics"):
+                return 200, self.scheduler.metrics()
+            case ("GET", "/health"):
+                return 200, {"status": "ok"}
+            case (_, "/annotate" | "/annotate/stream" | "/metrics" | "/health"):
+                return 405, {"error": f"{method} not allowed on {path}"}
+        return 404, {"error": f"no route {path}"}
+
+    async def stream(self, body: bytes, writer: asyncio.StreamWriter):
+        request = json.loads(body or b"{}")
+        sentence = request.get("sentence") if isinstance(request, dict) else None
+        if not isinstance(sentence, str):
+            raise ValueError("expected {\"sentence\": str}")
+        loop = asyncio.get_running_loop()
+        lines = asyncio.Queue()
+        timer = SpanTimer(lambda line: loop.call_soon_threadsafe(lines.put_nowait, line))
+        annotation = asyncio.ensure_future(self.scheduler.stream(sentence, timer))
+        started = False
+        # spans are queued before the annotation finishes, so none is left behind
+        while True:
+            line = asyncio.ensure_future(lines.get())
+            await asyncio.wait({line, annotation}, return_when=asyncio.FIRST_COMPLETED)
+            if not line.done():
+                line.cancel()
+                break
+            if not started:
+                self.write_head(writer, 200, "application/x-ndjson")
+                started = True
+            await self.write_line(writer, line.result())
+        try:
+            output = annotation.result()
+        except Exception as error:
+            if started:
+                return await self.write_line(writer, {"error": repr(error)})
+            if isinstance(error, QueueFull):
+                return await self.respond(writer, 503, {"error": f"overloaded: {error}"})
+            raise
+        summary = timer.summary(output)
+        # a sentence without spans is complete at its first line
+        first_span_ms = summary["time_to_first_span_ms"] or summary["total_ms"]
+        self.scheduler.first_span_times.append(first_span_ms)
+        self.scheduler.stream_times.append(summary["total_ms"])
+        if not started:
+            self.write_head(writer, 200, "application/x-ndjson")
+        while not lines.empty():
+            await self.write_line(writer, lines.get_nowait())
+        await self.write_line(writer, summary)
+
+    def write_head(
+        self, writer: asyncio.StreamWriter, status: int, content_type: str, length=None
+    ):
+        headers = [
+            f"HTTP/1.1 {status} {STATUS_TEXT[status]}",
+            f"Content-Type: {content_type}; charset=utf-8",
+            "Connection: close",
+        ]
+        if length is not None:
+            headers.append(f"Content-Length: {length}")
+        if status == 503:
+            headers.append("Retry-After: 1")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1"))
+
+    async def write_line(self, writer: asyncio.StreamWriter, payload: dict):
+        writer.write(json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n")
+        await writer.drain()
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, payload: dict):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.write_head(writer, status, "application/json", len(data))
+        writer.write(data)
+        await writer.drain()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_BYTES:
+                    status, payload = 413, {"error": f"body over {MAX_BODY_BYTES} bytes"}
+                else:
+                    body = await reader.readexactly(length)
+                    if (method, path.split("?")[0]) == ("POST", "/annotate/stream"):
+                        return await self.stream(body, writer)
+                    status, payload = await self.route(method, path.split("?")[0], body)
+            except (ValueError, asyncio.IncompleteReadError) as error:
+                status, payload = 400, {"error": str(error)}
+            except Exception as error:
+                status, payload = 500, {"error": repr(error)}
+            await self.respond(writer, status, payload)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, unix_path=None):
+        scheduler_task = asyncio.create_task(self.scheduler.run())
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle, path=unix_path)
+            print(f"Serving on {unix_path}", flush=True)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print(f"Serving on http://{host}:{port}", flush=True)
+        async with server:
+            await asyncio.gather(server.serve_forever(), scheduler_task)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local furigana annotation server")
+    add_annotator_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix", help="serve on this Unix socket instead of TCP")
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--max-queue", type=int, default=1024)
+    args = parser.parse_args()
+
+    annotator = annotator_from_args(args)
+    scheduler = BatchScheduler(
+        annotator, args.max_batch_tokens, args.max_wait_ms, args.max_queue
+    )
+    try:
+        asyncio.run(Server(scheduler).serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
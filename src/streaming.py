@@ -0,0 +1,74 @@
+import argparse
+import json
+import sys
+import time
+from typing import Callable, Optional
+from cli import add_annotator_arguments, annotator_from_args
+
+
+class SpanTimer:
+    """
+    on_span callback for Annotator.annotate_streaming that timestamps each span and
+    passes {"offset", "base", "reading", "ms"} on to emit, for the server and the
+    command line alike. ms counts from when the timer was created.
+    """
+
+    def __init__(self, emit: Callable[[dict], None]):
+        self.emit = emit
+        self.start = time.perf_counter()
+        self.first_span_ms: Optional[float] = None
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def __call__(self, span):
+        ms = self.elapsed_ms()
+        if self.first_span_ms is None:
+            self.first_span_ms = ms
+        self.emit({"offset": span.offset, "base": span.base, "reading": span.reading, "ms": ms})
+
+    def summary(self, output: str) -> dict:
+        return {
+            "output": output,
+            "time_to_first_span_ms": self.first_span_ms,
+            "total_ms": self.elapsed_ms(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Annotate sentences and print each ruby span as soon as it is generated"
+    )
+    add_annotator_arguments(parser)
+    parser.add_argument("sentences", nargs="*", help="default: one sentence per line on stdin")
+    parser.add_argument("--jsonl", action="store_true", help="print spans as JSON lines")
+    args = parser.parse_intermixed_args()
+
+    annotator = annotator_from_args(args)
+
+    def emit(line: dict):
+        if args.jsonl:
+            print(json.dumps(line, ensure_ascii=False), flush=True)
+        else:
+            print(f"{line['ms']:8.1f} ms  {line['base']}({line['reading']})", flush=True)
+
+    sentences = args.sentences or (line.strip() for line in sys.stdin)
+    for sentence in sentences:
+        if not sentence:
+            continue
+        timer = SpanTimer(emit)
+        summary = timer.summary(annotator.annotate_streaming(sentence, timer))
+        if args.jsonl:
+            print(json.dumps(summary, ensure_ascii=False), flush=True)
+        else:
+            first = summary["time_to_first_span_ms"]
+            print(summary["output"])
+            print(
+                f"first span {'-' if first is None else f'{first:.1f} ms'}, "
+                f"total {summary['total_ms']:.1f} ms",
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
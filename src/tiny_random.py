@@ -0,0 +1,28 @@
+from ruby import RT_CLOSE, RT_OPEN, RUBY_CLOSE, RUBY_OPEN
+
+
+def tiny_random_tokenizer():
+    """
+    Builds the character-level tokenizer of inference.tiny_random_model, without
+    importing torch, for the tokenizer workers of data/pretokenize.py.
+
+    The vocabulary covers ASCII, kana, CJK punctuation and the CJK unified ideographs,
+    plus the ruby tags and prompt markers as single tokens.
+    """
+    from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {"<pad>": 0, "<eos>": 1}
+    for token in [RUBY_OPEN, RT_OPEN, RT_CLOSE, RUBY_CLOSE, "[INST]", "[/INST]"]:
+        vocab[token] = len(vocab)
+    ranges = [(0x20, 0x7F), (0x3000, 0x3100), (0x4E00, 0xA000), (0xFF00, 0xFFF0)]
+    for char in ["\n"] + [chr(c) for start, end in ranges for c in range(start, end)]:
+        vocab.setdefault(char, len(vocab))
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<pad>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split(
+        Regex(r"</?ruby>|</?rt>|\[/?INST\]|."), behavior="isolated"
+    )
+    tokenizer.decoder = decoders.Fuse()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="<pad>", eos_token="<eos>"
+    )
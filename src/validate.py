@@ -0,0 +1,121 @@
+import re
+from itertools import groupby
+from typing import List, Optional
+from ruby import can_start_ruby, is_reading_char, parse_ruby
+
+TAG_PATTERN = re.compile(r"</?ruby>|</?rt>")
+DELIMITERS = {"ruby": ("<ruby>", "</ruby>"), "rt": ("<rt>", "</rt>")}
+
+
+def check_output(sentence: str, output: str) -> Optional[str]:
+    """
+    Checks ruby markup generated for a sentence in one pass over it.
+
+    Returns:
+        str: None if the output is valid, else what is wrong with it: "malformed"
+        (unmatched tags), "base_text" (the base text is not the sentence), "base"
+        (a ruby base without kanji) or "reading" (an empty reading or one that is
+        not kana).
+    """
+    try:
+        base_text, spans = parse_ruby(output)
+    except ValueError:
+        return "malformed"
+    if base_text != sentence:
+        return "base_text"
+    for span in spans:
+        if not any(map(can_start_ruby, span.base)):
+            return "base"
+        if not span.reading or not all(map(is_reading_char, span.reading)):
+            return "reading"
+    return None
+
+
+def is_word_char(char: str) -> bool:
+    return can_start_ruby(char) or is_reading_char(char)
+
+
+def word_chunks(text: str) -> List[str]:
+    # runs of kanji and kana, and the punctuation, latin etc. between them
+    return ["".join(chars) for _, chars in groupby(text, key=is_word_char)]
+
+
+def take_kana(text: str, position: int) -> int:
+    # the end of the kana run starting at position
+    while position < len(text) and not can_start_ruby(text[position]):
+        position += 1
+    return position
+
+
+def repair_chunk(text_chunk: str, output_chunk: str) -> Optional[str]:
+    """
+    Rebuilds the ruby of one run of kanji and kana, one kanji block at a time: its
+    reading is the kana after (and between) its kanji in the output, less the kana
+    that follow the block in the text. This assumes each reading directly follows
+    its block; where the output could also be read otherwise (a reading after the
+    kana that follow the block, or one reading for several blocks), None is returned
+    and the output is decoded again rather than guessed.
+    """
+    blocks = ["".join(chars) for _, chars in groupby(text_chunk, key=can_start_ruby)]
+    repaired = []
+    position = 0
+    for i, block in enumerate(blocks):
+        if not can_start_ruby(block[0]):
+            if i == 0:  # kana before the first block, as they are
+                end = take_kana(output_chunk, position)
+                if output_chunk[position:end] != block:
+                    return None
+                repaired.append(block)
+                position = end
+            continue  # kana after a block went with it
+        reading = ""
+        for char in block:
+            if output_chunk[position : position + 1] != char:
+                return None
+            end = take_kana(output_chunk, position + 1)
+            reading += output_chunk[position + 1 : end]
+            position = end
+        following = blocks[i + 1] if i + 1 < len(blocks) else ""
+        if len(reading) <= len(following) or not reading.endswith(following):
+            return None
+        if following and reading.startswith(following):
+            # the reading may as well come after the kana (書くかく for 書く): ambiguous
+            return None
+        reading = reading[: len(reading) - len(following)]
+        repaired.append(
+            f"{DELIMITERS['ruby'][0]}{block}{DELIMITERS['rt'][0]}{reading}"
+            f"{DELIMITERS['rt'][1]}{DELIMITERS['ruby'][1]}{following}"
+        )
+    if position != len(output_chunk):
+        return None
+    return "".join(repaired)
+
+
+def repair_output(sentence: str, output: str) -> Optional[str]:
+    """
+    Rebuilds the markup of an output whose tags are broken but whose text is intact.
+
+    With the tags removed, the output is the sentence with each reading following
+    its base, so each kanji block of the sentence is given the kana that follow it
+    in the output up to the next block, less the kana of the sentence in between
+    (see repair_chunk). This takes one pass, however long the run of kanji and kana.
+    Returns None if the kanji or the kana of the sentence changed, or if a block is
+    left without a reading.
+    """
+    text_chunks = word_chunks(sentence)
+    output_chunks = word_chunks(TAG_PATTERN.sub("", output))
+    if len(text_chunks) != len(output_chunks):
+        return None
+    repaired = []
+    for text_chunk, output_chunk in zip(text_chunks, output_chunks):
+        if not is_word_char(text_chunk[0]):
+            if output_chunk != text_chunk:
+                return None
+            repaired.append(text_chunk)
+            continue
+        chunk = repair_chunk(text_chunk, output_chunk)
+        if chunk is None:
+            return None
+        repaired.append(chunk)
+    repaired = "".join(repaired)
+    return repaired if check_output(sentence, repaired) is None else None
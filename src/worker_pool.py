@@ -0,0 +1,152 @@
+import copy
+import multiprocessing
+import os
+import queue
+import time
+from typing import List, Optional
+from cli import annotator_from_args
+from instrument import memory_mb
+
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cores(cores: List[int], replicas: int) -> List[List[int]]:
+    """
+    Splits cores into replicas disjoint contiguous sets, as even as possible.
+    """
+    if not 1 <= replicas <= len(cores):
+        raise ValueError(f"partition_cores: cannot split {len(cores)} cores {replicas} ways")
+    size, extra = divmod(len(cores), replicas)
+    sets, start = [], 0
+    for replica in range(replicas):
+        end = start + size + (replica < extra)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+
+def replica_main(args, replica: int, cores: List[int], tasks, results):
+    """
+    Runs one model replica: pins itself to cores, sizes torch's thread pool to them
+    and annotates batches from tasks until it gets None.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    args = copy.copy(args)
+    args.threads, args.interop_threads = len(cores), 1
+    start = time.perf_counter()
+    try:
+        annotator = annotator_from_args(args)
+    except Exception as error:
+        results.put(("failed", replica, repr(error)))
+        return
+    stats = {"cores": cores, "load_time": time.perf_counter() - start}
+    results.put(("ready", replica, stats | (memory_mb() or {})))
+    while (task := tasks.get()) is not None:
+        batch_id, sentences = task
+        try:
+            outputs = annotator.annotate(sentences)
+        except Exception as error:
+            results.put(("error", batch_id, repr(error)))
+            continue
+        # memory once the weights have been read, not just mapped
+        results.put(("done", batch_id, (outputs, replica, memory_mb() or {})))
+
+
+class WorkerPool:
+    """
+    Model replicas in separate processes, each pinned to its own cores with a thread
+    pool of that size, fed batches from one work queue.
+
+    A small model does not keep many cores busy from one process; several replicas
+    with a few threads each usually do better. With shared_weights, replicas load
+    the checkpoint with inference.load_shared_model, so their weights are views of
+    the same mapped safetensors files and held once, in the page cache; a quantized
+    model is converted in each replica and so is not shared. replica_stats has each
+    replica's rss, pss and private memory (instrument.memory_mb) after its last
+    batch, to check.
+    The annotation cache is not used in replicas.
+    """
+
+    def __init__(
+        self,
+        args,
+        replicas: int,
+        cores: Optional[List[int]] = None,
+        shared_weights: bool = True,
+    ):
+        self.args = copy.copy(args)
+        self.args.cache = None
+        self.args.shared_weights = shared_weights
+        self.core_sets = partition_cores(cores or available_cores(), replicas)
+        self.context = multiprocessing.get_context("spawn")
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        self.processes = []
+        self.replica_stats = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        for replica, cores in enumerate(self.core_sets):
+            process = self.context.Process(
+                target=replica_main,
+                args=(self.args, replica, cores, self.tasks, self.results),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        while len(self.replica_stats) < len(self.processes):
+            status, replica, payload = self.next_result()
+            if status == "failed":
+                self.close()
+                raise RuntimeError(f"WorkerPool: replica {replica} failed to load: {payload}")
+            self.replica_stats[replica] = payload
+
+    def next_result(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    raise RuntimeError("WorkerPool: a replica exited")
+
+    def annotate(self, sentences: List[str], batch_size: int = 32) -> List[str]:
+        """
+        Annotates sentences in batches of batch_size spread over the replicas and
+        returns the outputs in input order.
+        """
+        batches = [sentences[i : i + batch_size] for i in range(0, len(sentences), batch_size)]
+        for batch_id, batch in enumerate(batches):
+            self.tasks.put((batch_id, batch))
+        outputs, errors = [None] * len(batches), []
+        # collect every batch even after an error, so none is left in the queue
+        for _ in batches:
+            status, batch_id, payload = self.next_result()
+            if status == "error":
+                errors.append(f"batch {batch_id} failed: {payload}")
+                continue
+            outputs[batch_id], replica, memory = payload
+            self.replica_stats[replica].update(memory)
+        if errors:
+            raise RuntimeError(f"WorkerPool: {errors[0]}")
+        return [output for batch in outputs for output in batch]
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
@@ -0,0 +1,120 @@
+import pytest
+import annotation_cache
+from annotation_cache import AnnotationCache, cache_namespace, normalize_sentence
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # one tick per lookup or store, so last-use times are distinct
+    now = [1000.0]
+
+    def time():
+        now[0] += 1
+        return now[0]
+
+    monkeypatch.setattr(annotation_cache.time, "time", time)
+
+
+def open_cache(tmp_path, **kwargs):
+    return AnnotationCache(str(tmp_path / "cache" / "annotations.sqlite"), **kwargs)
+
+
+def test_round_trip_through_memory_and_disk(tmp_path):
+    cache = open_cache(tmp_path)
+    cache.put_many("ns", {"前": "<ruby>前<rt>まえ</rt></ruby>", "雨": "<ruby>雨<rt>あめ</rt></ruby>"})
+    assert cache.get_many("ns", ["前", "雨", "前"]) == {
+        "前": "<ruby>前<rt>まえ</rt></ruby>",
+        "雨": "<ruby>雨<rt>あめ</rt></ruby>",
+    }
+    assert cache.stats["memory_hits"] == 2 and cache.stats["disk_hits"] == 0
+    cache.close()
+
+    reopened = open_cache(tmp_path)
+    assert reopened.size == cache.size > 0
+    assert reopened.get_many("ns", ["前"]) == {"前": "<ruby>前<rt>まえ</rt></ruby>"}
+    assert reopened.stats["disk_hits"] == 1
+    # now remembered in memory
+    assert reopened.get_many("ns", ["前"]) == {"前": "<ruby>前<rt>まえ</rt></ruby>"}
+    assert reopened.stats["memory_hits"] == 1
+    reopened.close()
+
+
+def test_memory_is_a_bounded_lru(tmp_path):
+    cache = open_cache(tmp_path, memory_size=2)
+    cache.put_many("ns", {"a": "A", "b": "B"})
+    cache.get_many("ns", ["a"])
+    cache.put_many("ns", {"c": "C"})
+    assert list(cache.memory) == [("ns", "a"), ("ns", "c")]
+    # b is still on disk
+    assert cache.get_many("ns", ["b"]) == {"b": "B"}
+    assert cache.stats["disk_hits"] == 1
+    cache.close()
+
+
+def test_replacing_an_entry_keeps_the_size(tmp_path):
+    cache = open_cache(tmp_path)
+    cache.put_many("ns", {"a": "AAAA"})
+    cache.put_many("ns", {"a": "AA"})
+    assert cache.size == 2
+    assert cache.get_many("ns", ["a"]) == {"a": "AA"}
+    cache.close()
+
+
+def test_evicts_least_recently_used_down_to_90_percent(tmp_path, clock):
+    cache = open_cache(tmp_path, max_bytes=100)
+    for sentence in "abcde":
+        cache.put_many("ns", {sentence: sentence * 20})
+    assert cache.size == 100 and cache.stats["evicted"] == 0
+    # a is used again, so b and c are now the least recently used
+    cache.get_many("ns", ["a"])
+    cache.put_many("ns", {"f": "f" * 20})
+    # 120 bytes, over max_bytes: evicted down to 90 bytes
+    assert cache.stats["evicted"] == 2
+    assert cache.size == 80
+    assert set(cache.get_many("ns", list("abcdef"))) == {"a", "d", "e", "f"}
+    assert ("ns", "b") not in cache.memory
+    cache.close()
+
+    reopened = open_cache(tmp_path)
+    assert reopened.size == 80
+    assert set(reopened.get_many("ns", list("abcdef"))) == {"a", "d", "e", "f"}
+    reopened.close()
+
+
+def test_namespaces_are_isolated(tmp_path):
+    cache = open_cache(tmp_path)
+    int8 = cache_namespace({"model": "m", "quantize": True})
+    fp32 = cache_namespace({"model": "m", "quantize": False})
+    assert int8 != fp32
+    cache.put_many(int8, {"前": "int8"})
+    assert cache.get_many(fp32, ["前"]) == {}
+    cache.put_many(fp32, {"前": "fp32"})
+    assert cache.get_many(int8, ["前"]) == {"前": "int8"}
+    assert cache.get_many(fp32, ["前"]) == {"前": "fp32"}
+    cache.close()
+
+
+def test_cache_namespace_ignores_key_order():
+    assert cache_namespace({"a": 1, "b": [2]}) == cache_namespace({"b": [2], "a": 1})
+
+
+def test_hit_and_miss_counts(tmp_path):
+    cache = open_cache(tmp_path)
+    assert cache.hit_rate() is None
+    cache.put_many("ns", {"a": "A", "b": "B"})
+    cache.memory.clear()
+    cache.get_many("ns", ["a", "x", "y"])  # a from disk
+    cache.get_many("ns", ["a", "b", "z"])  # a from memory, b from disk
+    metrics = cache.metrics()
+    assert metrics["memory_hits"] == 1
+    assert metrics["disk_hits"] == 2
+    assert metrics["misses"] == 3
+    assert metrics["stored"] == 2
+    assert metrics["hit_rate"] == 0.5
+    cache.close()
+
+
+def test_normalize_sentence():
+    # NFC and surrounding whitespace only
+    assert normalize_sentence(" が \n") == "が"
+    assert normalize_sentence("ｶﾞ") == "ｶﾞ"
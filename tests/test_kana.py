@@ -0,0 +1,46 @@
+import pytest
+from kana import normalize_kana_batch
+
+
+@pytest.mark.parametrize(
+    "level, expected",
+    [
+        (0, ["カッコー", "すゝむ", "こゝろ々"]),
+        (1, ["かっこー", "すゝむ", "こゝろ々"]),  # script
+        (2, ["かっこう", "すゝむ", "こゝろ々"]),  # long_vowel
+        (3, ["かつこう", "すゝむ", "こゝろ々"]),  # small_kana
+        (4, ["かつこう", "すすむ", "こころろ"]),  # iteration
+    ],
+)
+def test_levels_apply_in_order(level, expected):
+    assert normalize_kana_batch(["カッコー", "すゝむ", "こゝろ々"], level) == expected
+
+
+def test_long_vowel():
+    assert normalize_kana_batch(["らーめん", "しょーゆ", "ねー", "こーー"], 2) == [
+        "らあめん",
+        "しょうゆ",  # う after the お row, as in process_reading
+        "ねえ",
+        "こうう",
+    ]
+
+
+def test_voiced_iteration_mark():
+    assert normalize_kana_batch(["ほゞ", "ハヾ"], 4) == ["ほぼ", "はば"]
+
+
+def test_iteration_mark_after_kanji_is_kept():
+    # 々 after kanji is read with them; in a reading it is left alone
+    assert normalize_kana_batch(["時々", "とき々"], 4) == ["時々", "ときき"]
+    assert normalize_kana_batch(["とき々"], 4, reading=True) == ["とき々"]
+
+
+def test_keeps_lengths_and_other_characters():
+    strings = ["ヵ月", "一ヶ月", "ABC、。", "", "𠮷野家"]
+    normalized = normalize_kana_batch(strings, 4)
+    assert normalized == strings
+    assert [len(string) for string in normalized] == [len(string) for string in strings]
+
+
+def test_empty_batch():
+    assert normalize_kana_batch([], 4) == []
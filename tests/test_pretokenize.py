@@ -0,0 +1,81 @@
+import json
+import numpy as np
+import pytest
+from pretokenize import first_fit_decreasing
+
+
+def check_packing(lengths, capacity, bins):
+    assert sorted(item for items in bins for item in items) == list(range(len(lengths)))
+    assert all(sum(lengths[item] for item in items) <= capacity for items in bins)
+
+
+def test_first_fit_decreasing():
+    lengths = np.array([5, 3, 8, 2, 4, 6], dtype=np.uint64)
+    bins = first_fit_decreasing(lengths, 10)
+    check_packing(lengths, 10, bins)
+    # 8 2 | 6 4 | 5 3
+    assert bins == [[2, 3], [5, 4], [0, 1]]
+
+
+def test_first_fit_decreasing_takes_the_first_bin_that_fits():
+    lengths = np.array([6, 5, 4, 1], dtype=np.uint64)
+    # 1 goes into the first bin with room, not the emptiest one
+    assert first_fit_decreasing(lengths, 7) == [[0, 3], [1], [2]]
+
+
+def test_first_fit_decreasing_edges():
+    assert first_fit_decreasing(np.zeros(0, dtype=np.uint64), 10) == []
+    assert first_fit_decreasing(np.array([10], dtype=np.uint64), 10) == [[0]]
+    assert first_fit_decreasing(np.array([1] * 5, dtype=np.uint64), 2) == [[0, 1], [2, 3], [4]]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_first_fit_decreasing_matches_linear_scan(seed):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 100, size=300).astype(np.uint64)
+    expected = []
+    free = []
+    for item in np.argsort(-lengths.astype(np.int64), kind="stable").tolist():
+        bin_index = next((i for i, room in enumerate(free) if room >= lengths[item]), len(free))
+        if bin_index == len(free):
+            free.append(100)
+            expected.append([])
+        free[bin_index] -= int(lengths[item])
+        expected[bin_index].append(item)
+    bins = first_fit_decreasing(lengths, 100)
+    check_packing(lengths, 100, bins)
+    assert bins == expected
+
+
+def test_packed_examples_do_not_attend_to_each_other(tmp_path):
+    torch = pytest.importorskip("torch")
+    from inference import tiny_random_model
+    from pretokenize import PackedDataset, pretokenize
+
+    rows = [
+        {"instruction": "ふりがな", "input": "雨が", "output": "<ruby>雨<rt>あめ</rt></ruby>が"},
+        {"input": "[INST] ふりがな\n今日\n[/INST]", "output": "<ruby>今日<rt>きょう</rt></ruby>"},
+        {"instruction": "ふりがな", "input": "前", "output": "<ruby>前<rt>まえ</rt></ruby>"},
+    ]
+    path = tmp_path / "rows.jsonl"
+    path.write_text("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+    pretokenize([str(path)], str(tmp_path / "packed"), "tiny-random", 128, workers=1)
+    dataset = PackedDataset(str(tmp_path / "packed"))
+    assert len(dataset) == 1
+    item = dataset[0]
+    assert "attention_mask" not in item
+
+    model = tiny_random_model()[0]
+    with torch.no_grad():
+        packed = model(
+            input_ids=torch.from_numpy(item["input_ids"])[None],
+            position_ids=torch.from_numpy(item["position_ids"])[None],
+            use_cache=False,
+        ).logits[0]
+        starts = np.flatnonzero(item["position_ids"] == 0).tolist() + [len(item["input_ids"])]
+        # three examples, then the padding
+        assert len(starts) == 5
+        for start, end in zip(starts[:-2], starts[1:-1]):
+            input_ids = torch.from_numpy(item["input_ids"][start:end])[None]
+            alone = model(input_ids=input_ids).logits[0]
+            assert torch.allclose(packed[start:end], alone, atol=1e-5)
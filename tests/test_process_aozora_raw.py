@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("datasets")
+from process_aozora_raw import ANNOTATION_PATTERN, iter_body_lines, parse_ruby
+
+DELIMITERS = {"ruby": ("<ruby>", "</ruby>"), "rt": ("<rt>", "</rt>")}
+
+
+def test_parse_ruby_kanji_run():
+    assert parse_ruby("その前《まえ》は", DELIMITERS) == (
+        "その前は",
+        "その<ruby>前<rt>まえ</rt></ruby>は",
+        "そのまえは",
+    )
+
+
+def test_parse_ruby_explicit_base():
+    # ｜ marks where the base starts, here with kana in it
+    assert parse_ruby("青い｜鳥かご《とりかご》だ", DELIMITERS) == (
+        "青い鳥かごだ",
+        "青い<ruby>鳥かご<rt>とりかご</rt></ruby>だ",
+        "青いとりかごだ",
+    )
+
+
+def test_parse_ruby_base_is_the_kanji_run_only():
+    assert parse_ruby("大きな東京《とうきょう》", DELIMITERS)[1] == (
+        "大きな<ruby>東京<rt>とうきょう</rt></ruby>"
+    )
+
+
+def test_parse_ruby_without_ruby():
+    assert parse_ruby("雨｜だった", DELIMITERS) == ("雨だった",) * 3
+
+
+def test_annotations_and_header():
+    assert ANNOTATION_PATTERN.sub("", "※［＃「てへん＋劣」、第3水準1-84-77］いた") == "※いた"
+    lines = ["題名\n", "-------\n", "《》：ルビ\n", "-------\n", "本文\n", "底本：全集\n", "後"]
+    assert list(iter_body_lines(lines)) == ["題名\n", "本文\n"]
@@ -0,0 +1,103 @@
+import pytest
+from ruby import CopyState, RubyStreamParser, Span, covers_sentence, parse_ruby
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "その",
+        "その<ru",
+        "その<ruby>前",
+        "その<ruby>前<rt>ま",
+        "その<ruby>前<rt>まえ</rt>",
+        "その<ruby>前<rt>まえ</rt></ruby>は",
+        "その<ruby>前<rt>まえ�",
+    ],
+)
+def test_copy_state_valid_prefixes(text):
+    assert CopyState.from_text("その前は", text) is not None
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "あの",  # not the sentence
+        "<ruby>",  # ruby on kana
+        "その<ruby>前は",  # kana in the base
+        "その<ruby><rt>",  # empty base
+        "その<ruby>前<rt></rt>",  # empty reading
+        "その<ruby>前<rt>mae",  # reading not kana
+        "その<ruby>前<rt>まえ</rt>は",  # </ruby> must follow </rt>
+        "その<ruby>前<rt>" + "ま" * 7,  # longer than MAX_READING_PER_CHAR per kanji
+        "その前は。",  # past the end
+    ],
+)
+def test_copy_state_invalid_prefixes(text):
+    assert CopyState.from_text("その前は", text) is None
+
+
+def test_copy_state_complete():
+    assert CopyState.from_text("その前は", "その<ruby>前<rt>まえ</rt></ruby>は").complete
+    assert CopyState.from_text("その前は", "その前は").complete
+    assert not CopyState.from_text("その前は", "その<ruby>前<rt>まえ</rt></ruby>").complete
+    assert not CopyState.from_text("前", "<ruby>前<rt>まえ</rt>").complete
+
+
+def test_copy_state_forced_text():
+    assert CopyState("その前は").forced_text() == "その"
+    assert CopyState.from_text("その前は", "その<ru").forced_text() == "by>"
+    assert CopyState.from_text("その前は", "その<ruby>前<rt>まえ</rt>").forced_text() == "</ruby>"
+    full = CopyState.from_text("前", "<ruby>前<rt>" + "ま" * 6)
+    assert full.forced_text() == "</rt>"
+
+
+def test_copy_state_literal_angle_bracket():
+    # a "<" in the sentence is copied, not taken for a tag
+    assert CopyState.from_text("a<b", "a<b").complete
+
+
+def test_copy_state_copy_is_independent():
+    state = CopyState.from_text("その前は", "その")
+    copied = state.copy()
+    assert copied.feed("<ruby>前")
+    assert state.pos == 2 and copied.pos == 3
+
+
+def test_parse_ruby():
+    base_text, spans = parse_ruby("その<ruby>前<rt>まえ</rt></ruby>は<ruby>雨<rt>あめ</rt></ruby>")
+    assert base_text == "その前は雨"
+    assert spans == [Span(2, "前", "まえ"), Span(4, "雨", "あめ")]
+
+
+def test_parse_ruby_unmatched():
+    with pytest.raises(ValueError):
+        parse_ruby("<ruby>前<rt>まえ</ruby>")
+
+
+def test_covers_sentence():
+    assert covers_sentence("前は", "<ruby>前<rt>まえ</rt></ruby>は")
+    assert not covers_sentence("前は", "<ruby>前<rt>まえ</rt></ruby>")
+    assert not covers_sentence("前は", "<ruby>前<rt>まえ</rt>は")
+
+
+def parse_in_pieces(text, size):
+    parser = RubyStreamParser()
+    spans = []
+    for start in range(0, len(text), size):
+        spans += parser.feed(text[start : start + size])
+    return spans
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 100])
+def test_stream_parser_matches_parse_ruby(size):
+    text = "その<ruby>前<rt>まえ</rt></ruby>は<ruby>雨<rt>あめ</rt></ruby>だった<ruby>日<rt>ひ</rt></ruby>"
+    assert parse_in_pieces(text, size) == parse_ruby(text)[1]
+
+
+@pytest.mark.parametrize("size", [1, 4, 100])
+def test_stream_parser_skips_malformed_span(size):
+    # the first span never closes its reading; the offsets of the next one still count it
+    text = "<ruby>前<rt>まえ</ruby>は<ruby>雨<rt>あめ</rt></ruby>"
+    spans = parse_in_pieces(text, size)
+    assert [(span.base, span.reading) for span in spans] == [("雨", "あめ")]
@@ -0,0 +1,44 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+from inference import load_shared_model, map_safetensors, tiny_random_model
+
+
+@pytest.fixture(scope="module")
+def checkpoint(tmp_path_factory):
+    path = tmp_path_factory.mktemp("checkpoint")
+    model = tiny_random_model()[0]
+    model.save_pretrained(str(path))
+    return str(path), model
+
+
+def test_map_safetensors_matches_the_file(checkpoint):
+    from safetensors.torch import load_file
+
+    path, _ = checkpoint
+    mapped = map_safetensors(f"{path}/model.safetensors")
+    loaded = load_file(f"{path}/model.safetensors")
+    assert mapped.keys() == loaded.keys()
+    assert all(torch.equal(mapped[name], loaded[name]) for name in loaded)
+
+
+def test_load_shared_model_uses_the_mapped_weights(checkpoint):
+    path, model = checkpoint
+    shared = load_shared_model(path)
+    # every parameter lies in a mapping of the file, not in memory of its own
+    try:
+        with open("/proc/self/maps", "r") as file:
+            lines = [line.split() for line in file if "model.safetensors" in line]
+    except OSError:
+        pytest.skip("no /proc")
+    ranges = [[int(bound, 16) for bound in line[0].split("-")] for line in lines]
+    for parameter in shared.parameters():
+        assert any(start <= parameter.data_ptr() < end for start, end in ranges)
+    input_ids = torch.arange(2, 20)[None]
+    with torch.no_grad():
+        assert torch.equal(shared(input_ids).logits, model(input_ids).logits)
+
+
+def test_load_shared_model_needs_safetensors(tmp_path):
+    with pytest.raises(ValueError):
+        load_shared_model(str(tmp_path))
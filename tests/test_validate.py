@@ -0,0 +1,104 @@
+import pytest
+import validate
+from validate import check_output, repair_output, word_chunks
+
+
+def test_check_output_valid():
+    assert check_output("その前は", "その<ruby>前<rt>まえ</rt></ruby>は") is None
+    assert check_output("その前は", "その前は") is None
+
+
+@pytest.mark.parametrize(
+    "output, error",
+    [
+        ("その<ruby>前<rt>まえ</ruby>は", "malformed"),
+        ("この<ruby>前<rt>まえ</rt></ruby>は", "base_text"),
+        ("<ruby>その<rt>その</rt></ruby><ruby>前<rt>まえ</rt></ruby>は", "base"),
+        ("その<ruby>前<rt></rt></ruby>は", "reading"),
+        ("その<ruby>前<rt>mae</rt></ruby>は", "reading"),
+    ],
+)
+def test_check_output_errors(output, error):
+    assert check_output("その前は", output) == error
+
+
+def test_word_chunks():
+    assert word_chunks("雨、その前は。") == ["雨", "、", "その前は", "。"]
+
+
+@pytest.mark.parametrize(
+    "output",
+    [
+        "その前まえは雨あめだった。",  # no tags at all
+        "その<ruby>前<rt>まえ</ruby>は<ruby>雨<rt>あめ</rt></ruby>だった。",
+        "その<ruby>前<rt>まえ</rt></ruby>は雨<rt>あめ</rt>だった。",
+    ],
+)
+def test_repair_output(output):
+    assert (
+        repair_output("その前は雨だった。", output)
+        == "その<ruby>前<rt>まえ</rt></ruby>は<ruby>雨<rt>あめ</rt></ruby>だった。"
+    )
+
+
+def test_repair_output_keeps_ruby_off_kana():
+    # kana read as themselves and are never a base
+    assert repair_output("その前は", "その前まえは") == "その<ruby>前<rt>まえ</rt></ruby>は"
+    assert repair_output("その前は", "<ruby>その<rt>その</rt></ruby>前まえは") is None
+
+
+def test_repair_output_joins_readings_split_inside_a_block():
+    repaired = repair_output("漢字を書く", "<ruby>漢<rt>かん</rt></ruby>字じを書<rt>か</rt>く")
+    assert repaired == "<ruby>漢字<rt>かんじ</rt></ruby>を<ruby>書<rt>か</rt></ruby>く"
+
+
+@pytest.mark.parametrize(
+    "output",
+    [
+        "その前はあめだった。",  # a kanji changed
+        "この前まえは雨あめだった。",  # kana changed
+        "その前まえは雨あめだった！",  # text between runs changed
+        "その前は雨あめだった。",  # a block without reading
+        "その前まえ、は雨あめだった。",  # punctuation added
+    ],
+)
+def test_repair_output_unrepairable(output):
+    assert repair_output("その前は雨だった。", output) is None
+
+
+@pytest.mark.parametrize(
+    "sentence, output",
+    [
+        # one reading for several blocks, after the last
+        ("持ち越し", "<ruby>持ち越し<rt>もちこし</rt></ruby>"),
+        ("雨の日", "雨の日あめのひ"),
+        ("前の前", "<ruby>前の前<rt>まえのまえ</rt></ruby>"),
+        # a reading after the kana that follow its block
+        ("書く", "<ruby>書く<rt>かく</rt></ruby>"),
+        ("雨の日", "雨のあめの日ひ"),
+        ("歌う声", "<ruby>歌う<rt>うたう</rt></ruby><ruby>声<rt>こえ</rt></ruby>"),
+    ],
+)
+def test_repair_output_rejects_readings_away_from_their_block(sentence, output):
+    assert repair_output(sentence, output) is None
+
+
+def test_repair_output_is_linear(monkeypatch):
+    # exhaustive alignment of a long run of kanji and kana is exponential in its
+    # blocks; the repair looks at each character of the output once
+    calls = []
+    take_kana = validate.take_kana
+
+    def counted(text, position):
+        calls.append(position)
+        return take_kana(text, position)
+
+    monkeypatch.setattr(validate, "take_kana", counted)
+
+    def count_calls(repeats):
+        calls.clear()
+        repaired = repair_output("子の" * repeats, "子この" * repeats)
+        assert repaired == "<ruby>子<rt>こ</rt></ruby>の" * repeats
+        return len(calls)
+
+    assert count_calls(40) == 2 * count_calls(20) == 4 * count_calls(10)